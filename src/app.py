@@ -1,19 +1,31 @@
+import gc
 from wsgiref import simple_server
 
 import falcon
 
-from resources import ProposalsResource, DifferenceResource
+from cache import ResponseCache
+from config import RELOAD_INTERVAL, RESPONSE_CACHE_MAX_BYTES
+from metrics import REGISTRY, MetricsMiddleware
+from resources import (
+    DifferenceResource, MetricsResource, ProposalsResource, RoutesResource,
+    SearchesResource, StatsResource)
 from storage import Storage
 
 
 def create_app(storage: 'Storage') -> 'falcon.API':
     """Создает приложение."""
-    api = falcon.API()
-    proposals_resource = ProposalsResource(storage)
-    difference_resource = DifferenceResource(storage)
+    api = falcon.API(middleware=[MetricsMiddleware()])
+    # Общий кэш готовых ответов.
+    cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+    proposals_resource = ProposalsResource(storage, cache)
+    difference_resource = DifferenceResource(storage, cache)
     # Роутинг.
     api.add_route('/proposals', proposals_resource)
     api.add_route('/difference', difference_resource)
+    api.add_route('/stats', StatsResource(storage, cache))
+    api.add_route('/routes', RoutesResource(storage, cache))
+    api.add_route('/searches/{source}', SearchesResource(storage))
+    api.add_route('/metrics', MetricsResource())
 
     return api
 
@@ -23,8 +35,19 @@ def get_app() -> 'falcon.API':
     # Инициализируем хранилище, которое хранит результаты парсинга xml.
     # Хранилище инициализируется перед созданием приложения один раз,
     # чтобы не парсить каждый раз xml на новые запросы.
+    # Метрики прошлых запусков не учитываются.
+    REGISTRY.clear_directory()
     storage = Storage()
     storage.load()
+    # Метрики загрузки сохраняются до форка воркеров.
+    REGISTRY.flush()
+    # Новые и измененные файлы подгружаются в фоне без перезапуска.
+    if RELOAD_INTERVAL:
+        storage.watch(RELOAD_INTERVAL)
+    # Под gunicorn --preload воркеры форкаются после загрузки. Загруженные
+    # объекты переносятся в постоянное поколение сборщика мусора, чтобы
+    # его проходы в воркерах не копировали страницы памяти мастера.
+    gc.freeze()
 
     return create_app(storage)
 
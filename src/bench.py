@@ -0,0 +1,261 @@
+"""Бенчмарки.
+
+Набор замеров по этапам (парсинг, загрузка, сортировки, ранжирование,
+сериализация) на синтетических данных разного объема (см. datagen.py).
+Результаты сравниваются с сохраненными базовыми значениями: если этап
+стал медленнее или требует больше памяти, чем базовое значение плюс
+порог, бенчмарк завершается с ошибкой.
+
+Запуск:
+    python bench.py
+    python bench.py --sizes 1000 10000 100000 --repeat 5
+    python bench.py --save  # сохранить результаты как базовые
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from operator import methodcaller
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import datagen
+from config import ALL_KEY, ROOT_PATH, RS_VIA_3_XML
+from models import ORDER_KEYS, OptimalityWeights, Proposals
+from parser import Parser
+from schemas import ProposalSchema
+from storage import Storage
+from utils import jsonify
+
+# Файл с базовыми результатами бенчмарков.
+BASELINE_PATH = os.path.join(ROOT_PATH, 'bench_baseline.json')
+# Допустимое ухудшение относительно базового значения.
+REGRESSION_THRESHOLD = 0.25
+# Количество предложений в синтетических данных по умолчанию.
+SIZES = (1000, 10000)
+
+
+def bench_parse(file_path: str = RS_VIA_3_XML, repeat: int = 20) -> dict:
+    """Замеряет пропускную способность Parser.parse_stream на файле.
+
+    Возвращает лучший результат из repeat прогонов.
+    """
+    size = Path(file_path).stat().st_size
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = Parser.parse_stream(file_path)
+        count = sum(1 for _ in data['proposals'])
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    result = {
+        'file': Path(file_path).name,
+        'proposals': count,
+        'seconds': best,
+        'proposals_per_second': count / best,
+        'mb_per_second': size / best / 2 ** 20,
+    }
+
+    return result
+
+
+def bench_memory() -> dict:
+    """Замеряет память, занимаемую загруженным хранилищем.
+
+    Считается память, оставшаяся занятой после Storage.load
+    (модели, индексы и JSON-фрагменты), в пересчете на одно предложение.
+    """
+    gc.collect()
+    tracemalloc.start()
+    storage = Storage(workers=1)
+    storage.load()
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(storage.get_all_proposals().proposals)
+
+    result = {
+        'proposals': count,
+        'bytes': size,
+        'peak_bytes': peak,
+        'bytes_per_proposal': size / count,
+    }
+
+    return result
+
+
+def stages(file_path: str) -> Iterator[Tuple[str, Callable[[], object]]]:
+    """Генерирует этапы бенчмарка на файле: (имя этапа, функция).
+
+    Каждый этап замеряется отдельно, функция выполняет только сам этап.
+    Для сортировок набор предложений создается заново, чтобы в замер
+    попадало построение таблицы и индексов.
+    """
+    content = Path(file_path).read_text()
+    sources = {'synthetic': file_path}
+    yield 'parse', lambda: Parser.parse(content)
+    yield 'storage_load', lambda: Storage(
+        sources, workers=1, snapshot_path=None).load()
+
+    storage = Storage(sources, workers=1, snapshot_path=None)
+    storage.load()
+    proposals = storage.get_all_proposals().proposals
+    for key in ORDER_KEYS:
+        yield f'order_by.{key}', lambda key=key: Proposals(
+            proposals).order_by(key)
+
+    data = Proposals(proposals)
+    key = methodcaller(
+        'calc_optimality',
+        min_prize=data.min_prize,
+        min_duration=data.min_duration)
+    yield 'calc_optimality', lambda: sorted(proposals, key=key, reverse=True)
+    weights = OptimalityWeights(price=0.5, duration=0.3, stops=0.2)
+    yield 'rank', lambda: Proposals(proposals).rank(weights)
+
+    schema = ProposalSchema(strict=True, many=True)
+    yield 'schema_dump', lambda: schema.dump(proposals)
+    dumped = {'proposals': schema.dump(proposals).data}
+    yield 'jsonify', lambda: jsonify(dumped, indent=None)
+
+
+def measure(func: Callable[[], object], repeat: int) -> dict:
+    """Замеряет время (лучшее из repeat прогонов) и пик памяти функции.
+
+    Память считается отдельным прогоном под tracemalloc, чтобы
+    трассировка не влияла на время.
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def run_suite(sizes=SIZES, repeat: int = 3, segments=(1, 3),
+              return_ratio: float = 0.5) -> Dict[str, dict]:
+    """Прогоняет все этапы на синтетических данных заданных объемов.
+
+    Возвращает словарь {"этап/объем": результат measure}.
+    """
+    result = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            file_path = os.path.join(tmp_dir, f'RS_Synthetic_{size}.xml')
+            with open(file_path, 'w', encoding='utf-8') as f:
+                datagen.write(
+                    f, proposals=size, segments=segments,
+                    return_ratio=return_ratio)
+            for name, func in stages(file_path):
+                name = f'{name}/{size}'
+                result[name] = measure(func, repeat)
+                print(format_result(name, result[name]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return result
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """Возвращает описания регрессий относительно базовых значений.
+
+    Этапы, которых нет в базовых значениях, не сравниваются.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            base = baseline[name][metric]
+            if base and result[metric] > base * (1 + threshold):
+                regressions.append(
+                    f'{name}: {metric} {result[metric]:.6g} > '
+                    f'{base:.6g} (+{threshold:.0%})')
+
+    return regressions
+
+
+def format_result(name: str, result: dict) -> str:
+    return (
+        f"{name:<28} {result['seconds'] * 1000:10.2f} мс "
+        f"{result['peak_bytes'] / 2 ** 20:10.2f} МБ")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарки.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--segments', type=int, nargs=2, default=(1, 3),
+        metavar=('MIN', 'MAX'))
+    parser.add_argument('--return-ratio', type=float, default=0.5)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument(
+        '--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument(
+        '--save', action='store_true',
+        help='сохранить результаты как базовые')
+    args = parser.parse_args()
+
+    result = bench_parse()
+    print(
+        f"parse {result['file']}: {result['proposals']} предложений "
+        f"за {result['seconds'] * 1000:.1f} мс "
+        f"({result['proposals_per_second']:.0f} предл./с, "
+        f"{result['mb_per_second']:.1f} МБ/с)")
+    result = bench_memory()
+    print(
+        f"memory {ALL_KEY}: {result['proposals']} предложений, "
+        f"{result['bytes'] / 2 ** 20:.1f} МБ "
+        f"(пик {result['peak_bytes'] / 2 ** 20:.1f} МБ), "
+        f"{result['bytes_per_proposal'] / 1024:.1f} КБ на предложение")
+
+    results = run_suite(
+        sizes=args.sizes, repeat=args.repeat, segments=tuple(args.segments),
+        return_ratio=args.return_ratio)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'Базовые значения сохранены в {args.baseline}.')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'Нет базовых значений {args.baseline}, сравнение пропущено.')
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'Регрессия: {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Union
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    """Готовый ответ."""
+    body: bytes
+    # Сильный ETag, посчитанный по телу ответа.
+    etag: str
+
+    @classmethod
+    def from_body(cls, body: bytes) -> 'CachedResponse':
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+        return cls(body=body, etag=f'"{digest}"')
+
+    def matches(self, if_none_match: Union[str, None]) -> bool:
+        """Проверяет, совпадает ли ETag с заголовком If-None-Match."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+
+        return self.etag in (tag.strip() for tag in if_none_match.split(','))
+
+
+class ResponseCache:
+    """LRU-кэш готовых ответов, ограниченный суммарным размером тел.
+
+    Кэш привязан к версии хранилища: при обращении с другой версией
+    все сохраненные ответы сбрасываются.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size(self) -> int:
+        """Суммарный размер тел ответов в байтах."""
+        return self._size
+
+    def get(self, key: Hashable,
+            version: int) -> Union['CachedResponse', None]:
+        """Возвращает ответ по ключу или None, если его нет в кэше."""
+        with self._lock:
+            self._check_version(version)
+            result = self._items.get(key)
+            if result is not None:
+                self._items.move_to_end(key)
+
+        return result
+
+    def set(self, key: Hashable, version: int,
+            body: bytes) -> 'CachedResponse':
+        """Сохраняет тело ответа и возвращает готовый ответ.
+
+        Ответы больше max_bytes не сохраняются. Если места не хватает,
+        вытесняются давно не запрошенные ответы.
+        """
+        result = CachedResponse.from_body(body)
+        if len(body) > self.max_bytes:
+            return result
+
+        with self._lock:
+            self._check_version(version)
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old.body)
+            self._items[key] = result
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted.body)
+
+        return result
+
+    def clear(self) -> None:
+        """Очищает кэш."""
+        with self._lock:
+            self._clear()
+
+    def _check_version(self, version: int) -> None:
+        if version != self._version:
+            self._clear()
+            self._version = version
+
+    def _clear(self) -> None:
+        self._items.clear()
+        self._size = 0
@@ -0,0 +1,235 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Sequence, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from models import OptimalityWeights, Proposal
+
+# Числовые колонки таблицы предложений.
+COLUMNS = (
+    'adult_prize',
+    'child_prize',
+    'infant_prize',
+    'duration',
+    'segments',
+    'stops',
+    'departure',
+    'arrival',
+    'has_return',
+    'source',
+    'carrier',
+)
+
+
+@dataclass(frozen=True)
+class ProposalsTable:
+    """Колоночное представление предложений.
+
+    Каждая колонка - непрерывный массив numpy, i-й элемент которого
+    относится к i-му предложению в Proposals.proposals. Все агрегаты
+    и ранжирование считаются векторно по этим массивам.
+    """
+    # Итоговые стоимости для взрослого, ребенка и младенца - целые
+    # с PRICE_EXPONENT знаками после запятой (см. Proposal.adult_prize).
+    adult_prize: np.ndarray
+    child_prize: np.ndarray
+    infant_prize: np.ndarray
+    # Продолжительность перелета туда в минутах.
+    duration: np.ndarray
+    # Количество сегментов перелета туда.
+    segments: np.ndarray
+    # Количество остановок перелета туда: пересадки и технические посадки.
+    stops: np.ndarray
+    # Время вылета из начального и прилета в конечный пункт (datetime64[m]).
+    departure: np.ndarray
+    arrival: np.ndarray
+    # Есть ли перелет обратно.
+    has_return: np.ndarray
+    # Индекс источника в sources.
+    source: np.ndarray
+    # Индекс перевозчика первого сегмента в carriers.
+    carrier: np.ndarray
+    sources: Tuple[str, ...]
+    carriers: Tuple[str, ...]
+
+    @classmethod
+    def from_proposals(
+            cls, proposals: Iterable['Proposal']) -> 'ProposalsTable':
+        """Строит таблицу за один проход по предложениям."""
+        columns = {name: [] for name in COLUMNS}
+        sources = {}
+        carriers = {}
+        for proposal in proposals:
+            onward = proposal.flights.onward
+            carrier_id = onward[0].carrier_id if onward else ''
+            columns['adult_prize'].append(proposal.adult_prize)
+            columns['child_prize'].append(proposal.child_prize)
+            columns['infant_prize'].append(proposal.infant_prize)
+            columns['duration'].append(proposal.duration)
+            columns['segments'].append(len(onward))
+            columns['stops'].append(
+                len(onward) - 1 + sum(f.number_of_stops or 0 for f in onward)
+                if onward else 0)
+            columns['departure'].append(
+                onward[0].departure_timestamp if onward else None)
+            columns['arrival'].append(
+                onward[-1].arrival_timestamp if onward else None)
+            columns['has_return'].append(bool(proposal.flights.returned))
+            columns['source'].append(
+                sources.setdefault(proposal.source, len(sources)))
+            columns['carrier'].append(
+                carriers.setdefault(carrier_id, len(carriers)))
+
+        result = cls(
+            adult_prize=np.array(columns['adult_prize'], dtype=np.int64),
+            child_prize=np.array(columns['child_prize'], dtype=np.int64),
+            infant_prize=np.array(columns['infant_prize'], dtype=np.int64),
+            duration=np.array(columns['duration'], dtype=np.int64),
+            segments=np.array(columns['segments'], dtype=np.int16),
+            stops=np.array(columns['stops'], dtype=np.int16),
+            departure=np.array(columns['departure'], dtype='datetime64[m]'),
+            arrival=np.array(columns['arrival'], dtype='datetime64[m]'),
+            has_return=np.array(columns['has_return'], dtype=np.bool_),
+            source=np.array(columns['source'], dtype=np.int32),
+            carrier=np.array(columns['carrier'], dtype=np.int32),
+            sources=tuple(sources),
+            carriers=tuple(carriers),
+        )
+
+        return result
+
+    @classmethod
+    def concat(cls, tables: Sequence['ProposalsTable']) -> 'ProposalsTable':
+        """Склеивает таблицы наборов предложений (см. Proposals.concat).
+
+        Результат совпадает с from_proposals по склеенным предложениям:
+        коды источников и перевозчиков перенумеровываются в порядке
+        первого появления.
+        """
+        columns = {name: [] for name in COLUMNS}
+        labels = {'sources': {}, 'carriers': {}}
+        for table in tables:
+            for name in COLUMNS:
+                columns[name].append(table.column(name))
+            for name, column in (('sources', 'source'),
+                                 ('carriers', 'carrier')):
+                mapping = np.array([
+                    labels[name].setdefault(label, len(labels[name]))
+                    for label in getattr(table, name)], dtype=np.int32)
+                columns[column][-1] = mapping[table.column(column)]
+
+        if not tables:
+            return cls.from_proposals([])
+
+        return cls(
+            sources=tuple(labels['sources']),
+            carriers=tuple(labels['carriers']),
+            **{name: np.concatenate(columns[name]) for name in COLUMNS})
+
+    def __len__(self) -> int:
+        return len(self.adult_prize)
+
+    def column(self, name: str) -> np.ndarray:
+        """Возвращает колонку по имени."""
+        if name not in COLUMNS:
+            raise KeyError(name)
+
+        return getattr(self, name)
+
+    def source_mask(self, sources: Iterable[str]) -> np.ndarray:
+        """Маска предложений источников с ключами sources."""
+        sources = set(sources)
+        codes = [
+            code for code, source in enumerate(self.sources)
+            if source in sources]
+
+        return np.isin(self.source, codes)
+
+    def argmin(self, name: str) -> int:
+        """Позиция первого предложения с минимальным значением колонки."""
+        return int(np.argmin(self.column(name)))
+
+    def argmax(self, name: str) -> int:
+        """Позиция первого предложения с максимальным значением колонки."""
+        return int(np.argmax(self.column(name)))
+
+    def min(self, name: str):
+        """Минимальное значение колонки."""
+        return self.column(name).min()
+
+    def max(self, name: str):
+        """Максимальное значение колонки."""
+        return self.column(name).max()
+
+    def percentile(self, name: str, q):
+        """Перцентиль (или массив перцентилей) q значений колонки."""
+        return np.percentile(self.column(name), q)
+
+    def argsort(self, name: str) -> np.ndarray:
+        """Стабильный индекс сортировки колонки по возрастанию."""
+        return np.argsort(self.column(name), kind='stable')
+
+    def optimality(
+            self, weights: 'OptimalityWeights' = None) -> np.ndarray:
+        """Оптимальность всех предложений (см. OptimalityWeights).
+
+        Без weights считается по формуле Proposal.calc_optimality.
+        """
+        if not len(self):
+            return np.empty(0, dtype=np.float64)
+
+        if weights is None:
+            k1 = 0.75
+            k2 = 0.25
+            min_prize = self.adult_prize.min()
+            min_duration = self.duration.min()
+            result = (
+                    (k1 * (min_prize / self.adult_prize)) +
+                    (k2 * (min_duration / self.duration))
+            )
+            return result
+
+        prize = (
+            weights.adults * self.adult_prize +
+            weights.children * self.child_prize +
+            weights.infants * self.infant_prize
+        )
+        result = (
+                (weights.price * (prize.min() / prize)) +
+                (weights.duration * (self.duration.min() / self.duration)) +
+                (weights.stops * (self.segments.min() / self.segments))
+        )
+
+        return result
+
+
+def top_k(values: np.ndarray, limit: int = None) -> np.ndarray:
+    """Возвращает позиции limit наименьших значений.
+
+    Порядок совпадает со стабильной сортировкой по возрастанию:
+    при равных значениях первой идет меньшая позиция. Если limit меньше
+    количества значений, вместо полной сортировки делается частичный
+    выбор через np.partition.
+    """
+    if limit is None or limit >= len(values):
+        return np.argsort(values, kind='stable')
+    if limit <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Граничное значение limit-го элемента. Берем все значения не больше
+    # него, чтобы при равенстве выбрать предложения с меньшей позицией.
+    kth = np.partition(values, limit - 1)[limit - 1]
+    positions = np.flatnonzero(values <= kth)
+    order = np.argsort(values[positions], kind='stable')
+
+    return positions[order][:limit]
+
+
+def inverse_permutation(index: np.ndarray) -> np.ndarray:
+    """Обратная перестановка индекса сортировки:
+    result[позиция] = место позиции в index."""
+    result = np.empty_like(index)
+    result[index] = np.arange(len(index))
+
+    return result
@@ -1,9 +1,87 @@
 import os
+import tempfile
 
 ROOT_PATH = os.path.dirname(__file__)
 DATA_PATH = os.path.join(ROOT_PATH, 'data')
 RS_VIA_3_XML = os.path.join(DATA_PATH, 'RS_Via-3.xml')
 RS_VIA_OW_XML = os.path.join(DATA_PATH, 'RS_ViaOW.xml')
+# Шаблон файлов с ответами поставщиков.
+# Ключ источника определяется по имени файла (см. utils.source_key).
+SOURCES_GLOB = os.path.join(DATA_PATH, 'RS_*.xml')
+# Количество процессов для параллельного парсинга файлов.
+LOAD_WORKERS = os.cpu_count() or 1
+# Количество предложений в порции, которую дочерний процесс передает
+# в основной при параллельном парсинге (см. storage.send_xml_file).
+LOAD_CHUNK = 1000
+# Сколько порций одного файла может ждать в очереди, пока основной
+# процесс их не разобрал.
+LOAD_QUEUE_CHUNKS = 4
+# Бинарный снимок загруженного хранилища для быстрого старта.
+SNAPSHOT_PATH = os.path.join(DATA_PATH, 'storage.snapshot')
+# Период проверки изменений файлов в секундах, 0 - не проверять.
+RELOAD_INTERVAL = 10
+# Политика хранения источников (см. Storage._retain), None - без ограничения.
+# Максимальный возраст данных по времени ответа поставщика в секундах.
+RETENTION_MAX_AGE = None
+# Максимальное количество источников.
+RETENTION_MAX_SOURCES = None
+# Бюджет памяти предложений и индексов в байтах.
+RETENTION_MAX_BYTES = None
 
 VIA_3_KEY = 'via_3'
 VIA_OW_KEY = 'via_ow'
+ALL_KEY = 'all'
+
+# Максимальный суммарный размер закэшированных ответов в байтах.
+RESPONSE_CACHE_MAX_BYTES = 64 * 2 ** 20
+# Количество порядков предложений для постраничного вывода,
+# которые хранятся между запросами страниц.
+ORDERINGS_CACHE_SIZE = 64
+# Количество строк сопоставления маршрутов в одной порции потокового ответа.
+JOIN_CHUNK_ROWS = 1000
+# Размер порции потокового ответа со списком предложений в байтах.
+STREAM_CHUNK_BYTES = 64 * 2 ** 10
+# Ответ без limit и cursor, в котором не меньше стольких предложений,
+# отдается потоком, а не собирается в памяти и не кэшируется
+# (если не задан параметр stream). None - только по параметру stream.
+STREAM_MIN_PROPOSALS = 5000
+# Количество ответов поставщиков, принятых через POST /searches/{source},
+# которые одновременно разбираются или ждут публикации в хранилище.
+# Сверх этого запросы отклоняются с кодом 503.
+INGEST_QUEUE_SIZE = 4
+# Через сколько секунд клиенту повторить отклоненный запрос (Retry-After).
+INGEST_RETRY_AFTER = 5
+# Перцентили распределений цен и длительностей в /stats.
+STATS_PERCENTILES = (5, 25, 50, 75, 95)
+# Границы интервалов гистограмм в /stats: цен (в основных единицах
+# валюты) и длительностей перелета (в минутах).
+STATS_PRICE_EDGES = (
+    0, 100, 200, 300, 400, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+STATS_DURATION_EDGES = (
+    0, 60, 120, 180, 240, 360, 480, 720, 960, 1440, 2160, 2880, 4320)
+# Хранить колонки, индексы и JSON-фрагменты в разделяемой памяти
+# только для чтения, общей для воркеров gunicorn (см. shared.py).
+SHARED_MEMORY = True
+# Каталог для регионов разделяемой памяти, None - временный каталог ОС.
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Каталог, через который процессы (воркеры gunicorn) обмениваются
+# метриками, None - отдавать метрики только текущего процесса.
+METRICS_DIR = os.path.join(
+    SHARED_MEMORY_DIR or tempfile.gettempdir(), 'avia-metrics')
+# Период сброса метрик процесса в каталог в секундах.
+METRICS_FLUSH_INTERVAL = 5
+# Отступ в JSON ответах. None - компактный вид без пробелов,
+# 2 - форматированный вид для отладки.
+JSON_INDENT = None
+# Формировать JSON-фрагменты предложений при загрузке, а не на запросах.
+PRERENDER_JSON = True
+# Хранить от предложений только таблицу, индексы и границы их тэгов
+# в исходных xml файлах, а сами предложения разбирать при отдаче
+# (см. lazy.py). Уменьшает память, но JSON не формируется заранее.
+LAZY_PROPOSALS = False
+# Количество разобранных предложений, которые хранятся в кэше
+# каждого ленивого набора.
+LAZY_CACHE_SIZE = 10000
+# Количество предложений, объекты которых одновременно создаются
+# при построении ленивого набора (см. storage.build_lazy_proposals).
+LAZY_BUILD_CHUNK = 10000
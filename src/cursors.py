@@ -0,0 +1,169 @@
+"""Курсоры постраничного вывода предложений.
+
+Курсор - непрозрачная строка, в которой закодированы идентификатор данных,
+отпечаток параметров запроса, ключ сортировки, значение ключа и uuid
+последнего отданного предложения. Следующая страница начинается сразу
+за этим предложением в заранее построенном порядке (Ordering), поэтому
+каждая страница стоит O(размер страницы) независимо от ее номера.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Union
+
+import numpy as np
+
+
+class InvalidCursor(ValueError):
+    """Курсор поврежден или выдан для других параметров запроса."""
+
+
+class StaleCursor(InvalidCursor):
+    """Курсор выдан для данных, которые с тех пор были перезагружены."""
+
+
+def query_digest(*params) -> str:
+    """Отпечаток параметров запроса, от которых зависит порядок."""
+    digest = hashlib.blake2b(repr(params).encode(), digest_size=8)
+
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class Cursor:
+    """Позиция в упорядоченном списке предложений."""
+    # Идентификатор данных (StorageState.generation).
+    generation: str
+    # Отпечаток параметров запроса (см. query_digest).
+    query: str
+    # Ключ сортировки.
+    key: Union[str, None]
+    # Значение ключа сортировки последнего отданного предложения.
+    value: Union[int, float, None]
+    # uuid и позиция последнего отданного предложения.
+    uuid: str
+    position: int
+
+    def encode(self) -> str:
+        data = [
+            self.generation, self.query, self.key, self.value, self.uuid,
+            self.position,
+        ]
+        data = json.dumps(data, separators=(',', ':')).encode()
+
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    @classmethod
+    def decode(cls, token: str) -> 'Cursor':
+        """Разбирает курсор. При ошибке бросает InvalidCursor."""
+        try:
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            result = cls(*json.loads(data.decode()))
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            raise InvalidCursor(token)
+        if not isinstance(result.position, int) or result.position < 0:
+            raise InvalidCursor(token)
+
+        return result
+
+    def check(self, generation: str, query: str,
+              key: Union[str, None]) -> None:
+        """Проверяет, что курсор выдан для этих данных и параметров."""
+        if (self.query, self.key) != (query, key):
+            raise InvalidCursor(self.encode())
+        if self.generation != generation:
+            raise StaleCursor(self.encode())
+
+
+class Ordering:
+    """Полный порядок предложений для постраничного вывода.
+
+    positions - позиции предложений в порядке сортировки,
+    offsets - обратная перестановка: offsets[позиция] = место в positions
+    или -1, если предложение не попало в порядок (отфильтровано).
+    values - значения ключа сортировки по позициям предложений.
+    """
+    def __init__(self, positions: np.ndarray, offsets: np.ndarray,
+                 values: Union[np.ndarray, None] = None) -> None:
+        self.positions = positions
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @classmethod
+    def from_positions(cls, positions: np.ndarray, size: int,
+                       values: Union[np.ndarray, None] = None) -> 'Ordering':
+        """Строит порядок по позициям предложений из size."""
+        offsets = np.full(size, -1, dtype=np.intp)
+        offsets[positions] = np.arange(len(positions))
+
+        return cls(positions=positions, offsets=offsets, values=values)
+
+    def value(self, position: int) -> Union[int, float, None]:
+        """Значение ключа сортировки предложения."""
+        if self.values is None:
+            return None
+
+        return self.values[position].item()
+
+    def offset(self, position: int) -> int:
+        """Место предложения в порядке или -1."""
+        if not 0 <= position < len(self.offsets):
+            return -1
+        return int(self.offsets[position])
+
+    def page(self, after: int = None, limit: int = None) -> np.ndarray:
+        """Позиции предложений страницы, следующей за предложением after."""
+        start = 0
+        if after is not None:
+            start = self.offset(after)
+            if start < 0:
+                raise InvalidCursor(after)
+            start += 1
+        stop = None if limit is None else start + limit
+
+        return self.positions[start:stop]
+
+
+class OrderingCache:
+    """LRU-кэш порядков предложений, ограниченный количеством порядков.
+
+    Как и ResponseCache, привязан к версии хранилища.
+    """
+    def __init__(self, max_items: int) -> None:
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_or_build(self, key: Hashable, version: int,
+                     build: Callable[[], 'Ordering']) -> 'Ordering':
+        """Возвращает порядок по ключу, при отсутствии строит его."""
+        with self._lock:
+            if version != self._version:
+                self._items.clear()
+                self._version = version
+            result = self._items.get(key)
+            if result is not None:
+                self._items.move_to_end(key)
+                return result
+
+        # Порядок строится без блокировки, параллельные запросы
+        # в худшем случае построят его дважды.
+        result = build()
+        with self._lock:
+            if version == self._version:
+                self._items[key] = result
+                while len(self._items) > self.max_items:
+                    self._items.popitem(last=False)
+
+        return result
@@ -0,0 +1,174 @@
+"""Генератор синтетических ответов поставщиков.
+
+Формирует xml AirFareSearchResponse той же структуры, что RS_Via-3.xml
+и RS_ViaOW.xml, с заданным количеством предложений, сегментов и долей
+перелетов с обратным маршрутом. Используется в бенчмарках (bench.py).
+
+Запуск:
+    python datagen.py RS_Synthetic.xml --proposals 100000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, TextIO, Tuple
+
+from utils import DateFormat
+
+# Аэропорты, между которыми строятся маршруты.
+AIRPORTS = (
+    'DXB', 'DEL', 'BKK', 'CAN', 'SIN', 'HKG', 'KUL', 'BOM', 'DOH', 'AUH',
+    'CMB', 'MCT', 'KTM', 'SHJ', 'PEK', 'ICN', 'NRT', 'IST', 'LHR', 'FRA',
+)
+# Перевозчики {id: название}.
+CARRIERS = {
+    'AI': 'AirIndia',
+    'CZ': 'China Southern Airlines',
+    'EK': 'Emirates',
+    'SQ': 'Singapore Airlines',
+    'TG': 'Thai Airways International',
+    'QR': 'Qatar Airways',
+    'MH': 'Malaysia Airlines',
+    '9W': 'Jet Airways',
+}
+TRIP_CLASSES = ('G', 'U', 'Y', 'S', 'Q')
+PRICING_TYPES = ('SingleAdult', 'SingleChild', 'SingleInfant')
+INDENT = '    '
+
+
+def generate(proposals: int = 1000, segments: Tuple[int, int] = (1, 3),
+             return_ratio: float = 0.5, child_ratio: float = 0.5,
+             seed: int = 0) -> Iterator[str]:
+    """Генерирует xml ответа по частям.
+
+    proposals - количество предложений,
+    segments - минимальное и максимальное количество сегментов
+        в каждом направлении,
+    return_ratio - доля предложений с перелетом обратно,
+    child_ratio - доля предложений с ценами для ребенка и младенца,
+    seed - начальное значение генератора случайных чисел: при одинаковых
+        параметрах результат одинаковый.
+    """
+    rnd = random.Random(seed)
+    request_time = datetime(2015, 9, 28, 20, 23, 49)
+    response_time = request_time + timedelta(seconds=7)
+    date_format = DateFormat.DEFAULT.value
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield (
+        f'<AirFareSearchResponse '
+        f'RequestTime="{request_time.strftime(date_format)}" '
+        f'ResponseTime="{response_time.strftime(date_format)}">\n')
+    yield f'{INDENT}<RequestId>123ABCD</RequestId>\n'
+    yield f'{INDENT}<PricedItineraries>\n'
+    for _ in range(proposals):
+        yield _proposal(rnd, segments, return_ratio, child_ratio)
+    yield f'{INDENT}</PricedItineraries>\n'
+    yield '</AirFareSearchResponse>\n'
+
+
+def write(file: TextIO, **params) -> None:
+    """Записывает сгенерированный xml в файл. Параметры - как у generate."""
+    for chunk in generate(**params):
+        file.write(chunk)
+
+
+def _proposal(rnd: random.Random, segments: Tuple[int, int],
+              return_ratio: float, child_ratio: float) -> str:
+    count = rnd.randint(*segments)
+    route = rnd.sample(AIRPORTS, count + 1)
+    departure = datetime(2018, 10, 22) + timedelta(
+        minutes=5 * rnd.randrange(7 * 24 * 12))
+    carrier_id = rnd.choice(tuple(CARRIERS))
+    fare_basis = f'{rnd.getrandbits(128):032x}@@A2_{count}_{rnd.randint(0, 1)}'
+
+    parts = [f'{INDENT * 2}<Flights>\n']
+    onward, arrival = _flights(
+        rnd, route, departure, carrier_id, fare_basis)
+    parts.append(f'{INDENT * 3}<OnwardPricedItinerary>\n')
+    parts.append(onward)
+    parts.append(f'{INDENT * 3}</OnwardPricedItinerary>\n')
+    if rnd.random() < return_ratio:
+        departure = arrival + timedelta(
+            days=rnd.randint(1, 14), minutes=5 * rnd.randrange(12 * 12))
+        returned, _ = _flights(
+            rnd, route[::-1], departure, carrier_id, fare_basis)
+        parts.append(f'{INDENT * 3}<ReturnPricedItinerary>\n')
+        parts.append(returned)
+        parts.append(f'{INDENT * 3}</ReturnPricedItinerary>\n')
+
+    parts.append(f'{INDENT * 3}<Pricing currency="SGD">\n')
+    base_fare = rnd.randint(50, 2000)
+    types = PRICING_TYPES if rnd.random() < child_ratio else PRICING_TYPES[:1]
+    for type_, share in zip(types, (1, 0.75, 0.1)):
+        fare = round(base_fare * share, 2)
+        taxes = round(rnd.uniform(0, 500), 1) if share > 0.5 else 0
+        charges = [('BaseFare', fare), ('TotalAmount', fare + taxes)]
+        if taxes:
+            charges.insert(1, ('AirlineTaxes', taxes))
+        for charge_type, amount in charges:
+            parts.append(
+                f'{INDENT * 4}<ServiceCharges type="{type_}" '
+                f'ChargeType="{charge_type}">{amount:.2f}</ServiceCharges>\n')
+    parts.append(f'{INDENT * 3}</Pricing>\n')
+    parts.append(f'{INDENT * 2}</Flights>\n')
+
+    return ''.join(parts)
+
+
+def _flights(rnd: random.Random, route: Tuple[str, ...], departure: datetime,
+             carrier_id: str, fare_basis: str) -> Tuple[str, datetime]:
+    """Возвращает xml тэга Flights с сегментами маршрута
+    и время прилета в конечный пункт."""
+    timestamp = DateFormat.TIMESTAMP.value
+    trip_class = rnd.choice(TRIP_CLASSES)
+    parts = [f'{INDENT * 4}<Flights>\n']
+    for source, destination in zip(route, route[1:]):
+        arrival = departure + timedelta(minutes=5 * rnd.randint(12, 16 * 12))
+        number_of_stops = 1 if rnd.random() < 0.1 else 0
+        indent = INDENT * 6
+        parts.append(
+            f'{INDENT * 5}<Flight>\n'
+            f'{indent}<Carrier id="{carrier_id}">'
+            f'{CARRIERS[carrier_id]}</Carrier>\n'
+            f'{indent}<FlightNumber>{rnd.randint(1, 9999)}</FlightNumber>\n'
+            f'{indent}<Source>{source}</Source>\n'
+            f'{indent}<Destination>{destination}</Destination>\n'
+            f'{indent}<DepartureTimeStamp>{departure.strftime(timestamp)}'
+            f'</DepartureTimeStamp>\n'
+            f'{indent}<ArrivalTimeStamp>{arrival.strftime(timestamp)}'
+            f'</ArrivalTimeStamp>\n'
+            f'{indent}<Class>{trip_class}</Class>\n'
+            f'{indent}<NumberOfStops>{number_of_stops}</NumberOfStops>\n'
+            f'{indent}<FareBasis>\n'
+            f'{indent}{INDENT}{fare_basis}\n'
+            f'{indent}</FareBasis>\n'
+            f'{indent}<WarningText/>\n'
+            f'{indent}<TicketType>E</TicketType>\n'
+            f'{INDENT * 5}</Flight>\n')
+        departure = arrival + timedelta(minutes=5 * rnd.randint(6, 12 * 12))
+    parts.append(f'{INDENT * 4}</Flights>\n')
+
+    return ''.join(parts), arrival
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Генератор синтетических ответов поставщиков.')
+    parser.add_argument('path', help='путь к xml файлу')
+    parser.add_argument('--proposals', type=int, default=1000)
+    parser.add_argument(
+        '--segments', type=int, nargs=2, default=(1, 3),
+        metavar=('MIN', 'MAX'))
+    parser.add_argument('--return-ratio', type=float, default=0.5)
+    parser.add_argument('--child-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.path, 'w', encoding='utf-8') as f:
+        write(
+            f, proposals=args.proposals, segments=tuple(args.segments),
+            return_ratio=args.return_ratio, child_ratio=args.child_ratio,
+            seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import math
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterable, List, Sequence
+
+import numpy as np
+
+from utils import PRICE_EXPONENT
+
+if TYPE_CHECKING:
+    from columns import ProposalsTable
+    from models import Proposal
+
+# Поля фильтра, которые проверяются по диапазонным индексам:
+# {поле фильтра: (колонка таблицы, граница)}.
+# Цены в фильтре задаются в основных единицах валюты.
+RANGE_FILTERS = {
+    'max_segments': ('segments', 'max'),
+    'max_stops': ('stops', 'max'),
+    'min_adult_prize': ('adult_prize', 'min'),
+    'max_adult_prize': ('adult_prize', 'max'),
+    'departure_from': ('departure', 'min'),
+    'departure_to': ('departure', 'max'),
+    'arrival_from': ('arrival', 'min'),
+    'arrival_to': ('arrival', 'max'),
+}
+# Колонки таблицы с ценами.
+PRIZE_COLUMNS = ('adult_prize', 'child_prize', 'infant_prize')
+
+
+@dataclass(frozen=True)
+class ProposalsFilter:
+    """Параметры фильтрации предложений.
+
+    None - фильтр по полю не задан. Все заданные условия объединяются по И.
+    """
+    # Аэропорт вылета перелета туда.
+    source: str = None
+    # Аэропорт прилета перелета туда.
+    destination: str = None
+    # Аэропорт пересадки перелета туда.
+    via: str = None
+    # Перевозчик любого сегмента.
+    carrier_id: str = None
+    max_segments: int = None
+    max_stops: int = None
+    min_adult_prize: float = None
+    max_adult_prize: float = None
+    # Окна времени вылета и прилета перелета туда (границы включаются).
+    departure_from: datetime = None
+    departure_to: datetime = None
+    arrival_from: datetime = None
+    arrival_to: datetime = None
+    has_return: bool = None
+
+    @property
+    def is_empty(self) -> bool:
+        return all(getattr(self, f.name) is None for f in fields(self))
+
+
+class FilterIndex:
+    """Индексы для фильтрации предложений.
+
+    Инвертированные индексы хранят для каждого значения (аэропорта,
+    перевозчика) отсортированный массив позиций предложений. Диапазонные
+    индексы - это позиции, отсортированные по значению колонки, и сами
+    отсортированные значения, по которым границы ищутся бинарным поиском.
+    """
+    def __init__(self, inverted: Dict[str, Dict], ranges: Dict[str, tuple],
+                 size: int) -> None:
+        self.inverted = inverted
+        self.ranges = ranges
+        self.size = size
+
+    @classmethod
+    def build(cls, proposals: Iterable['Proposal'],
+              table: 'ProposalsTable') -> 'FilterIndex':
+        """Строит индексы за один проход по предложениям."""
+        inverted = {
+            'source': {},
+            'destination': {},
+            'via': {},
+            'carrier_id': {},
+        }
+        for position, proposal in enumerate(proposals):
+            onward = proposal.flights.onward
+            if onward:
+                cls._add(inverted['source'], onward[0].source_code, position)
+                cls._add(
+                    inverted['destination'], onward[-1].destination_code,
+                    position)
+            for flight in onward[:-1]:
+                cls._add(inverted['via'], flight.destination_code, position)
+            for flight in onward + proposal.flights.returned:
+                cls._add(inverted['carrier_id'], flight.carrier_id, position)
+
+        for index in inverted.values():
+            for value, positions in index.items():
+                # Позиции могут повторяться, если значение встречается
+                # в нескольких сегментах одного предложения.
+                index[value] = np.unique(np.array(positions, dtype=np.intp))
+        inverted['has_return'] = cls._has_return(table)
+
+        return cls(
+            inverted=inverted, ranges=cls._ranges(table), size=len(table))
+
+    @classmethod
+    def concat(cls, parts: Sequence['FilterIndex'],
+               table: 'ProposalsTable') -> 'FilterIndex':
+        """Индексы объединения наборов предложений (см. Proposals.concat).
+
+        Инвертированные индексы склеиваются из индексов частей со сдвигом
+        позиций, поэтому по предложениям второй раз не проходим.
+        table - таблица объединенного набора.
+        """
+        if not parts:
+            return cls.build([], table)
+
+        inverted = {}
+        for name in parts[0].inverted:
+            if name == 'has_return':
+                continue
+            collected = {}
+            offset = 0
+            for part in parts:
+                for value, positions in part.inverted[name].items():
+                    collected.setdefault(value, []).append(positions + offset)
+                offset += part.size
+            inverted[name] = {
+                value: np.concatenate(items)
+                for value, items in collected.items()}
+        inverted['has_return'] = cls._has_return(table)
+
+        return cls(
+            inverted=inverted, ranges=cls._ranges(table), size=len(table))
+
+    @staticmethod
+    def _has_return(table: 'ProposalsTable') -> Dict[bool, np.ndarray]:
+        return {
+            value: np.flatnonzero(table.has_return == value)
+            for value in (True, False)
+        }
+
+    @staticmethod
+    def _ranges(table: 'ProposalsTable') -> Dict[str, tuple]:
+        result = {}
+        for column, _ in RANGE_FILTERS.values():
+            if column not in result:
+                order = table.argsort(column)
+                result[column] = (table.column(column)[order], order)
+
+        return result
+
+    def subset(self, keep: np.ndarray) -> 'FilterIndex':
+        """Индексы для набора без предложений, для которых keep ложно.
+
+        Позиции оставшихся предложений сдвигаются, порядок в индексах
+        сохраняется, поэтому пересортировка не нужна.
+        """
+        new_positions = np.cumsum(keep) - 1
+        inverted = {}
+        for name, index in self.inverted.items():
+            inverted[name] = {}
+            for value, positions in index.items():
+                positions = new_positions[positions[keep[positions]]]
+                if len(positions) or name == 'has_return':
+                    inverted[name][value] = positions
+        ranges = {}
+        for column, (values, order) in self.ranges.items():
+            selected = keep[order]
+            ranges[column] = (values[selected], new_positions[order[selected]])
+
+        return FilterIndex(
+            inverted=inverted, ranges=ranges, size=int(keep.sum()))
+
+    def positions(self, flt: 'ProposalsFilter') -> np.ndarray:
+        """Возвращает отсортированные позиции предложений под фильтр."""
+        candidates = []
+        for name, index in self.inverted.items():
+            value = getattr(flt, name)
+            if value is not None:
+                candidates.append(
+                    index.get(value, np.empty(0, dtype=np.intp)))
+
+        bounds = {}
+        for name, (column, bound) in RANGE_FILTERS.items():
+            value = getattr(flt, name)
+            if value is not None:
+                bounds.setdefault(column, {})[f'{bound}_value'] = value
+        for column, bound in bounds.items():
+            candidates.append(self._range(column, **bound))
+
+        if not candidates:
+            return np.arange(self.size)
+
+        # Пересекаем начиная с самых маленьких наборов.
+        candidates.sort(key=len)
+        result = candidates[0]
+        for positions in candidates[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, positions, assume_unique=True)
+
+        return result
+
+    def _range(self, column: str, min_value=None,
+               max_value=None) -> np.ndarray:
+        """Позиции предложений со значением колонки
+        в [min_value, max_value]."""
+        values, order = self.ranges[column]
+        if column in PRIZE_COLUMNS:
+            # Цены в таблице - целые с PRICE_EXPONENT знаками после
+            # запятой, границы переводятся в них с округлением внутрь.
+            scale = 10 ** PRICE_EXPONENT
+            if min_value is not None:
+                min_value = math.ceil(round(min_value * scale, 6))
+            if max_value is not None:
+                max_value = math.floor(round(max_value * scale, 6))
+        elif values.dtype.kind == 'M':
+            if min_value is not None:
+                min_value = np.datetime64(min_value, 'm')
+            if max_value is not None:
+                max_value = np.datetime64(max_value, 'm')
+        lo = 0
+        hi = len(values)
+        if min_value is not None:
+            lo = np.searchsorted(values, min_value, 'left')
+        if max_value is not None:
+            hi = np.searchsorted(values, max_value, 'right')
+
+        return np.sort(order[lo:hi])
+
+    @staticmethod
+    def _add(index: Dict[str, List[int]], value: str, position: int) -> None:
+        index.setdefault(value, []).append(position)
+
+
+def order_subset(positions: np.ndarray, rank: np.ndarray,
+                 limit: int = None) -> np.ndarray:
+    """Упорядочивает подмножество позиций по готовому индексу.
+
+    rank - обратная перестановка индекса (rank[позиция] = место в индексе),
+    поэтому сортируется только подмножество, а не все предложения.
+    """
+    order = np.argsort(rank[positions], kind='stable')
+
+    return positions[order][:limit]
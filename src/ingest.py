@@ -0,0 +1,113 @@
+"""Прием ответов поставщиков через POST /searches/{source}.
+
+Тело запроса проверяется потоковым разбором прямо из входного потока
+WSGI, одновременно копируясь во временный файл. Разобранные предложения
+в запросе не хранятся, только считаются. Временный файл передается
+в очередь фонового потока, который создает по нему Proposals
+с индексами и публикует их в хранилище (Storage.ingest). Запрос
+не ждет публикации. Количество принятых, но еще не опубликованных
+ответов ограничено, сверх него запросы отклоняются.
+"""
+import logging
+import os
+import queue
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, BinaryIO
+
+from config import INGEST_QUEUE_SIZE
+from metrics import INGEST_REQUESTS
+
+if TYPE_CHECKING:
+    from storage import Storage
+
+logger = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class IngestJob:
+    """Проверенный ответ поставщика, ожидающий публикации."""
+    # Ключ источника.
+    source: str
+    # Временный файл с исходным xml.
+    file_path: str
+    # Количество предложений в ответе.
+    proposals: int
+
+
+class TeeReader:
+    """Поток для чтения, который копирует прочитанные данные в файл."""
+    def __init__(self, stream: BinaryIO, file: BinaryIO) -> None:
+        self.stream = stream
+        self.file = file
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.file.write(data)
+
+        return data
+
+    def drain(self, chunk_size: int = 2 ** 16) -> None:
+        """Дочитывает поток до конца."""
+        while self.read(chunk_size):
+            pass
+
+
+class IngestQueue:
+    """Ограниченная очередь публикации ответов поставщиков.
+
+    Место в очереди занимается до разбора тела запроса (reserve)
+    и освобождается после публикации, поэтому переполнение
+    обнаруживается до того, как тело прочитано. Как и проверка файлов
+    хранилища, поток публикации запускается при первом обращении
+    в каждом процессе.
+    """
+    def __init__(self, storage: 'Storage',
+                 max_size: int = INGEST_QUEUE_SIZE) -> None:
+        self.storage = storage
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._queue = queue.Queue()
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def reserve(self) -> bool:
+        """Занимает место в очереди. Возвращает False, если мест нет."""
+        return self._slots.acquire(blocking=False)
+
+    def release(self) -> None:
+        """Освобождает место, занятое reserve, если задание
+        не было отправлено в очередь."""
+        self._slots.release()
+
+    def submit(self, job: 'IngestJob') -> None:
+        """Отправляет задание в очередь. Место должно быть занято."""
+        self._start_worker()
+        self._queue.put(job)
+
+    def join(self) -> None:
+        """Ждет публикации всех заданий очереди."""
+        self._queue.join()
+
+    def _start_worker(self) -> None:
+        with self._worker_lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            thread = threading.Thread(
+                target=self._work, name='ingest-worker', daemon=True)
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                self.storage.ingest(job.source, job.file_path)
+                INGEST_REQUESTS.inc(result='published')
+            except Exception:
+                INGEST_REQUESTS.inc(result='failed')
+                # Файл удаляет Storage.ingest.
+                logger.exception(
+                    f'Не удалось опубликовать данные источника {job.source}.')
+            finally:
+                self._slots.release()
+                self._queue.task_done()
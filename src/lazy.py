@@ -0,0 +1,251 @@
+"""Ленивые наборы предложений (LAZY_PROPOSALS).
+
+При загрузке по предложениям источника строятся таблица и индексы,
+после чего от каждого предложения остаются только uuid и границы его
+тэга Flights в исходном xml файле. Файл отображается в память (mmap),
+а предложение и его JSON-фрагмент разбираются заново только для строк,
+которые действительно отдаются, и держатся в LRU-кэше.
+
+Файлы источников в этом режиме нужно заменять атомарно (os.replace),
+а не перезаписывать на месте: отображение старого файла остается
+у состояния, которое его использует.
+"""
+import mmap
+import re
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING, Callable, Iterator, List, Sequence, Tuple, Union)
+
+import numpy as np
+
+from config import LAZY_CACHE_SIZE
+from schemas import dump_proposal_json
+
+if TYPE_CHECKING:
+    from models import Proposal
+
+# Открывающий, закрывающий или пустой тэг Flights.
+FLIGHTS_TAG = re.compile(rb'<(/?)Flights\b[^>]*?(/?)>')
+
+
+class SourceFile:
+    """Исходный xml файл источника, отображенный в память для чтения.
+
+    Отображение создается сразу, поэтому не зависит от того, какой файл
+    окажется по пути path позже. В снимок хранилища попадает только путь.
+    """
+    def __init__(self, path: str, source: str) -> None:
+        self.path = path
+        self.source = source
+        self.buffer = self._map()
+
+    def __getstate__(self) -> dict:
+        return {'path': self.path, 'source': self.source}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.buffer = self._map()
+
+    def move(self, path: str) -> None:
+        """Файл перенесен на путь path (os.replace). Отображение
+        остается прежним, в снимок попадает новый путь."""
+        self.path = path
+
+    def _map(self) -> mmap.mmap:
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def spans(self) -> np.ndarray:
+        """Границы [начало, конец) тэгов Flights с предложениями
+        в порядке файла, массив (количество предложений, 2).
+
+        Предложения - тэги Flights верхнего уровня вложенности
+        (см. Parser._iter_proposals), вложенные в них тэги Flights
+        с сегментами пропускаются.
+        """
+        result = []
+        depth = 0
+        start = None
+        for match in FLIGHTS_TAG.finditer(self.buffer):
+            closing, empty = match.groups()
+            if empty:
+                continue
+            if closing:
+                depth -= 1
+                if not depth:
+                    result.append((start, match.end()))
+            else:
+                if not depth:
+                    start = match.start()
+                depth += 1
+
+        return np.array(result, dtype=np.int64).reshape(-1, 2)
+
+    def element(self, start: int, stop: int) -> bytes:
+        """Байты тэга по границам из spans."""
+        return self.buffer[start:stop]
+
+
+class LazyProposals(Sequence):
+    """Последовательность предложений, которые разбираются из исходных
+    файлов при обращении.
+
+    files - файлы источников, file_codes - номер файла каждой строки,
+    spans - границы тэгов Flights, uuids - uuid предложений (по 16 байт),
+    decode(element, source, uuid) - функция, создающая Proposal из байтов
+    тэга Flights. Она сохраняется в снимок по имени, поэтому должна быть
+    функцией модуля.
+    """
+    def __init__(self, files: Tuple['SourceFile', ...],
+                 file_codes: np.ndarray, spans: np.ndarray,
+                 uuids: np.ndarray,
+                 decode: Callable[[bytes, str, uuid.UUID], 'Proposal'],
+                 cache_size: int = LAZY_CACHE_SIZE) -> None:
+        self.files = files
+        self.file_codes = file_codes
+        self.spans = spans
+        self.uuids = uuids
+        self.decode = decode
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, file: 'SourceFile', uuids: Sequence[uuid.UUID],
+                  decode: Callable,
+                  spans: np.ndarray = None) -> 'LazyProposals':
+        """Создает набор по предложениям файла в порядке их разбора.
+
+        spans - границы тэгов этих предложений, по умолчанию все тэги
+        файла (см. SourceFile.spans).
+        """
+        if spans is None:
+            spans = file.spans()
+        if len(spans) != len(uuids):
+            raise ValueError(
+                f'Файл {file.path}: найдено {len(spans)} тэгов Flights '
+                f'вместо {len(uuids)}.')
+
+        return cls(
+            files=(file,),
+            file_codes=np.zeros(len(spans), dtype=np.int32),
+            spans=spans,
+            uuids=np.frombuffer(
+                b''.join(item.bytes for item in uuids),
+                dtype=np.uint8).reshape(-1, 16),
+            decode=decode)
+
+    @classmethod
+    def concat(cls, parts: Sequence['LazyProposals']) -> 'LazyProposals':
+        """Склеивает наборы, файлы частей используются совместно."""
+        files = {}
+        file_codes = []
+        for part in parts:
+            mapping = np.array(
+                [files.setdefault(id(file), (len(files), file))[0]
+                 for file in part.files], dtype=np.int32)
+            file_codes.append(mapping[part.file_codes])
+
+        return cls(
+            files=tuple(file for _, file in files.values()),
+            file_codes=np.concatenate(
+                file_codes or [np.empty(0, dtype=np.int32)]),
+            spans=np.concatenate(
+                [part.spans for part in parts] or
+                [np.empty((0, 2), dtype=np.int64)]),
+            uuids=np.concatenate(
+                [part.uuids for part in parts] or
+                [np.empty((0, 16), dtype=np.uint8)]),
+            decode=parts[0].decode if parts else None)
+
+    def take(self, positions: np.ndarray) -> 'LazyProposals':
+        """Набор из строк с позициями positions (см. Proposals.subset).
+        Файлы, на которые больше не ссылается ни одна строка, отпускаются.
+        """
+        file_codes = self.file_codes[positions]
+        used = np.unique(file_codes)
+        mapping = np.zeros(len(self.files), dtype=np.int32)
+        mapping[used] = np.arange(len(used))
+
+        return LazyProposals(
+            files=tuple(self.files[i] for i in used.tolist()),
+            file_codes=mapping[file_codes],
+            spans=self.spans[positions],
+            uuids=self.uuids[positions],
+            decode=self.decode,
+            cache_size=self.cache_size)
+
+    def __getstate__(self) -> dict:
+        # Кэш разобранных предложений в снимок не попадает.
+        state = dict(self.__dict__)
+        del state['_cache']
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+    def __getitem__(self, index: Union[int, slice]
+                    ) -> Union['Proposal', List['Proposal']]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return self._entry(index)[0]
+
+    def __iter__(self) -> Iterator['Proposal']:
+        for position in range(len(self)):
+            yield self[position]
+
+    @property
+    def nbytes(self) -> int:
+        """Память, занятая строками набора, без кэша в байтах."""
+        return (
+            sys.getsizeof(self) + self.file_codes.nbytes + self.spans.nbytes +
+            self.uuids.nbytes)
+
+    def fragment(self, position: int) -> bytes:
+        """JSON-фрагмент предложения, кэшируется вместе с ним."""
+        entry = self._entry(position)
+        if entry[1] is None:
+            entry[1] = dump_proposal_json(entry[0])
+
+        return entry[1]
+
+    def _entry(self, position: int) -> list:
+        """Возвращает [предложение, JSON-фрагмент или None] из кэша,
+        при отсутствии разбирает предложение."""
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+
+        with self._lock:
+            entry = self._cache.get(position)
+            if entry is not None:
+                self._cache.move_to_end(position)
+                return entry
+
+        # Предложение разбирается без блокировки, параллельные запросы
+        # в худшем случае разберут его дважды.
+        file = self.files[self.file_codes[position]]
+        start, stop = self.spans[position].tolist()
+        entry = [
+            self.decode(
+                file.element(start, stop), file.source,
+                uuid.UUID(bytes=self.uuids[position].tobytes())),
+            None]
+        with self._lock:
+            self._cache[position] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return entry
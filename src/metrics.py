@@ -0,0 +1,460 @@
+"""Метрики приложения в формате Prometheus.
+
+Каждый процесс копит метрики в памяти (Registry) и периодически сбрасывает
+их в свой файл в каталоге METRICS_DIR. Эндпоинт /metrics суммирует файлы
+всех процессов, поэтому под gunicorn с несколькими воркерами отдаются
+общие значения независимо от того, какой воркер принял запрос.
+Значения Gauge не суммируются: они относятся к своему процессу и отдаются
+с меткой pid. Чтобы счетчики не уменьшались, значения завершившихся
+воркеров переносятся в общий файл AGGREGATE_FILE, а их файлы удаляются,
+поэтому pid, доставшийся новому процессу, не затирает чужие значения.
+Значения Gauge завершившихся воркеров не сохраняются.
+"""
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Файл со значениями завершившихся процессов.
+AGGREGATE_FILE = 'aggregate.json'
+# Границы корзин гистограмм длительностей в секундах.
+DURATION_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0,
+)
+# Границы корзин гистограмм размеров ответов в байтах.
+SIZE_BUCKETS = tuple(2 ** i for i in range(8, 28, 2))
+# Границы корзин гистограмм количества предложений в ответе.
+COUNT_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+logger = logging.getLogger()
+
+
+class Metric:
+    """Базовый класс метрики с метками."""
+    type_name = ''
+    # Учитывать только значения работающих процессов.
+    live_only = False
+
+    def __init__(self, registry: 'Registry', name: str, documentation: str,
+                 labels: Tuple[str, ...] = ()) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        registry.register(self)
+
+    def new_value(self) -> List[float]:
+        raise NotImplementedError
+
+    def merge(self, value: List[float], other: List[float]) -> None:
+        """Прибавляет значение другого процесса."""
+        for i, item in enumerate(other):
+            value[i] += item
+
+    def samples(self, label_values: Tuple[str, ...],
+                value: List[float]) -> Iterator[Tuple[str, str, float]]:
+        """Генерирует строки экспозиции: (суффикс имени, метки, значение)."""
+        raise NotImplementedError
+
+    def _values(self, label_values: dict) -> List[float]:
+        # Значения меток - строки, они приводятся к str вызывающим кодом.
+        key = tuple([label_values[name] for name in self.labels])
+
+        return self.registry.value(self, key)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик."""
+    type_name = 'counter'
+
+    def new_value(self) -> List[float]:
+        return [0.0]
+
+    def inc(self, amount: float = 1, **label_values) -> None:
+        with self.registry.lock:
+            self._values(label_values)[0] += amount
+
+    def samples(self, label_values, value):
+        yield '_total', format_labels(self.labels, label_values), value[0]
+
+
+class Gauge(Metric):
+    """Текущее значение процесса.
+
+    Значения разных процессов не складываются, а отдаются с меткой pid
+    (см. Registry.collect).
+    """
+    type_name = 'gauge'
+    live_only = True
+
+    def new_value(self) -> List[float]:
+        return [0.0]
+
+    def set(self, value: float, **label_values) -> None:
+        with self.registry.lock:
+            self._values(label_values)[0] = float(value)
+
+    def samples(self, label_values, value):
+        labels = format_labels(self.labels + ('pid',), label_values)
+        yield '', labels, value[0]
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными корзинами.
+
+    Значение хранится списком: количества по корзинам (без накопления),
+    затем сумма наблюдений.
+    """
+    type_name = 'histogram'
+
+    def __init__(self, registry: 'Registry', name: str, documentation: str,
+                 labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.buckets = tuple(buckets) + (float('inf'),)
+        super().__init__(registry, name, documentation, labels)
+
+    def new_value(self) -> List[float]:
+        return [0.0] * (len(self.buckets) + 1)
+
+    def observe(self, amount: float, **label_values) -> None:
+        index = bisect_left(self.buckets, amount)
+        with self.registry.lock:
+            value = self._values(label_values)
+            value[index] += 1
+            value[-1] += amount
+
+    @contextmanager
+    def time(self, **label_values) -> Iterator[None]:
+        """Замеряет длительность блока with."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **label_values)
+
+    def samples(self, label_values, value):
+        total = 0
+        for bound, count in zip(self.buckets, value):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            labels = format_labels(
+                self.labels + ('le',), label_values + (le,))
+            yield '_bucket', labels, total
+        labels = format_labels(self.labels, label_values)
+        yield '_sum', labels, value[-1]
+        yield '_count', labels, total
+
+
+class Registry:
+    """Метрики процесса.
+
+    После форка значения, унаследованные от родителя, сбрасываются:
+    родитель сохраняет их в свой файл сам (см. flush).
+    """
+    def __init__(self, directory: str = METRICS_DIR,
+                 flush_interval: float = METRICS_FLUSH_INTERVAL) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self._values = {}
+        self._pid = os.getpid()
+        self._flusher_pid = None
+        # Процесс, который уже сбрасывал значения в свой файл.
+        self._flushed_pid = None
+
+    def register(self, metric: 'Metric') -> None:
+        self.metrics[metric.name] = metric
+
+    def value(self, metric: 'Metric', key: Tuple[str, ...]) -> List[float]:
+        """Возвращает изменяемое значение метрики по меткам.
+
+        Вызывается под self.lock.
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        values = self._values.setdefault(metric.name, {})
+        result = values.get(key)
+        if result is None:
+            result = values[key] = metric.new_value()
+
+        return result
+
+    def snapshot(self) -> Dict[str, list]:
+        """Значения метрик процесса в виде, пригодном для JSON."""
+        with self.lock:
+            if self._pid != os.getpid():
+                self._after_fork()
+            return {
+                name: [[list(key), list(value)]
+                       for key, value in values.items()]
+                for name, values in self._values.items()}
+
+    def flush(self) -> None:
+        """Сохраняет значения процесса в его файл в каталоге метрик."""
+        if not self.directory:
+            return
+
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        # Сбрасывать может и фоновый поток, и запрос к /metrics.
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Файл с pid процесса до первого сброса остался
+            # от завершившегося процесса с тем же pid.
+            if self._flushed_pid != os.getpid():
+                self._flushed_pid = os.getpid()
+                if os.path.exists(path):
+                    self._fold([path])
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Не удалось сохранить метрики {path}: {e}')
+
+    def clear_directory(self) -> None:
+        """Удаляет файлы метрик предыдущих запусков."""
+        if not self.directory:
+            return
+
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def collect(self) -> Dict[str, Dict[tuple, List[float]]]:
+        """Суммирует значения всех процессов.
+
+        Свои значения процесс сначала сбрасывает в файл, значения
+        остальных процессов берутся из их последних файлов, файлы
+        завершившихся процессов переносятся в общий (см. fold_dead).
+        К ключам Gauge добавляется pid процесса.
+        """
+        self.start_flusher()
+        self.flush()
+        self.fold_dead()
+        result = {}
+        if not self.directory:
+            self._merge(result, self.snapshot(), str(os.getpid()))
+            return result
+
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            snapshot = read_snapshot(path)
+            if snapshot is None:
+                continue
+            # У общего файла и файла только что завершившегося
+            # процесса значения Gauge не учитываются.
+            pid = None
+            if is_alive(path):
+                pid = os.path.splitext(os.path.basename(path))[0]
+            self._merge(result, snapshot, pid)
+
+        return result
+
+    def fold_dead(self) -> None:
+        """Переносит значения завершившихся процессов в общий файл
+        AGGREGATE_FILE и удаляет их файлы."""
+        if not self.directory:
+            return
+
+        paths = [
+            path for path in glob.glob(os.path.join(self.directory, '*.json'))
+            if os.path.basename(path) != AGGREGATE_FILE and
+            not is_alive(path)]
+        if paths:
+            self._fold(paths)
+
+    def _fold(self, paths: List[str]) -> None:
+        """Добавляет значения файлов paths в общий файл и удаляет их.
+
+        Процессы переносят файлы по одному под блокировкой, поэтому
+        значения не учитываются дважды.
+        """
+        aggregate_path = os.path.join(self.directory, AGGREGATE_FILE)
+        tmp_path = f'{aggregate_path}.{os.getpid()}.tmp'
+        try:
+            with open(os.path.join(self.directory, 'aggregate.lock'),
+                      'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                result = {}
+                self._merge(result, read_snapshot(aggregate_path) or {})
+                # Файл мог уже перенести другой процесс.
+                paths = [path for path in paths if os.path.exists(path)]
+                for path in paths:
+                    self._merge(result, read_snapshot(path) or {})
+                with open(tmp_path, 'w') as f:
+                    json.dump({
+                        name: [[list(key), value]
+                               for key, value in values.items()]
+                        for name, values in result.items()}, f)
+                os.replace(tmp_path, aggregate_path)
+                for path in paths:
+                    os.remove(path)
+        except OSError as e:
+            logger.warning(f'Не удалось перенести метрики {paths}: {e}')
+
+    def _merge(self, result: Dict[str, Dict[tuple, List[float]]],
+               snapshot: Dict[str, list], pid: str = None) -> None:
+        """Добавляет значения процесса к result.
+
+        pid - процесс, значения Gauge которого учитываются, None -
+        без значений Gauge.
+        """
+        for name, items in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.live_only and pid is None):
+                continue
+            values = result.setdefault(name, {})
+            for key, value in items:
+                key = tuple(key)
+                if metric.live_only:
+                    key += (pid,)
+                if key in values:
+                    metric.merge(values[key], value)
+                else:
+                    values[key] = list(value)
+
+    def expose(self) -> str:
+        """Возвращает метрики всех процессов в текстовом формате
+        Prometheus."""
+        collected = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type_name}')
+            for key, value in sorted(collected.get(name, {}).items()):
+                for suffix, labels, sample in metric.samples(key, value):
+                    lines.append(f'{name}{suffix}{labels} {sample!r}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start_flusher(self) -> None:
+        """Запускает фоновый сброс метрик в текущем процессе.
+
+        Как и проверка файлов хранилища, поток запускается при первом
+        обращении в каждом процессе, а не в мастере gunicorn.
+        """
+        if (not self.directory or not self.flush_interval or
+                self._flusher_pid == os.getpid()):
+            return
+
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        thread = threading.Thread(
+            target=self._flush_loop, name='metrics-flusher', daemon=True)
+        thread.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _after_fork(self) -> None:
+        self._values = {}
+        self._pid = os.getpid()
+
+
+def read_snapshot(path: str) -> Union[Dict[str, list], None]:
+    """Значения метрик из файла процесса или None, если файл
+    не удалось прочитать."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_alive(path: str) -> bool:
+    """Работает ли процесс, которому принадлежит файл метрик."""
+    try:
+        pid = int(os.path.splitext(os.path.basename(path))[0])
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ','.join(
+        f'{name}="{escape_label(value)}"'
+        for name, value in zip(names, values))
+
+    return f'{{{labels}}}' if labels else ''
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class MetricsMiddleware:
+    """Middleware falcon, замеряющее длительность и размер ответов."""
+    def __init__(self, registry: 'Registry' = None) -> None:
+        self.registry = registry or REGISTRY
+
+    def process_request(self, req, resp) -> None:
+        req.context['metrics_start'] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded) -> None:
+        start = req.context.get('metrics_start')
+        if start is None:
+            return
+
+        self.registry.start_flusher()
+        # Метка - шаблон маршрута из атрибута route ресурса, а не путь
+        # запроса, иначе каждый путь с параметром (/searches/{source})
+        # и каждый ненайденный путь добавляли бы новый ряд.
+        route = getattr(resource, 'route', 'unmatched')
+        status = resp.status.split(' ', 1)[0]
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - start, route=route, method=req.method,
+            status=status)
+        body = resp.data if resp.data is not None else resp.body
+        if body is not None:
+            RESPONSE_BYTES.observe(len(body), route=route)
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram(
+    REGISTRY, 'avia_request_duration_seconds',
+    'Длительность обработки запроса.', ('route', 'method', 'status'))
+STAGE_SECONDS = Histogram(
+    REGISTRY, 'avia_stage_duration_seconds',
+    'Длительность этапов формирования ответа.', ('route', 'stage'))
+RESPONSE_BYTES = Histogram(
+    REGISTRY, 'avia_response_size_bytes', 'Размер тела ответа.', ('route',),
+    buckets=SIZE_BUCKETS)
+RESULT_COUNT = Histogram(
+    REGISTRY, 'avia_result_count',
+    'Количество предложений в сформированном ответе.', ('route',),
+    buckets=COUNT_BUCKETS)
+RESPONSE_CACHE = Counter(
+    REGISTRY, 'avia_response_cache',
+    'Обращения к кэшу готовых ответов.', ('route', 'result'))
+INGEST_REQUESTS = Counter(
+    REGISTRY, 'avia_ingest_requests',
+    'Ответы поставщиков, присланные через POST /searches.', ('result',))
+STORAGE_MEMORY_BYTES = Gauge(
+    REGISTRY, 'avia_storage_memory_bytes',
+    'Оценка памяти, занятой предложениями в хранилище.')
+STORAGE_EVICTIONS = Counter(
+    REGISTRY, 'avia_storage_evictions',
+    'Источники, вытесненные из хранилища политикой хранения.', ('reason',))
+STORAGE_LOAD_SECONDS = Histogram(
+    REGISTRY, 'avia_storage_load_duration_seconds',
+    'Длительность загрузки данных в хранилище.', ('source',))
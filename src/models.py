@@ -1,12 +1,90 @@
-from dataclasses import dataclass
+import heapq
+import json
+import sys
+from dataclasses import dataclass, replace
 from datetime import datetime
-from decimal import Decimal
 from enum import Enum
 from operator import attrgetter
-from typing import List, Union
+from typing import (
+    TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple,
+    Union)
 
+import numpy as np
 from cached_property import cached_property
 
+from columns import (
+    COLUMNS, ProposalsTable, inverse_permutation, top_k)
+from config import STREAM_CHUNK_BYTES
+from cursors import Ordering
+from filters import FilterIndex, order_subset
+from lazy import LazyProposals
+from routes import RouteIndex
+from schemas import dump_proposal_json
+from shared import SharedFragments, share_arrays
+from stats import ProposalsStats
+from utils import PRICE_EXPONENT, currency_exponent, minor2decimal, scale_minor
+
+if TYPE_CHECKING:
+    from filters import ProposalsFilter
+
+# Ключи, по которым индексы сортировки строятся заранее.
+ORDER_KEYS = (
+    'adult_prize',
+    'child_prize',
+    'infant_prize',
+    'duration',
+    'optimality',
+)
+# Индексы сортировки, которые переносятся в разделяемую память.
+SORT_INDEXES = ('indexes', 'ranks', 'reverse_indexes', 'reverse_ranks')
+# Ключи, по которым сравниваются лучшие предложения источников.
+COMPARE_KEYS = (
+    'adult_prize',
+    'child_prize',
+    'infant_prize',
+    'duration',
+)
+# Статусы строк сопоставления предложений (см. join_proposals).
+JOIN_MATCHED = 'matched'
+JOIN_ADDED = 'added'
+JOIN_REMOVED = 'removed'
+# Во сколько раз лимит должен быть меньше количества предложений,
+# чтобы вместо полной сортировки выбирать top-k через кучу.
+TOP_K_RATIO = 10
+
+
+@dataclass(frozen=True)
+class OptimalityWeights:
+    """Параметры расчета оптимальности.
+
+    Формула:
+        opt = (price * min_prize / prize) +
+              (duration * min_duration / duration) +
+              (stops * min_segments / segments)
+    где prize - стоимость перелета для заданного состава пассажиров:
+        prize = adults * adult_prize + children * child_prize +
+                infants * infant_prize
+
+    Значения по умолчанию соответствуют Proposal.calc_optimality.
+    """
+    # Вес цены.
+    price: float = 0.75
+    # Вес длительности перелета.
+    duration: float = 0.25
+    # Вес количества пересадок.
+    stops: float = 0.0
+    # Состав пассажиров.
+    adults: int = 1
+    children: int = 0
+    infants: int = 0
+
+    @property
+    def is_default(self) -> bool:
+        return self == DEFAULT_OPTIMALITY_WEIGHTS
+
+
+DEFAULT_OPTIMALITY_WEIGHTS = OptimalityWeights()
+
 
 class PricingTypeEnum(Enum):
     """Типы ценообразования."""
@@ -21,57 +99,606 @@ class PricingTypeEnum(Enum):
 @dataclass(frozen=True)
 class Proposals:
     """Класс для хранения предложений по перелетам."""
-    proposals: List['Proposal']
+    # Список предложений или ленивый набор (см. lazy.py).
+    proposals: Union[List['Proposal'], 'LazyProposals']
+    # Время ответа поставщика (ResponseTime), по нему определяется
+    # возраст данных в политике хранения (см. Storage._retain).
+    response_time: datetime = None
+
+    @classmethod
+    def concat(cls, parts: Iterable['Proposals'],
+               response_time: datetime = None) -> 'Proposals':
+        """Объединяет несколько наборов предложений в один.
+
+        Уже сформированные JSON-фрагменты частей переиспользуются,
+        таблица, индексы фильтрации и маршрутов и статистика собираются
+        из построенных для частей без прохода по предложениям.
+        Ленивые наборы (см. lazy.py) склеиваются без разбора предложений.
+        """
+        parts = list(parts)
+        if parts and all(
+                isinstance(part.proposals, LazyProposals) for part in parts):
+            proposals = LazyProposals.concat(
+                [part.proposals for part in parts])
+        else:
+            proposals = [p for part in parts for p in part.proposals]
+        result = cls(proposals=proposals, response_time=response_time)
+        result.__dict__['fragments'] = [
+            fragment for part in parts for fragment in part.fragments]
+        result.__dict__['table'] = ProposalsTable.concat(
+            [part.table for part in parts])
+        result.__dict__['filter_index'] = FilterIndex.concat(
+            [part.filter_index for part in parts], result.table)
+        result.__dict__['route_index'] = RouteIndex.concat(
+            [part.route_index for part in parts])
+        result.__dict__['stats'] = ProposalsStats.merge(
+            (part.stats for part in parts), result)
+
+        return result
+
+    def __getstate__(self) -> dict:
+        # Массивы из разделяемой памяти сохраняются как обычные копии
+        # или ссылками на файл региона снимка (см. shared.RegionWriter),
+        # после загрузки это проверяет share.
+        state = dict(self.__dict__)
+        state.pop('shared', None)
+
+        return state
 
     @cached_property
-    def min_prize(self) -> 'Decimal':
-        """Минимальная цена для взрослого из всех предложений."""
-        return min(map(attrgetter('adult_prize'), self.proposals))
+    def table(self) -> 'ProposalsTable':
+        """Колоночное представление предложений для агрегатов."""
+        return ProposalsTable.from_proposals(self.proposals)
+
+    @cached_property
+    def min_prize(self) -> int:
+        """Минимальная цена для взрослого из всех предложений
+        (см. Proposal.adult_prize)."""
+        position = self.table.argmin('adult_prize')
+
+        return self.proposals[position].adult_prize
 
     @cached_property
     def min_duration(self) -> int:
         """Минимальная длительность перелета из всех предложений."""
-        return min(map(attrgetter('duration'), self.proposals))
+        return int(self.table.duration.min())
+
+    @cached_property
+    def indexes(self) -> Dict[str, 'np.ndarray']:
+        """Индексы сортировки по ключам ORDER_KEYS.
+
+        Каждый индекс - массив позиций предложений в порядке сортировки
+        по умолчанию: по возрастанию, а для оптимальности - от лучших
+        к худшим.
+        """
+        result = {}
+        for key in ORDER_KEYS:
+            if key == 'optimality':
+                values = -self.table.optimality()
+                result[key] = np.argsort(values, kind='stable')
+            else:
+                result[key] = self.table.argsort(key)
+
+        return result
+
+    @cached_property
+    def reverse_indexes(self) -> Dict[str, 'np.ndarray']:
+        """Индексы сортировки по ключам ORDER_KEYS в обратном порядке
+        (reverse).
+
+        Как и у sorted(..., reverse=True), равные значения идут в порядке
+        загрузки, поэтому это не перевернутые indexes.
+        """
+        result = {}
+        for key in ORDER_KEYS:
+            if key == 'optimality':
+                values = self.table.optimality()
+            else:
+                values = -self.table.column(key)
+            result[key] = np.argsort(values, kind='stable')
+
+        return result
+
+    @cached_property
+    def ranks(self) -> Dict[str, 'np.ndarray']:
+        """Обратные перестановки индексов сортировки:
+        ranks[key][позиция] = место предложения в indexes[key]."""
+        return {
+            key: inverse_permutation(index)
+            for key, index in self.indexes.items()}
+
+    @cached_property
+    def reverse_ranks(self) -> Dict[str, 'np.ndarray']:
+        """Обратные перестановки индексов reverse_indexes."""
+        return {
+            key: inverse_permutation(index)
+            for key, index in self.reverse_indexes.items()}
+
+    @cached_property
+    def best_positions(self) -> Dict[str, Tuple[int, int]]:
+        """Позиции лучших предложений по ключам COMPARE_KEYS:
+        {ключ: (первое при сортировке по возрастанию, по убыванию)}.
+
+        Как и у стабильной сортировки, из равных значений выбирается
+        первое по порядку загрузки (см. ProposalsTable.argmin и argmax).
+        """
+        if not self.proposals:
+            return {}
+
+        table = self.table
+
+        return {
+            key: (table.argmin(key), table.argmax(key))
+            for key in COMPARE_KEYS}
+
+    @cached_property
+    def itinerary_index(self) -> Dict[tuple, List[int]]:
+        """Хэш-индекс {ключ маршрута: позиции предложений} для join_proposals.
+
+        Строится при первом сопоставлении, а не при загрузке.
+        """
+        result = {}
+        for position, proposal in enumerate(self.proposals):
+            result.setdefault(proposal.itinerary_key, []).append(position)
+
+        return result
+
+    def best(self, key: str, reverse=False) -> Union['Proposal', None]:
+        """Возвращает лучшее предложение по ключу из COMPARE_KEYS
+        или None, если предложений нет."""
+        positions = self.best_positions.get(key)
+        if positions is None:
+            return None
+
+        return self.proposals[positions[reverse]]
+
+    @cached_property
+    def filter_index(self) -> 'FilterIndex':
+        """Индексы для фильтрации предложений."""
+        return FilterIndex.build(self.proposals, self.table)
+
+    @cached_property
+    def stats(self) -> 'ProposalsStats':
+        """Аналитика для эндпоинта /stats."""
+        return ProposalsStats.build(self)
+
+    @cached_property
+    def route_index(self) -> 'RouteIndex':
+        """Граф соединений аэропортов для эндпоинта /routes."""
+        return RouteIndex.build(self.proposals)
+
+    @cached_property
+    def data_bytes(self) -> int:
+        """Оценка памяти предложений и их JSON-фрагментов в байтах.
+
+        Интернированные сегменты и ценообразования общие для многих
+        предложений и не учитываются. У ленивого набора учитываются
+        только ссылки на тэги в файлах, без кэша разобранных предложений.
+        """
+        if isinstance(self.proposals, LazyProposals):
+            return self.proposals.nbytes
+
+        result = sys.getsizeof(self.proposals)
+        for proposal in self.proposals:
+            flights = proposal.flights
+            result += (
+                sys.getsizeof(proposal) + sys.getsizeof(proposal.uuid) +
+                sys.getsizeof(proposal.uuid.int) + sys.getsizeof(flights) +
+                sys.getsizeof(flights.onward) +
+                sys.getsizeof(flights.returned) +
+                sys.getsizeof(proposal.pricing))
+        fragments = self.__dict__.get('fragments') or ()
+        if isinstance(fragments, SharedFragments):
+            result += fragments.nbytes
+        else:
+            result += sum(len(f) for f in fragments if f is not None)
+
+        return result
+
+    @property
+    def index_bytes(self) -> int:
+        """Память колоночной таблицы и индексов в байтах."""
+        arrays = [self.table.column(name) for name in COLUMNS]
+        for name in SORT_INDEXES:
+            arrays.extend(getattr(self, name).values())
+        for index in self.filter_index.inverted.values():
+            arrays.extend(index.values())
+        for values, order in self.filter_index.ranges.values():
+            arrays.extend((values, order))
+
+        return sum(a.nbytes for a in arrays) + self.route_index.nbytes
+
+    def subset(self, keep: 'np.ndarray',
+               parts: Iterable['Proposals'] = None) -> 'Proposals':
+        """Возвращает набор без предложений, для которых keep ложно.
+
+        Таблица, фрагменты, индексы сортировки, фильтрации и маршрутов
+        переносятся из текущего набора за линейное время: из них убираются
+        позиции удаленных предложений, а порядок остальных сохраняется.
+        Индекс оптимальности пересчитывается, только если изменились
+        минимальные цена или длительность, от которых он зависит.
+        parts - оставшиеся наборы, из которых состоит текущий (см. concat),
+        из их статистики собирается статистика результата.
+        """
+        keep = np.asarray(keep, dtype=np.bool_)
+        positions = np.flatnonzero(keep)
+        new_positions = np.cumsum(keep) - 1
+        if isinstance(self.proposals, LazyProposals):
+            proposals = self.proposals.take(positions)
+        else:
+            proposals = [self.proposals[i] for i in positions]
+        result = Proposals(
+            proposals=proposals, response_time=self.response_time)
+        fragments = self.fragments
+        result.__dict__['fragments'] = [fragments[i] for i in positions]
+
+        table = self.table
+        result.__dict__['table'] = replace(table, **{
+            name: table.column(name)[positions] for name in COLUMNS})
+        indexes = {}
+        reverse_indexes = {}
+        for key in ORDER_KEYS:
+            index = self.indexes[key]
+            indexes[key] = new_positions[index[keep[index]]]
+            index = self.reverse_indexes[key]
+            reverse_indexes[key] = new_positions[index[keep[index]]]
+        new_table = result.table
+        if len(new_table) and (
+                new_table.min('adult_prize') != table.min('adult_prize') or
+                new_table.min('duration') != table.min('duration')):
+            optimality = new_table.optimality()
+            indexes['optimality'] = np.argsort(-optimality, kind='stable')
+            reverse_indexes['optimality'] = np.argsort(
+                optimality, kind='stable')
+        result.__dict__['indexes'] = indexes
+        result.__dict__['reverse_indexes'] = reverse_indexes
+        result.__dict__['filter_index'] = self.filter_index.subset(keep)
+        result.__dict__['route_index'] = self.route_index.subset(keep)
+        if parts is not None:
+            result.__dict__['stats'] = ProposalsStats.merge(
+                (part.stats for part in parts), result)
+
+        return result
+
+    def build_indexes(self) -> None:
+        """Строит колоночную таблицу, индексы сортировки, фильтрации
+        и маршрутов, таблицу лучших предложений и статистику заранее,
+        чтобы не делать этого при первом запросе."""
+        self.table
+        self.indexes
+        self.ranks
+        self.reverse_indexes
+        self.reverse_ranks
+        self.best_positions
+        self.filter_index
+        self.stats
+        self.route_index
+
+    def share(self, fragments: 'SharedFragments' = None) -> None:
+        """Переносит колоночную таблицу, индексы и JSON-фрагменты
+        в разделяемую память только для чтения (см. shared.py).
+
+        fragments - готовые фрагменты в разделяемой памяти, например
+        срез фрагментов общего набора предложений. Иначе в разделяемую
+        память переносятся собственные фрагменты, если они сформированы
+        для всех предложений. Повторный вызов не переносит данные заново,
+        как и вызов для массивов, которые уже отображены из файла региона
+        снимка.
+        """
+        self.build_indexes()
+        if not self.__dict__.get('shared'):
+            table = self.table
+            filter_index = self.filter_index
+            arrays = {}
+            for name in COLUMNS:
+                arrays['table', name] = table.column(name)
+            for name in SORT_INDEXES:
+                for key in ORDER_KEYS:
+                    arrays[name, key] = getattr(self, name)[key]
+            for name, index in filter_index.inverted.items():
+                for value, positions in index.items():
+                    arrays['inverted', name, value] = positions
+            for column, (values, order) in filter_index.ranges.items():
+                arrays['range_values', column] = values
+                arrays['range_order', column] = order
+            if any(a.flags.writeable for a in arrays.values()):
+                views = share_arrays(arrays)
+            else:
+                views = arrays
+
+            self.__dict__['table'] = replace(table, **{
+                name: views['table', name] for name in COLUMNS})
+            for name in SORT_INDEXES:
+                self.__dict__[name] = {
+                    key: views[name, key] for key in ORDER_KEYS}
+            self.__dict__['filter_index'] = FilterIndex(
+                inverted={
+                    name: {
+                        value: views['inverted', name, value]
+                        for value in index}
+                    for name, index in filter_index.inverted.items()},
+                ranges={
+                    column: (
+                        views['range_values', column],
+                        views['range_order', column])
+                    for column in filter_index.ranges},
+                size=filter_index.size)
+            self.__dict__['shared'] = True
+
+        if fragments is not None:
+            self.__dict__['fragments'] = fragments
+            return
+        current = self.__dict__.get('fragments')
+        if (current is not None and
+                not isinstance(current, SharedFragments) and
+                None not in current):
+            self.__dict__['fragments'] = SharedFragments.from_fragments(
+                current)
+
+    def order_by(self, key: Union[str, Callable], reverse=False,
+                 limit: int = None, weights: 'OptimalityWeights' = None,
+                 flt: 'ProposalsFilter' = None) -> List['Proposal']:
+        """Возвращает отсортированный по ключу список предложений.
+
+        Параметры те же, что у order_positions.
+        """
+        positions = self.order_positions(
+            key, reverse=reverse, limit=limit, weights=weights, flt=flt)
+
+        return [self.proposals[i] for i in positions]
+
+    def order_positions(self, key: Union[str, Callable, None] = None,
+                        reverse=False, limit: int = None,
+                        weights: 'OptimalityWeights' = None,
+                        flt: 'ProposalsFilter' = None) -> Sequence[int]:
+        """Возвращает позиции предложений, отсортированных по ключу.
+
+        key - имя ключа из ORDER_KEYS, функция или None (без сортировки).
+        Для ключей из ORDER_KEYS используется готовый индекс, при reverse
+        - обратный (см. reverse_indexes). Для произвольной функции
+        при небольшом limit выбираются top-k предложений через кучу,
+        иначе делается полная сортировка.
+        weights - параметры оптимальности для ключа 'optimality',
+        если они отличаются от стандартных, рейтинг считается на лету.
+        flt - фильтр предложений. Подходящие позиции берутся из индексов
+        фильтрации, и сортируются только они.
+        """
+        custom_weights = (
+            key == 'optimality' and weights and not weights.is_default)
+        if flt is not None and not flt.is_empty:
+            positions = self.filter_index.positions(flt)
+            if custom_weights:
+                scores = self.table.optimality(weights)[positions]
+                order = top_k(scores if reverse else -scores, limit)
+                return positions[order]
+            if isinstance(key, str):
+                ranks = self.reverse_ranks if reverse else self.ranks
+                return order_subset(positions, ranks[key], limit=limit)
+            if key is None:
+                return positions[:limit]
+            subset = Proposals([self.proposals[i] for i in positions])
+            order = subset.order_positions(key, reverse=reverse, limit=limit)
+            return positions[list(order)]
+
+        if custom_weights:
+            return self.rank_positions(weights, reverse=reverse, limit=limit)
+
+        if key is None:
+            return range(len(self.proposals))[:limit]
+
+        if isinstance(key, str):
+            indexes = self.reverse_indexes if reverse else self.indexes
+            return indexes[key][:limit]
+
+        positions = range(len(self.proposals))
+        position_key = lambda i: key(self.proposals[i])  # noqa: E731
+        if limit is not None and limit * TOP_K_RATIO < len(self.proposals):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            return select(limit, positions, key=position_key)
+
+        return sorted(positions, key=position_key, reverse=reverse)[:limit]
+
+    def ordering(self, key: Union[str, None] = None, reverse=False,
+                 weights: 'OptimalityWeights' = None,
+                 flt: 'ProposalsFilter' = None) -> 'Ordering':
+        """Возвращает полный порядок предложений для постраничного вывода.
+
+        Параметры те же, что у order_positions, key - имя ключа
+        из ORDER_KEYS или None. Без фильтра и нестандартных весов порядок
+        собирается из готовых индексов без копирования, иначе позиции
+        сортируются один раз и дальше страницы берутся из порядка.
+        """
+        custom_weights = (
+            key == 'optimality' and weights and not weights.is_default)
+        values = self.sort_values(key, weights)
+        if (flt is None or flt.is_empty) and not custom_weights:
+            if key is None:
+                positions = np.arange(len(self.proposals))
+                return Ordering(positions, positions, values=values)
+            if reverse:
+                return Ordering(
+                    self.reverse_indexes[key], self.reverse_ranks[key],
+                    values=values)
+            return Ordering(self.indexes[key], self.ranks[key], values=values)
+
+        positions = self.order_positions(
+            key, reverse=reverse, weights=weights, flt=flt)
+        positions = np.asarray(positions, dtype=np.intp)
+
+        return Ordering.from_positions(
+            positions, len(self.proposals), values=values)
+
+    def sort_values(self, key: Union[str, None] = None,
+                    weights: 'OptimalityWeights' = None
+                    ) -> Union['np.ndarray', None]:
+        """Значения ключа сортировки по позициям предложений для курсоров
+        (см. Ordering.values), None - без сортировки."""
+        if key is None:
+            return None
+        if key == 'optimality':
+            if weights and not weights.is_default:
+                return self.table.optimality(weights)
+            return self.table.optimality()
+
+        return self.table.column(key)
+
+    def rank(self, weights: 'OptimalityWeights', reverse=False,
+             limit: int = None) -> List['Proposal']:
+        """Возвращает предложения от лучших к худшим по оптимальности
+        с заданными параметрами.
+
+        Параметры те же, что у rank_positions.
+        """
+        positions = self.rank_positions(weights, reverse=reverse, limit=limit)
+
+        return [self.proposals[i] for i in positions]
+
+    def rank_positions(self, weights: 'OptimalityWeights', reverse=False,
+                       limit: int = None) -> 'np.ndarray':
+        """Возвращает позиции предложений от лучших к худшим
+        по оптимальности с заданными параметрами.
+
+        Оптимальность считается одной векторной операцией по всем
+        предложениям, затем выбираются только limit лучших.
+        При reverse порядок обратный - от худших к лучшим.
+        """
+        scores = self.table.optimality(weights)
+
+        return top_k(scores if reverse else -scores, limit)
 
-    def order_by(self, key, reverse=False) -> List['Proposal']:
-        """Возвращает отсортированный по ключу список предложений."""
-        return sorted(self.proposals, key=key, reverse=reverse)
+    @cached_property
+    def fragments(self) -> List[Union[bytes, None]]:
+        """JSON-фрагменты предложений в компактном виде.
+
+        Заполняются лениво при первом обращении к предложению
+        (см. fragment) или сразу все в render_fragments.
+        """
+        return [None] * len(self.proposals)
+
+    def fragment(self, position: int) -> bytes:
+        """Возвращает JSON-фрагмент предложения по позиции.
+
+        Фрагменты ленивого набора не сохраняются в fragments,
+        а кэшируются вместе с разобранными предложениями.
+        """
+        if isinstance(self.proposals, LazyProposals):
+            return self.proposals.fragment(position)
+
+        result = self.fragments[position]
+        if result is None:
+            result = dump_proposal_json(self.proposals[position])
+            self.fragments[position] = result
+
+        return result
+
+    def render_fragments(self) -> None:
+        """Формирует JSON-фрагменты всех предложений заранее."""
+        for position in range(len(self.proposals)):
+            self.fragment(position)
+
+    def to_json(self, positions: Iterable[int],
+                next_link: str = None) -> bytes:
+        """Собирает JSON-ответ {"proposals": [...]} из фрагментов.
+
+        next_link - ссылка на следующую страницу, добавляется ключом "next".
+        Результат побайтово совпадает с jsonify в компактном режиме.
+        """
+        body = b','.join(map(self.fragment, positions))
+        result = b'{"proposals":[' + body + b']}'
+        if next_link is not None:
+            result = b'{"next":' + json.dumps(next_link).encode() + b',' + \
+                result[1:]
+
+        return result
+
+    def iter_json(self, positions: Iterable[int], next_link: str = None,
+                  chunk_bytes: int = STREAM_CHUNK_BYTES) -> Iterator[bytes]:
+        """Генерирует тот же JSON-ответ, что to_json, порциями
+        примерно по chunk_bytes байт.
+
+        Фрагменты склеиваются в порцию, только когда она набрана,
+        поэтому в памяти одновременно находится не больше одной порции.
+        """
+        head = b'{"proposals":['
+        if next_link is not None:
+            head = b'{"next":' + json.dumps(next_link).encode() + b',' + \
+                head[1:]
+        chunk = [head]
+        size = len(head)
+        separator = b''
+        for position in positions:
+            fragment = self.fragment(position)
+            chunk.append(separator)
+            chunk.append(fragment)
+            size += len(separator) + len(fragment)
+            separator = b','
+            if size >= chunk_bytes:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(b']}')
+
+        yield b''.join(chunk)
+
+
+class Slotted:
+    """Базовый класс неизменяемых dataclass со __slots__.
+
+    У таких классов нет __dict__, поэтому экземпляры занимают меньше
+    памяти. Frozen dataclass запрещает setattr, которым pickle
+    восстанавливает слоты, поэтому состояние сохраняется кортежем.
+    """
+    __slots__ = ()
+
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state: tuple) -> None:
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
 
 
 @dataclass(frozen=True)
-class Proposal:
+class Proposal(Slotted):
     """Класс предложения по перелету."""
+    __slots__ = ('uuid', 'flights', 'pricing', 'source')
     uuid: str
     flights: 'Flights'
-    pricing: List['Pricing']
+    pricing: Tuple['Pricing', ...]
+    # Ключ источника, из которого загружено предложение.
+    source: str
 
-    @cached_property
-    def adult_prize(self) -> 'Decimal':
-        """Итоговая стоимость для одного взрослого."""
+    @property
+    def adult_prize(self) -> int:
+        """Итоговая стоимость для одного взрослого.
+
+        Стоимости предложений - целые числа с PRICE_EXPONENT знаками
+        после запятой, поэтому сортируются и сравниваются без Decimal.
+        """
         pricing = self._get_pricing_by_type(PricingTypeEnum.SINGLE_ADULT)
-        result = pricing.total_amount if pricing else Decimal()
+        result = pricing.total_prize if pricing else 0
 
         return result
 
-    @cached_property
-    def child_prize(self) -> 'Decimal':
+    @property
+    def child_prize(self) -> int:
         """Итоговая стоимость для одного ребенка."""
         pricing = self._get_pricing_by_type(PricingTypeEnum.SINGLE_CHILD)
         # Если такого типа нет, возвращаем стоимость как за взрослого.
-        result = pricing.total_amount if pricing else self.adult_prize
+        result = pricing.total_prize if pricing else self.adult_prize
 
         return result
 
-    @cached_property
-    def infant_prize(self) -> 'Decimal':
+    @property
+    def infant_prize(self) -> int:
         """Итоговая стоимость для одного младенца."""
         pricing = self._get_pricing_by_type(PricingTypeEnum.SINGLE_INFANT)
         # Если такого типа нет, возвращаем стоимость как за взрослого.
-        result = pricing.total_amount if pricing else self.adult_prize
+        result = pricing.total_prize if pricing else self.adult_prize
 
         return result
 
-    @cached_property
+    @property
     def duration(self) -> int:
         """Продолжительность полета в минутах."""
         result = None
@@ -86,7 +713,7 @@ class Proposal:
 
         return result
 
-    @cached_property
+    @property
     def segments_airports(self) -> List[str]:
         """Маршрут из аэропортов"""
         result = []
@@ -97,7 +724,16 @@ class Proposal:
 
         return result
 
-    def calc_optimality(self, min_prize: 'Decimal', min_duration: int) -> float:
+    @property
+    def itinerary_key(self) -> tuple:
+        """Ключ маршрута для сопоставления предложений разных источников:
+        ключи сегментов перелета туда и обратно (см. Flight.segment_key)."""
+        return (
+            tuple(f.segment_key for f in self.flights.onward),
+            tuple(f.segment_key for f in self.flights.returned),
+        )
+
+    def calc_optimality(self, min_prize: int, min_duration: int) -> float:
         """Рассчитывает оптимальность перелета.
         Чем больше значение, тем оно оптимальнее.
 
@@ -121,7 +757,7 @@ class Proposal:
         k1 = 0.75
         k2 = 0.25
         result = (
-                (k1 * float(min_prize / self.adult_prize)) +
+                (k1 * min_prize / self.adult_prize) +
                 (k2 * min_duration / self.duration)
         )
 
@@ -142,41 +778,74 @@ class Proposal:
 
 
 @dataclass(frozen=True)
-class Pricing:
-    """Класс ценообразования."""
+class Pricing(Slotted):
+    """Класс ценообразования.
+
+    Суммы хранятся целыми числами в минимальных единицах валюты
+    (Пр.: центах), в Decimal они переводятся только при выводе.
+    """
+    __slots__ = (
+        'type', 'currency', 'base_fare', 'taxes', 'total_amount',
+        'total_prize')
     type: 'PricingTypeEnum'
-    base_fare: 'Decimal' = 0
-    taxes: 'Decimal' = 0
-    total_amount: 'Decimal' = 0
+    # Код валюты (ISO 4217) из атрибута currency тэга Pricing.
+    currency: str
+    base_fare: int
+    taxes: int
+    total_amount: int
+
+    def __post_init__(self) -> None:
+        # Итоговая сумма с PRICE_EXPONENT знаками после запятой (слот
+        # без поля dataclass). Считается при создании, чтобы сортировка
+        # по цене не переводила суммы на каждом сравнении.
+        object.__setattr__(
+            self, 'total_prize',
+            scale_minor(self.total_amount, self.exponent))
 
     @property
     def type_name(self) -> str:
         return self.type.name.lower()
 
+    @property
+    def exponent(self) -> int:
+        """Количество знаков после запятой в минимальной единице валюты."""
+        return currency_exponent(self.currency)
+
 
 @dataclass(frozen=True)
-class Carrier:
+class Carrier(Slotted):
     """Класс с данными о перевозчике."""
+    __slots__ = ('carrier_id', 'name')
     carrier_id: str
     name: str
 
 
 @dataclass(frozen=True)
-class Airport:
+class Airport(Slotted):
     """Класс с данными о аэропорте."""
+    __slots__ = ('code',)
     code: str
 
 
 @dataclass(frozen=True)
-class Flights:
+class Flights(Slotted):
     """Класс с данными о перелетах."""
-    onward: List['Flight']
-    returned: List['Flight']
+    __slots__ = ('onward', 'returned')
+    onward: Tuple['Flight', ...]
+    returned: Tuple['Flight', ...]
 
 
 @dataclass(frozen=True)
-class Flight:
-    """Класс с данными о сегменте перелета."""
+class Flight(Slotted):
+    """Класс с данными о сегменте перелета.
+
+    Одинаковые сегменты разных предложений - это один и тот же объект
+    (см. Storage._create_flights).
+    """
+    __slots__ = (
+        'carrier', 'number', 'source', 'destination', 'departure_timestamp',
+        'arrival_timestamp', 'trip_class', 'number_of_stops', 'fare_basis',
+        'warning_text', 'ticket_type')
     carrier: 'Carrier'
     number: int
     source: 'Airport'
@@ -205,18 +874,63 @@ class Flight:
     def destination_code(self) -> str:
         return self.destination.code if self.destination else ''
 
+    @property
+    def segment_key(self) -> tuple:
+        """Идентичность сегмента: перевозчик, номер рейса, маршрут
+        и время вылета. Класс, тариф и прочие атрибуты не учитываются."""
+        return (
+            self.carrier_id, self.number, self.source_code,
+            self.destination_code, self.departure_timestamp)
+
 
 def compare_proposals(first_p, second_p: 'Proposal') -> dict:
     """Сравнивает два предложения между собой.
     Возвращает словарь с отличиями.
     """
+    # Разница цен считается целыми числами, в Decimal переводится
+    # только результат.
     result = {
-        'adult_prize_diff': second_p.adult_prize - first_p.adult_prize,
-        'child_prize_diff': second_p.child_prize - first_p.child_prize,
-        'infant_prize_diff': second_p.infant_prize - first_p.infant_prize,
+        'adult_prize_diff': minor2decimal(
+            second_p.adult_prize - first_p.adult_prize, PRICE_EXPONENT),
+        'child_prize_diff': minor2decimal(
+            second_p.child_prize - first_p.child_prize, PRICE_EXPONENT),
+        'infant_prize_diff': minor2decimal(
+            second_p.infant_prize - first_p.infant_prize, PRICE_EXPONENT),
         'duration_diff': second_p.duration - first_p.duration,
         'first_segments_airports': first_p.segments_airports,
         'second_segments_airports': second_p.segments_airports,
     }
 
     return result
+
+
+def join_proposals(
+        first, second: 'Proposals'
+) -> Iterator[Tuple[str, Union[int, None], Union[int, None]]]:
+    """Сопоставляет предложения двух источников по маршрутам.
+
+    Хэш-соединение: индекс строится по first (Proposals.itinerary_index),
+    предложения second проверяются по нему за один проход, так что время
+    линейно от количества предложений. Генерирует кортежи
+    (статус, позиция в first, позиция в second), где статус:
+        JOIN_MATCHED - маршрут есть в обоих источниках,
+        JOIN_ADDED - маршрут есть только во втором источнике,
+        JOIN_REMOVED - маршрут есть только в первом источнике.
+    Одинаковые маршруты одного источника сопоставляются по порядку:
+    первый с первым, второй со вторым и т.д.
+    """
+    index = first.itinerary_index
+    matched = {}
+    for position, proposal in enumerate(second.proposals):
+        key = proposal.itinerary_key
+        positions = index.get(key, ())
+        count = matched.get(key, 0)
+        if count < len(positions):
+            matched[key] = count + 1
+            yield JOIN_MATCHED, positions[count], position
+        else:
+            yield JOIN_ADDED, None, position
+
+    for key, positions in index.items():
+        for position in positions[matched.get(key, 0):]:
+            yield JOIN_REMOVED, position, None
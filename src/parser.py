@@ -1,8 +1,12 @@
+import io
 import xml.etree.ElementTree as ET
-from decimal import Decimal
-from typing import List
+from typing import BinaryIO, Callable, Iterator, List, Union
 
-from utils import DateFormat, str2date, str2int
+from utils import (
+    DateFormat, currency_exponent, str2date, str2int, str2minor, str2timestamp)
+
+# Максимальный размер одной таблицы мемоизации при разборе.
+MEMO_MAX_SIZE = 10000
 
 
 class Parser:
@@ -20,37 +24,131 @@ class Parser:
             'proposals': список предложений по перелетам
         }
         """
-        root = ET.fromstring(content)
+        data = cls.parse_stream(io.BytesIO(content.encode('utf-8')))
+        data['proposals'] = list(data['proposals'])
+
+        return data
+
+    @classmethod
+    def parse_stream(cls, source: Union[str, BinaryIO]) -> dict:
+        """Потоково парсит xml из файла или байтового потока.
+
+        Возвращает словарь того же вида, что и parse, но вместо списка
+        предложений в ключе 'proposals' лежит генератор. Каждый тэг Flights
+        с предложением удаляется из дерева сразу после разбора, поэтому
+        потребление памяти не зависит от размера файла.
+        """
+        events = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(events)
         request_time = root.attrib.get('RequestTime')
         response_time = root.attrib.get('ResponseTime')
-        request_node = root.find('RequestId')
         date_format = DateFormat.DEFAULT.value
+        # Стек открытых тэгов, первым в нем всегда лежит корень.
+        stack = [root]
+        request_id = ''
+
+        # Читаем заголовок ответа до начала первого предложения.
+        for event, node in events:
+            if event == 'start':
+                stack.append(node)
+                # Тэги третьего уровня - это уже содержимое предложений.
+                if len(stack) > 2:
+                    break
+            else:
+                stack.pop()
+                if node.tag == 'RequestId':
+                    request_id = (node.text or '').strip()
 
         data = {
-            'request_id': request_node.text if request_node else '',
+            'request_id': request_id,
             'request_time': str2date(request_time, date_format=date_format),
             'response_time': str2date(response_time, date_format=date_format),
-            'proposals': [],
+            'proposals': cls._iter_proposals(events, stack, cls.new_memo()),
         }
 
-        for proposal_node in root.findall('*/Flights'):
-            onward_node = proposal_node.find('OnwardPricedItinerary')
-            return_node = proposal_node.find('ReturnPricedItinerary')
-            pricing_node = proposal_node.find('Pricing')
+        return data
 
-            data['proposals'].append({
-                'onward': cls._parse_flights(onward_node),
-                'returned': (
-                    cls._parse_flights(return_node) if return_node else []),
-                'pricing': cls._parse_pricing(pricing_node),
-            })
+    @classmethod
+    def parse_proposal(cls, element: bytes, memo: dict = None) -> dict:
+        """Парсит отдельный тэг Flights с предложением (см. lazy.py).
 
-        return data
+        Возвращает словарь того же вида, что и предложения parse_stream.
+        memo - таблицы мемоизации, общие для нескольких тэгов
+        (см. new_memo), по умолчанию создаются заново.
+        """
+        if memo is None:
+            memo = cls.new_memo()
+
+        return cls._parse_proposal(ET.fromstring(element), memo)
+
+    @staticmethod
+    def new_memo() -> dict:
+        """Создает таблицы мемоизации для одного разбора.
+
+        В 'timestamps' хранятся разобранные даты, в 'fare_basis' - очищенные
+        от пробелов коды FareBasis, в 'strings' - прочие повторяющиеся строки
+        (id перевозчиков, коды аэропортов и т.п.).
+        """
+        return {'timestamps': {}, 'fare_basis': {}, 'strings': {}}
 
     @classmethod
-    def _parse_flights(cls, node: ET.Element) -> List[dict]:
+    def _iter_proposals(cls, events: Iterator, stack: list,
+                        memo: dict) -> Iterator[dict]:
+        """Генерирует словари предложений по событиям iterparse.
+
+        Предложением считается тэг Flights второго уровня вложенности
+        (аналог root.findall('*/Flights')).
+        """
+        for event, node in events:
+            if event == 'start':
+                stack.append(node)
+                continue
+
+            stack.pop()
+            if len(stack) == 2 and node.tag == 'Flights':
+                yield cls._parse_proposal(node, memo)
+                # Разобранный тэг больше не нужен, удаляем его из дерева.
+                stack[-1].remove(node)
+                # Ограничиваем размер таблиц мемоизации, чтобы память
+                # не росла вместе с размером файла.
+                for table in memo.values():
+                    if len(table) > MEMO_MAX_SIZE:
+                        table.clear()
+
+    @classmethod
+    def _parse_proposal(cls, node: ET.Element, memo: dict) -> dict:
+        """Парсит содержимое тэга Flights с предложением.
+
+        Возвращает словарь вида:
+        {
+            'onward': список сегментов перелета туда,
+            'returned': список сегментов перелета обратно,
+            'pricing': ценообразование,
+        }
+        """
+        onward_node = node.find('OnwardPricedItinerary')
+        return_node = node.find('ReturnPricedItinerary')
+        pricing_node = node.find('Pricing')
+        # Без перелета туда или цены предложение не построить.
+        for tag, child in (('OnwardPricedItinerary', onward_node),
+                           ('Pricing', pricing_node)):
+            if child is None:
+                raise ValueError(f'В предложении нет тэга {tag}.')
+
+        return {
+            'onward': cls._parse_flights(onward_node, memo),
+            'returned': (
+                cls._parse_flights(return_node, memo)
+                if return_node else []),
+            'pricing': cls._parse_pricing(pricing_node),
+        }
+
+    @classmethod
+    def _parse_flights(cls, node: ET.Element, memo: dict) -> List[dict]:
         """Парсит содержимое тэга Flights.
 
+        memo - таблицы мемоизации разобранных значений (см. new_memo).
+
         Возвращает список словарей вида:
         [
             {
@@ -70,45 +168,84 @@ class Parser:
             ...
         ]
         """
+        timestamps = memo['timestamps']
+        fare_basis_table = memo['fare_basis']
+        strings = memo['strings']
+
         flights = []
         for flight in node.iter('Flight'):
-            carrier_node = flight.find('Carrier')
-            flight_number_node = flight.find('FlightNumber')
-            source_node = flight.find('Source')
-            destination_node = flight.find('Destination')
-            departure_ts_node = flight.find('DepartureTimeStamp')
-            arrival_ts_node = flight.find('ArrivalTimeStamp')
-            class_node = flight.find('Class')
-            number_of_stops_node = flight.find('NumberOfStops')
-            fare_basis_node = flight.find('FareBasis')
-            warning_text_node = flight.find('WarningText')
-            ticket_type_node = flight.find('TicketType')
-
+            carrier_id = carrier = flight_number = None
+            source = destination = departure_ts = arrival_ts = None
+            trip_class = number_of_stops = fare_basis = None
+            warning_text = ticket_type = None
             # В xml файлах встречаются опечатки в тегах.
-            if departure_ts_node is None:
-                departure_ts_node = flight.find('DeartureTimeStamp')
+            typo_departure_ts = None
+
+            # Обходим дочерние тэги один раз и разбираем их по имени.
+            for child in flight:
+                tag = child.tag
+                text = child.text
+                if tag == 'Carrier':
+                    carrier_id = cls._memo(strings, child.attrib.get('id'))
+                    carrier = cls._memo(strings, text)
+                elif tag == 'FlightNumber':
+                    flight_number = str2int(text)
+                elif tag == 'Source':
+                    source = cls._memo(strings, text)
+                elif tag == 'Destination':
+                    destination = cls._memo(strings, text)
+                elif tag == 'DepartureTimeStamp':
+                    departure_ts = cls._memo(timestamps, text, str2timestamp)
+                elif tag == 'DeartureTimeStamp':
+                    typo_departure_ts = cls._memo(
+                        timestamps, text, str2timestamp)
+                elif tag == 'ArrivalTimeStamp':
+                    arrival_ts = cls._memo(timestamps, text, str2timestamp)
+                elif tag == 'Class':
+                    trip_class = cls._memo(strings, text)
+                elif tag == 'NumberOfStops':
+                    number_of_stops = str2int(text)
+                elif tag == 'FareBasis':
+                    fare_basis = cls._memo(fare_basis_table, text, str.strip)
+                elif tag == 'WarningText':
+                    warning_text = text
+                elif tag == 'TicketType':
+                    ticket_type = cls._memo(strings, text)
+
+            if departure_ts is None:
+                departure_ts = typo_departure_ts
 
             flights.append({
-                'carrier_id': carrier_node.attrib.get('id'),
-                'carrier': carrier_node.text,
-                'flight_number': str2int(flight_number_node.text),
-                'source': source_node.text,
-                'destination': destination_node.text,
-                'departure_timestamp': str2date(
-                    departure_ts_node.text,
-                    date_format=DateFormat.TIMESTAMP.value),
-                'arrival_timestamp': str2date(
-                    arrival_ts_node.text,
-                    date_format=DateFormat.TIMESTAMP.value),
-                'trip_class': class_node.text,
-                'number_of_stops': str2int(number_of_stops_node.text),
-                'fare_basis': fare_basis_node.text.strip(),
-                'warning_text': warning_text_node.text,
-                'ticket_type': ticket_type_node.text,
+                'carrier_id': carrier_id,
+                'carrier': carrier,
+                'flight_number': flight_number,
+                'source': source,
+                'destination': destination,
+                'departure_timestamp': departure_ts,
+                'arrival_timestamp': arrival_ts,
+                'trip_class': trip_class,
+                'number_of_stops': number_of_stops,
+                'fare_basis': fare_basis,
+                'warning_text': warning_text,
+                'ticket_type': ticket_type,
             })
 
         return flights
 
+    @staticmethod
+    def _memo(table: dict, text: str, decode: Callable = None):
+        """Возвращает разобранное значение text из таблицы мемоизации.
+
+        При первом обращении значение разбирается функцией decode
+        (или берется как есть) и запоминается, поэтому одинаковые строки
+        и даты во всех сегментах разделяют один объект.
+        """
+        try:
+            return table[text]
+        except KeyError:
+            value = table[text] = decode(text) if decode else text
+            return value
+
     @classmethod
     def _parse_pricing(cls, node: ET.Element) -> dict:
         """Парсит содержимое тэга Pricing.
@@ -120,7 +257,7 @@ class Parser:
                 {
                     'type': тип ценообразования,
                     'charge_type': тип сумм,
-                    'sum': сумма,
+                    'sum': сумма в минимальных единицах валюты,
                 },
                 ...
             ]
@@ -130,12 +267,22 @@ class Parser:
             'currency': node.attrib.get('currency'),
             'service_charges': [],
         }
+        # Суммы переводятся в целые числа один раз при разборе.
+        exponent = currency_exponent(pricing['currency'])
 
         for charge_node in node.iter('ServiceCharges'):
+            amount = 0
+            if charge_node.text:
+                amount = str2minor(charge_node.text, exponent)
+                # Некорректная сумма не должна превратиться в нулевую цену.
+                if amount is None:
+                    raise ValueError(
+                        f'Некорректная сумма ServiceCharges: '
+                        f'{charge_node.text!r}.')
             pricing['service_charges'].append({
                 'type': charge_node.attrib.get('type'),
                 'charge_type': charge_node.attrib.get('ChargeType'),
-                'sum': Decimal(charge_node.text) if charge_node.text else 0,
+                'sum': amount,
             })
 
         return pricing
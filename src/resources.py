@@ -1,87 +1,717 @@
-from operator import attrgetter, methodcaller
-from typing import TYPE_CHECKING
+import gzip
+import math
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+from dataclasses import fields, replace
+from datetime import datetime
+from typing import (
+    TYPE_CHECKING, Iterable, Iterator, Sequence, Tuple, Union)
+from urllib.parse import urlencode
 
 import falcon
 
-from config import VIA_3_KEY, VIA_OW_KEY
-from models import compare_proposals
+from cache import CachedResponse, ResponseCache
+from config import (
+    ALL_KEY, INGEST_RETRY_AFTER, JOIN_CHUNK_ROWS, JSON_INDENT,
+    ORDERINGS_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, STREAM_MIN_PROPOSALS,
+    VIA_3_KEY, VIA_OW_KEY)
+from cursors import (
+    Cursor, InvalidCursor, OrderingCache, StaleCursor, query_digest)
+from ingest import IngestJob, IngestQueue, TeeReader
+from metrics import (
+    INGEST_REQUESTS, REGISTRY, RESPONSE_CACHE, RESULT_COUNT, STAGE_SECONDS,
+    Registry)
+from models import (
+    COMPARE_KEYS, DEFAULT_OPTIMALITY_WEIGHTS, JOIN_ADDED, JOIN_MATCHED,
+    ORDER_KEYS, OptimalityWeights, compare_proposals, join_proposals)
+from filters import ProposalsFilter
+from parser import Parser
 from schemas import ProposalSchema
-from utils import jsonify
+from stats import dump_offer
+from utils import (
+    DateFormat, jsonify, source_file_name, source_key, str2timestamp)
 
 if TYPE_CHECKING:
-    from storage import Storage
+    from models import Proposals
+    from storage import Storage, StorageState
+
+
+def get_param_as_float(req, name: str,
+                       min_value: float = None) -> Union[float, None]:
+    """Аналог req.get_param_as_int для чисел с плавающей точкой."""
+    value = req.get_param(name)
+    if value is None:
+        return None
+
+    try:
+        result = float(value)
+    except ValueError:
+        result = math.nan
+    if not math.isfinite(result):
+        raise falcon.HTTPInvalidParam('The value must be a number.', name)
+    if min_value is not None and result < min_value:
+        raise falcon.HTTPInvalidParam(
+            f'The value must be at least {min_value}.', name)
+
+    return result
+
+
+def get_param_as_timestamp(req, name: str) -> Union[datetime, None]:
+    """Возвращает параметр-дату в формате DateFormat.TIMESTAMP."""
+    value = req.get_param(name)
+    if value is None:
+        return None
+
+    result = str2timestamp(value)
+    if result is None:
+        raise falcon.HTTPInvalidParam(
+            f'The value must be a date in {DateFormat.TIMESTAMP.value} '
+            f'format.', name)
+
+    return result
+
+
+def send_cached(req, resp, cached: 'CachedResponse') -> None:
+    """Отдает готовый ответ с ETag.
+
+    Если клиент прислал совпадающий If-None-Match, отдается 304 без тела.
+    """
+    resp.etag = cached.etag
+    if cached.matches(req.get_header('If-None-Match')):
+        resp.status = falcon.HTTP_304
+        return
+
+    resp.status = falcon.HTTP_200
+    resp.data = cached.body
+
+
+def send_stream(resp, chunks: Iterable[bytes],
+                content_type: str = falcon.MEDIA_JSON) -> None:
+    """Отдает тело ответа потоком порций без Content-Length.
+
+    Заголовок X-Accel-Buffering запрещает nginx копить ответ у себя,
+    порции уходят клиенту по мере формирования.
+    """
+    resp.content_type = content_type
+    resp.set_header('X-Accel-Buffering', 'no')
+    resp.stream = chunks
 
 
 class ProposalsResource:
-    def __init__(self, storage: 'Storage') -> None:
+    # Метка маршрута в метриках.
+    route = '/proposals'
+    # GET-параметры, которые переносятся в ссылку на следующую страницу.
+    link_params = (
+        'limit', 'order_by', 'reverse', 'w_price', 'w_duration', 'w_stops',
+        'adults', 'children', 'infants', 'stream',
+    ) + tuple(f.name for f in fields(ProposalsFilter))
+
+    def __init__(self, storage: 'Storage',
+                 cache: 'ResponseCache' = None) -> None:
         self.storage = storage
+        self.cache = cache or ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+        self.orderings = OrderingCache(ORDERINGS_CACHE_SIZE)
 
     def on_get(self, req, resp) -> None:
-        allowed_order_keys = (
-            'adult_prize',
-            'child_prize',
-            'infant_prize',
-            'duration',
-            'optimality',
-        )
         # Параметры.
         limit = req.get_param_as_int('limit', min=0)
         reverse = req.get_param_as_bool('reverse') or False
         order_by_key = req.get_param('order_by')
-        if order_by_key not in allowed_order_keys:
+        if order_by_key not in ORDER_KEYS:
             order_by_key = None
+        weights = None
+        if order_by_key == 'optimality':
+            weights = self._get_optimality_weights(req)
+        flt = self._get_filter(req)
+        cursor = self._get_cursor(req)
+        # None - потоком отдаются только большие ответы без limit и cursor.
+        stream = req.get_param_as_bool('stream')
+        # Весь запрос работает с одним состоянием хранилища.
+        state = self.storage.state
+        query = query_digest(order_by_key, reverse, weights, flt)
+        if cursor is not None:
+            try:
+                cursor.check(state.generation, query, order_by_key)
+            except StaleCursor:
+                raise falcon.HTTPGone(
+                    description='The cursor refers to data that has been '
+                                'reloaded. Request the first page again.')
+            except InvalidCursor:
+                raise falcon.HTTPInvalidParam(
+                    'The cursor does not match the query.', 'cursor')
+        link = self._get_link(req)
+        # Ответ зависит только от параметров и версии хранилища,
+        # поэтому повторные запросы отдаем из кэша.
+        cache_key = (
+            'proposals', order_by_key, reverse, limit, weights, flt, cursor,
+            link)
+        if not stream:
+            cached = self.cache.get(cache_key, state.version)
+            RESPONSE_CACHE.inc(
+                route=self.route, result='miss' if cached is None else 'hit')
+            if cached is not None:
+                send_cached(req, resp, cached)
+                return
+
+        try:
+            positions, next_link = self._positions(
+                state, order_by_key, reverse, limit, weights, flt, cursor,
+                query, link)
+        except InvalidCursor:
+            raise falcon.HTTPInvalidParam(
+                'The cursor does not match the query.', 'cursor')
+        RESULT_COUNT.observe(len(positions), route=self.route)
+        if stream is None:
+            stream = (
+                limit is None and cursor is None and
+                STREAM_MIN_PROPOSALS is not None and
+                len(positions) >= STREAM_MIN_PROPOSALS)
+        data = state.get_all_proposals()
+        if stream:
+            send_stream(resp, self._stream(data, positions, next_link))
+            return
+
+        body = self._render(data, positions, next_link)
+        send_cached(req, resp, self.cache.set(cache_key, state.version, body))
+
+    def _positions(self, state: 'StorageState', order_by_key: str,
+                   reverse: bool, limit: int, weights: 'OptimalityWeights',
+                   flt: 'ProposalsFilter', cursor: 'Cursor', query: str,
+                   link: str) -> Tuple[Sequence[int], Union[str, None]]:
+        """Возвращает позиции предложений ответа и ссылку
+        на следующую страницу."""
         # Достаем данные со всеми предложениями о перелетах.
-        data = self.storage.get_all_proposals()
-        proposals = data.proposals
-        # Если передан параметр сортировки, сортируем предложения по нему.
-        if order_by_key:
-            if order_by_key == 'optimality':
-                key = methodcaller(
-                    'calc_optimality',
-                    min_prize=data.min_prize,
-                    min_duration=data.min_duration)
-                # Для оптимальности reverse имеет противоположное значение,
-                # так как сортируем от большей оптимальности к меньшей.
-                reverse = not reverse
-            else:
-                key = attrgetter(order_by_key)
-            proposals = data.order_by(key=key, reverse=reverse)
+        data = state.get_all_proposals()
+        with STAGE_SECONDS.time(route=self.route, stage='order'):
+            if limit is None and cursor is None:
+                # Если передан параметр сортировки, берем предложения
+                # по индексу. Для оптимальности индекс уже идет от лучших
+                # к худшим. Фильтры применяются по индексам фильтрации.
+                positions = data.order_positions(
+                    key=order_by_key, reverse=reverse, weights=weights,
+                    flt=flt)
+                return positions, None
+
+            return self._page(
+                state, order_by_key, reverse, limit, weights, flt, cursor,
+                query, link)
 
+    def _render(self, data: 'Proposals', positions: Sequence[int],
+                next_link: Union[str, None]) -> bytes:
+        """Формирует тело ответа."""
+        # В компактном виде ответ собирается из готовых JSON-фрагментов.
+        if JSON_INDENT is None:
+            with STAGE_SECONDS.time(route=self.route, stage='to_json'):
+                return data.to_json(positions, next_link=next_link)
+
+        proposals = [data.proposals[i] for i in positions]
         proposals_schema = ProposalSchema(strict=True, many=True)
-        result = proposals_schema.dump(proposals[:limit])
+        with STAGE_SECONDS.time(route=self.route, stage='schema_dump'):
+            result = {'proposals': proposals_schema.dump(proposals).data}
+        if next_link is not None:
+            result['next'] = next_link
+
+        with STAGE_SECONDS.time(route=self.route, stage='jsonify'):
+            return jsonify(result).encode()
+
+    def _stream(self, data: 'Proposals', positions: Sequence[int],
+                next_link: Union[str, None]) -> Iterator[bytes]:
+        """Генерирует тело ответа порциями по мере отправки.
+
+        В память попадает только текущая порция. Форматированный
+        ответ (JSON_INDENT) не собирается из фрагментов, поэтому
+        формируется целиком и отдается одной порцией.
+        """
+        with STAGE_SECONDS.time(route=self.route, stage='stream'):
+            if JSON_INDENT is None:
+                yield from data.iter_json(positions, next_link=next_link)
+            else:
+                yield self._render(data, positions, next_link)
+
+    def _page(self, state: 'StorageState', order_by_key: str, reverse: bool,
+              limit: int, weights: 'OptimalityWeights',
+              flt: 'ProposalsFilter', cursor: 'Cursor', query: str,
+              link: str) -> Tuple[Sequence[int], Union[str, None]]:
+        """Возвращает позиции предложений страницы и ссылку
+        на следующую страницу.
+
+        Первая страница выбирается как top-k без полного порядка
+        (на одно предложение больше, чтобы узнать, есть ли следующая).
+        Продолжение по курсору берется из готового порядка, который
+        строится один раз на все следующие страницы запроса.
+        """
+        data = state.get_all_proposals()
+        if cursor is None:
+            positions = data.order_positions(
+                order_by_key, reverse=reverse,
+                limit=None if limit is None else limit + 1,
+                weights=weights, flt=flt)
+            has_next = limit is not None and len(positions) > limit
+            positions = positions[:limit]
+        else:
+            ordering = self.orderings.get_or_build(
+                query, state.version,
+                lambda: data.ordering(
+                    order_by_key, reverse=reverse, weights=weights, flt=flt))
+            after = cursor.position
+            if (after >= len(data.proposals) or
+                    str(data.proposals[after].uuid) != cursor.uuid or
+                    ordering.value(after) != cursor.value):
+                raise InvalidCursor(cursor.encode())
+            positions = ordering.page(after, limit)
+            has_next = (
+                len(positions) > 0 and
+                ordering.offset(int(positions[-1])) + 1 < len(ordering))
+
+        if not has_next or not len(positions):
+            return positions, None
+
+        last = int(positions[-1])
+        if cursor is None:
+            values = data.sort_values(order_by_key, weights)
+            value = None if values is None else values[last].item()
+        else:
+            value = ordering.value(last)
+        next_cursor = Cursor(
+            generation=state.generation, query=query, key=order_by_key,
+            value=value, uuid=str(data.proposals[last].uuid),
+            position=last)
+        separator = '&' if '?' in link else '?'
+        next_link = (
+            f'{link}{separator}{urlencode({"cursor": next_cursor.encode()})}')
+
+        return positions, next_link
+
+    @staticmethod
+    def _get_cursor(req) -> Union['Cursor', None]:
+        """Возвращает курсор из GET-параметра cursor."""
+        token = req.get_param('cursor')
+        if token is None:
+            return None
+
+        try:
+            return Cursor.decode(token)
+        except InvalidCursor:
+            raise falcon.HTTPInvalidParam('The cursor is malformed.', 'cursor')
 
-        resp.status = falcon.HTTP_200
-        resp.body = jsonify({'proposals': result.data})
+    def _get_link(self, req) -> str:
+        """Возвращает ссылку на запрос без курсора для перехода
+        по страницам."""
+        params = [
+            (name, req.params[name]) for name in self.link_params
+            if name in req.params]
+        if not params:
+            return req.path
+
+        return f'{req.path}?{urlencode(params, doseq=True)}'
+
+    @staticmethod
+    def _get_optimality_weights(req) -> 'OptimalityWeights':
+        """Возвращает параметры оптимальности из GET-параметров."""
+        params = {
+            'price': get_param_as_float(req, 'w_price', min_value=0),
+            'duration': get_param_as_float(req, 'w_duration', min_value=0),
+            'stops': get_param_as_float(req, 'w_stops', min_value=0),
+            'adults': req.get_param_as_int('adults', min=0),
+            'children': req.get_param_as_int('children', min=0),
+            'infants': req.get_param_as_int('infants', min=0),
+        }
+        params = {k: v for k, v in params.items() if v is not None}
+        weights = replace(DEFAULT_OPTIMALITY_WEIGHTS, **params)
+        if not weights.adults + weights.children + weights.infants:
+            raise falcon.HTTPInvalidParam(
+                'At least one passenger is required.', 'adults')
+
+        return weights
+
+    @staticmethod
+    def _get_filter(req) -> 'ProposalsFilter':
+        """Возвращает фильтр предложений из GET-параметров."""
+        return ProposalsFilter(
+            source=req.get_param('source'),
+            destination=req.get_param('destination'),
+            via=req.get_param('via'),
+            carrier_id=req.get_param('carrier_id'),
+            max_segments=req.get_param_as_int('max_segments', min=0),
+            max_stops=req.get_param_as_int('max_stops', min=0),
+            min_adult_prize=get_param_as_float(req, 'min_adult_prize'),
+            max_adult_prize=get_param_as_float(req, 'max_adult_prize'),
+            departure_from=get_param_as_timestamp(req, 'departure_from'),
+            departure_to=get_param_as_timestamp(req, 'departure_to'),
+            arrival_from=get_param_as_timestamp(req, 'arrival_from'),
+            arrival_to=get_param_as_timestamp(req, 'arrival_to'),
+            has_return=req.get_param_as_bool('has_return'),
+        )
 
 
 class DifferenceResource:
-    def __init__(self, storage: 'Storage') -> None:
+    # Метка маршрута в метриках.
+    route = '/difference'
+
+    def __init__(self, storage: 'Storage',
+                 cache: 'ResponseCache' = None) -> None:
         self.storage = storage
+        self.cache = cache or ResponseCache(RESPONSE_CACHE_MAX_BYTES)
 
     def on_get(self, req, resp) -> None:
-        allowed_order_keys = (
-            'adult_prize',
-            'child_prize',
-            'infant_prize',
-            'duration',
-        )
         # Параметры.
+        mode = req.get_param('mode') or 'best'
+        if mode == 'join':
+            self._on_get_join(req, resp)
+            return
+        if mode != 'best':
+            raise falcon.HTTPInvalidParam(
+                'The value must be "best" or "join".', 'mode')
         reverse = req.get_param_as_bool('reverse') or False
+        pairwise = req.get_param_as_bool('pairwise') or False
         # Параметр сортировки является обязательным,
         # иначе сравнение предложений будет некорректным.
         order_by_key = req.get_param('order_by', required=True)
-        if order_by_key not in allowed_order_keys:
+        if order_by_key not in COMPARE_KEYS:
             resp.status = falcon.HTTP_400
             return
 
-        data = self.storage.get_proposals()
-        key = attrgetter(order_by_key)
-        # Лучшее предложение из первого запроса
-        via3 = data[VIA_3_KEY].order_by(key=key, reverse=reverse)[0]
-        # Лучшее предложение из второго запроса
-        via_ow = data[VIA_OW_KEY].order_by(key=key, reverse=reverse)[0]
+        state = self.storage.state
+        sources = self._get_sources(req, state)
+        cache_key = ('difference', order_by_key, reverse, sources, pairwise)
+        cached = self.cache.get(cache_key, state.version)
+        RESPONSE_CACHE.inc(
+            route=self.route, result='miss' if cached is None else 'hit')
+        if cached is None:
+            body = self._render(
+                state, order_by_key, reverse, sources, pairwise)
+            cached = self.cache.set(cache_key, state.version, body)
+
+        send_cached(req, resp, cached)
+
+    def _render(self, state: 'StorageState', order_by_key: str,
+                reverse: bool, sources: Tuple[str, ...],
+                pairwise: bool) -> bytes:
+        """Формирует тело ответа.
+
+        Для двух источников - отличия лучших предложений второго
+        от первого. Для большего количества - отличия каждого следующего
+        источника от первого {источник: отличия}, а в режиме pairwise -
+        матрица отличий всех пар {первый: {второй: отличия}}.
+        """
+        data = state.get_proposals()
+        # Лучшие предложения источников берутся из готовых таблиц.
+        with STAGE_SECONDS.time(route=self.route, stage='lookup'):
+            best = {
+                source: data[source].best(order_by_key, reverse=reverse)
+                for source in sources}
         # Сравнение предложений
-        result = compare_proposals(via3, via_ow)
+        with STAGE_SECONDS.time(route=self.route, stage='compare'):
+            if pairwise:
+                result = {
+                    first: {
+                        second: compare_proposals(best[first], best[second])
+                        for second in sources if second != first}
+                    for first in sources}
+            elif len(sources) == 2:
+                result = compare_proposals(best[sources[0]], best[sources[1]])
+            else:
+                result = {
+                    source: compare_proposals(best[sources[0]], best[source])
+                    for source in sources[1:]}
+
+        with STAGE_SECONDS.time(route=self.route, stage='jsonify'):
+            return jsonify(result).encode()
+
+    def _on_get_join(self, req, resp) -> None:
+        """Отдает построчное сопоставление предложений двух источников
+        по маршрутам в формате JSON Lines.
+
+        Строки формируются по мере отправки ответа, поэтому ответ
+        не кэшируется и не собирается в памяти целиком.
+        """
+        state = self.storage.state
+        sources = self._get_sources(req, state)
+        if len(sources) != 2:
+            raise falcon.HTTPInvalidParam(
+                'Exactly two sources are required.', 'sources')
+
+        data = state.get_proposals()
+        send_stream(
+            resp, self._join_rows(data[sources[0]], data[sources[1]]),
+            content_type='application/x-ndjson')
+
+    @staticmethod
+    def _join_rows(first, second: 'Proposals') -> Iterator[bytes]:
+        """Генерирует строки сопоставления пачками по JOIN_CHUNK_ROWS.
+
+        Строка совпавшего маршрута - отличия из compare_proposals
+        и uuid обоих предложений, добавленного или удаленного - само
+        предложение.
+        """
+        rows = []
+        for status, first_position, second_position in join_proposals(
+                first, second):
+            if status == JOIN_MATCHED:
+                first_p = first.proposals[first_position]
+                second_p = second.proposals[second_position]
+                row = compare_proposals(first_p, second_p)
+                row.update(
+                    status=status, first_uuid=str(first_p.uuid),
+                    second_uuid=str(second_p.uuid))
+                rows.append(jsonify(row, indent=None).encode())
+            else:
+                data, position = (
+                    (second, second_position) if status == JOIN_ADDED
+                    else (first, first_position))
+                rows.append(b''.join((
+                    b'{"proposal":', data.fragment(position),
+                    b',"status":"', status.encode(), b'"}')))
+            if len(rows) >= JOIN_CHUNK_ROWS:
+                yield b'\n'.join(rows) + b'\n'
+                rows = []
+
+        if rows:
+            yield b'\n'.join(rows) + b'\n'
+
+    @staticmethod
+    def _get_sources(req, state: 'StorageState') -> Tuple[str, ...]:
+        """Возвращает ключи сравниваемых источников из GET-параметра
+        sources (через запятую), по умолчанию - VIA_3_KEY и VIA_OW_KEY."""
+        sources = req.get_param_as_list('sources') or [VIA_3_KEY, VIA_OW_KEY]
+        # Повторы убираются с сохранением порядка.
+        sources = tuple(dict.fromkeys(sources))
+        proposals = state.get_proposals()
+        for source in sources:
+            if (source == ALL_KEY or source not in proposals or
+                    not proposals[source].proposals):
+                raise falcon.HTTPInvalidParam(
+                    f'Unknown source or source without proposals: '
+                    f'{source}.', 'sources')
+        if len(sources) < 2:
+            raise falcon.HTTPInvalidParam(
+                'At least two sources are required.', 'sources')
+
+        return sources
+
+
+class StatsResource:
+    # Метка маршрута в метриках.
+    route = '/stats'
+
+    def __init__(self, storage: 'Storage',
+                 cache: 'ResponseCache' = None) -> None:
+        self.storage = storage
+        self.cache = cache or ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+
+    def on_get(self, req, resp) -> None:
+        """Отдает аналитику по источникам {источник: статистика}.
+
+        Статистика считается при загрузке данных (см. stats.py),
+        ответ собирается из готовых JSON.
+        """
+        state = self.storage.state
+        proposals = state.get_proposals()
+        sources = req.get_param_as_list('sources') or sorted(proposals)
+        sources = sorted(set(sources))
+        for source in sources:
+            if source not in proposals:
+                raise falcon.HTTPInvalidParam(
+                    f'Unknown source: {source}.', 'sources')
+
+        cache_key = ('stats', tuple(sources))
+        cached = self.cache.get(cache_key, state.version)
+        RESPONSE_CACHE.inc(
+            route=self.route, result='miss' if cached is None else 'hit')
+        if cached is None:
+            body = b','.join(
+                jsonify(source, indent=None).encode() + b':' +
+                proposals[source].stats.body
+                for source in sources)
+            cached = self.cache.set(
+                cache_key, state.version, b'{' + body + b'}')
+
+        send_cached(req, resp, cached)
+
+
+class RoutesResource:
+    """Поиск маршрутов между аэропортами (см. routes.py)."""
+    # Метка маршрута в метриках.
+    route = '/routes'
+    # Сортировка маршрутов: по цене самого дешевого
+    # или длительности самого быстрого предложения.
+    order_keys = {
+        'adult_prize': lambda item: (item.cheapest.adult_prize, item.count),
+        'duration': lambda item: (item.fastest.duration, item.count),
+    }
+
+    def __init__(self, storage: 'Storage',
+                 cache: 'ResponseCache' = None) -> None:
+        self.storage = storage
+        self.cache = cache or ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+
+    def on_get(self, req, resp) -> None:
+        """Отдает маршруты туда из from в to, их количество предложений,
+        самое дешевое и самое быстрое предложение каждого маршрута."""
+        # Параметры.
+        origin = req.get_param('from', required=True).upper()
+        destination = req.get_param('to', required=True).upper()
+        via = tuple(
+            airport.upper() for airport in req.get_param_as_list('via') or ())
+        max_legs = req.get_param_as_int('max_legs', min=1)
+        departure_from = get_param_as_timestamp(req, 'departure_from')
+        departure_to = get_param_as_timestamp(req, 'departure_to')
+        order_by_key = req.get_param('order_by') or 'adult_prize'
+        if order_by_key not in self.order_keys:
+            raise falcon.HTTPInvalidParam(
+                'The value must be "adult_prize" or "duration".', 'order_by')
+        limit = req.get_param_as_int('limit', min=0)
+        # Ключи источников через запятую, как у /stats и /difference.
+        sources = tuple(dict.fromkeys(
+            req.get_param_as_list('sources') or [ALL_KEY]))
+
+        state = self.storage.state
+        for source in sources:
+            if source not in state.get_proposals():
+                raise falcon.HTTPInvalidParam(
+                    f'Unknown source: {source}.', 'sources')
+        cache_key = (
+            'routes', sources, origin, destination, via, max_legs,
+            departure_from, departure_to, order_by_key, limit)
+        cached = self.cache.get(cache_key, state.version)
+        RESPONSE_CACHE.inc(
+            route=self.route, result='miss' if cached is None else 'hit')
+        if cached is None:
+            # Несколько источников ищутся по общему набору.
+            key = sources[0] if len(sources) == 1 else ALL_KEY
+            data = state.get_proposals()[key]
+            with STAGE_SECONDS.time(route=self.route, stage='lookup'):
+                positions = data.route_index.find(
+                    origin, destination, via=via, max_legs=max_legs,
+                    departure_from=departure_from, departure_to=departure_to)
+                if key == ALL_KEY and ALL_KEY not in sources:
+                    mask = data.table.source_mask(sources)
+                    positions = positions[mask[positions]]
+                itineraries = data.route_index.itineraries(data, positions)
+            RESULT_COUNT.observe(len(positions), route=self.route)
+            body = self._render(itineraries, order_by_key, limit)
+            cached = self.cache.set(cache_key, state.version, body)
+
+        send_cached(req, resp, cached)
+
+    def _render(self, itineraries: dict, order_by_key: str,
+                limit: Union[int, None]) -> bytes:
+        items = sorted(
+            itineraries.items(),
+            key=lambda item: self.order_keys[order_by_key](item[1]))
+        result = {
+            'count': sum(item.count for item in itineraries.values()),
+            'itineraries': [
+                {
+                    'route': list(route),
+                    'legs': len(route) - 1,
+                    'count': item.count,
+                    'cheapest': dump_offer(item.cheapest),
+                    'fastest': dump_offer(item.fastest),
+                }
+                for route, item in items[:limit]],
+        }
+        with STAGE_SECONDS.time(route=self.route, stage='jsonify'):
+            return jsonify(result).encode()
+
+
+class SearchesResource:
+    """Прием ответов поставщиков (см. ingest.py)."""
+    # Метка маршрута в метриках.
+    route = '/searches'
+
+    def __init__(self, storage: 'Storage',
+                 ingest: 'IngestQueue' = None) -> None:
+        self.storage = storage
+        self.ingest = ingest or IngestQueue(storage)
 
-        resp.status = falcon.HTTP_200
-        resp.body = jsonify(result)
+    def on_post(self, req, resp, source: str) -> None:
+        """Принимает xml AirFareSearchResponse для источника source.
+
+        Тело может быть сжато gzip (Content-Encoding: gzip). Ответ 202
+        отдается сразу после разбора, данные появляются в хранилище
+        после публикации в фоне.
+        """
+        # Ключ должен однозначно восстанавливаться из имени файла.
+        if source == ALL_KEY or source_key(source_file_name(source)) != source:
+            raise falcon.HTTPInvalidParam(
+                'The source must consist of lowercase letters, digits '
+                'and underscores.', 'source')
+        encoding = (req.get_header('Content-Encoding') or 'identity').lower()
+        if encoding not in ('identity', 'gzip'):
+            raise falcon.HTTPUnsupportedMediaType(
+                'Only gzip content encoding is supported.')
+
+        if not self.ingest.reserve():
+            INGEST_REQUESTS.inc(result='rejected')
+            raise falcon.HTTPServiceUnavailable(
+                'Ingestion queue is full',
+                'Too many searches are being processed. Retry later.',
+                retry_after=INGEST_RETRY_AFTER)
+        try:
+            job = self._receive(req, source, gzipped=encoding == 'gzip')
+        except Exception:
+            self.ingest.release()
+            raise
+        self.ingest.submit(job)
+        INGEST_REQUESTS.inc(result='queued')
+
+        resp.status = falcon.HTTP_202
+        resp.data = jsonify(
+            {'source': source, 'proposals': job.proposals},
+            indent=None).encode()
+
+    def _receive(self, req, source: str, gzipped: bool) -> 'IngestJob':
+        """Проверяет тело запроса потоковым разбором, копируя его
+        во временный файл рядом с файлом источника.
+
+        Разобранные предложения только считаются и в памяти
+        не накапливаются, объекты создаются в фоне по файлу
+        (см. Storage.ingest).
+        """
+        stream = req.bounded_stream
+        if gzipped:
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        directory = os.path.dirname(self.storage.source_path(source))
+        with STAGE_SECONDS.time(route=self.route, stage='parse'), \
+                tempfile.NamedTemporaryFile(
+                    dir=directory, prefix='.ingest-', suffix='.tmp',
+                    delete=False) as f:
+            try:
+                reader = TeeReader(stream, f)
+                data = Parser.parse_stream(reader)
+                proposals = sum(1 for _ in data['proposals'])
+                reader.drain()
+            except Exception as e:
+                f.close()
+                os.remove(f.name)
+                if not isinstance(e, (
+                        ET.ParseError, ValueError, OSError, EOFError,
+                        zlib.error)):
+                    raise
+                INGEST_REQUESTS.inc(result='invalid')
+                raise falcon.HTTPBadRequest(
+                    'Invalid body',
+                    'The body must be an AirFareSearchResponse XML document.')
+        if not proposals:
+            os.remove(f.name)
+            INGEST_REQUESTS.inc(result='invalid')
+            raise falcon.HTTPBadRequest(
+                'Invalid body', 'The body must contain proposals.')
+
+        return IngestJob(source=source, file_path=f.name, proposals=proposals)
+
+
+class MetricsResource:
+    # Метка маршрута в метриках.
+    route = '/metrics'
+
+    def __init__(self, registry: 'Registry' = REGISTRY) -> None:
+        self.registry = registry
+
+    def on_get(self, req, resp) -> None:
+        """Отдает метрики всех процессов в текстовом формате Prometheus."""
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.data = self.registry.expose().encode()
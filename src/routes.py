@@ -0,0 +1,245 @@
+"""Граф соединений аэропортов для эндпоинта /routes.
+
+Для каждого набора предложений при загрузке строятся список смежности
+{аэропорт: вылетающие из него сегменты по времени вылета} и обратный
+индекс {сегмент: предложения, в маршрут туда которых он входит}.
+Поиск маршрутов начинается с сегментов, вылетающих из начального
+аэропорта, и проверяет только предложения, которые с них начинаются,
+а не все предложения набора.
+"""
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from stats import GroupStats, first_by_group
+
+if TYPE_CHECKING:
+    from models import Flight, Proposal, Proposals
+
+
+class RouteIndex:
+    """Граф соединений аэропортов набора предложений.
+
+    Сегменты нумеруются, сами объекты Flight индекс не хранит.
+    adjacency - {код аэропорта: (времена вылета по возрастанию,
+        номера вылетающих сегментов)},
+    offsets, positions, legs - обратный индекс: предложения с сегментом i -
+        positions[offsets[i]:offsets[i + 1]] по возрастанию, legs - номер
+        сегмента в маршруте каждого из них,
+    routes - маршруты из кодов аэропортов,
+    route_codes - номер маршрута в routes для каждого предложения.
+    """
+    def __init__(self, adjacency: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                 offsets: np.ndarray, positions: np.ndarray, legs: np.ndarray,
+                 routes: Tuple[Tuple[str, ...], ...],
+                 route_codes: np.ndarray) -> None:
+        self.adjacency = adjacency
+        self.offsets = offsets
+        self.positions = positions
+        self.legs = legs
+        self.routes = routes
+        self.route_codes = route_codes
+
+    @classmethod
+    def build(cls, proposals: List['Proposal']) -> 'RouteIndex':
+        # Одинаковые сегменты разных предложений - один объект
+        # (см. Storage._create_flights), поэтому они различаются по id.
+        segment_ids = {}
+        segments = []
+        routes = {}
+        entries = []
+        route_codes = np.empty(len(proposals), dtype=np.int64)
+        for position, proposal in enumerate(proposals):
+            route_codes[position] = routes.setdefault(
+                tuple(proposal.segments_airports), len(routes))
+            for leg, flight in enumerate(proposal.flights.onward):
+                segment_id = segment_ids.setdefault(id(flight), len(segments))
+                if segment_id == len(segments):
+                    segments.append(flight)
+                entries.append((segment_id, position, leg))
+
+        entries = np.array(entries, dtype=np.int64).reshape(-1, 3)
+        # Позиции уже идут по возрастанию, сортировка стабильная.
+        order = np.argsort(entries[:, 0], kind='stable')
+        counts = np.bincount(entries[:, 0], minlength=len(segments))
+
+        return cls(
+            adjacency=_adjacency(segments),
+            offsets=np.concatenate(([0], np.cumsum(counts))),
+            positions=entries[order, 1],
+            legs=entries[order, 2].astype(np.int16),
+            routes=tuple(routes),
+            route_codes=route_codes)
+
+    @classmethod
+    def concat(cls, parts: Sequence['RouteIndex']) -> 'RouteIndex':
+        """Индекс объединения наборов предложений (см. Proposals.concat).
+
+        Сегменты частей нумеруются подряд без поиска одинаковых, поэтому
+        один рейс может встретиться в графе несколько раз. На поиск это
+        не влияет: у каждого предложения ровно один первый сегмент.
+        """
+        if not parts:
+            return cls.build([])
+
+        routes = {}
+        adjacency = {}
+        offsets, positions, legs, route_codes = [], [], [], []
+        segment_offset = entry_offset = position_offset = 0
+        for part in parts:
+            for code, (departures, ids) in part.adjacency.items():
+                adjacency.setdefault(code, []).append(
+                    (departures, ids + segment_offset))
+            offsets.append(part.offsets[:-1] + entry_offset)
+            positions.append(part.positions + position_offset)
+            legs.append(part.legs)
+            mapping = np.array(
+                [routes.setdefault(route, len(routes))
+                 for route in part.routes], dtype=np.int64)
+            route_codes.append(mapping[part.route_codes])
+            segment_offset += part.size
+            entry_offset += len(part.positions)
+            position_offset += len(part.route_codes)
+        offsets.append(np.array([entry_offset], dtype=np.int64))
+
+        for code, items in adjacency.items():
+            departures = np.concatenate([item[0] for item in items])
+            ids = np.concatenate([item[1] for item in items])
+            order = np.argsort(departures, kind='stable')
+            adjacency[code] = (departures[order], ids[order])
+
+        return cls(
+            adjacency=adjacency,
+            offsets=np.concatenate(offsets),
+            positions=np.concatenate(positions),
+            legs=np.concatenate(legs),
+            routes=tuple(routes),
+            route_codes=np.concatenate(route_codes))
+
+    @property
+    def size(self) -> int:
+        """Количество сегментов в графе."""
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """Память массивов индекса в байтах."""
+        arrays = [self.offsets, self.positions, self.legs, self.route_codes]
+        for departures, ids in self.adjacency.values():
+            arrays.extend((departures, ids))
+
+        return sum(a.nbytes for a in arrays)
+
+    def subset(self, keep: np.ndarray) -> 'RouteIndex':
+        """Индекс для набора без предложений, для которых keep ложно
+        (см. Proposals.subset). Сегменты, не входящие в оставшиеся
+        предложения, убираются из графа."""
+        new_positions = np.cumsum(keep) - 1
+        kept = keep[self.positions]
+        entry_segments = np.repeat(np.arange(self.size), np.diff(self.offsets))
+        counts = np.bincount(entry_segments[kept], minlength=self.size)
+        keep_segments = counts > 0
+        new_ids = np.cumsum(keep_segments) - 1
+        adjacency = {}
+        for code, (departures, ids) in self.adjacency.items():
+            selected = keep_segments[ids]
+            if selected.any():
+                adjacency[code] = (
+                    departures[selected], new_ids[ids[selected]])
+
+        return RouteIndex(
+            adjacency=adjacency,
+            offsets=np.concatenate(([0], np.cumsum(counts[keep_segments]))),
+            positions=new_positions[self.positions[kept]],
+            legs=self.legs[kept],
+            routes=self.routes,
+            route_codes=self.route_codes[keep])
+
+    def departures(self, origin: str, departure_from: datetime = None,
+                   departure_to: datetime = None) -> np.ndarray:
+        """Номера сегментов, вылетающих из аэропорта origin в интервале
+        [departure_from, departure_to], по времени вылета."""
+        item = self.adjacency.get(origin)
+        if item is None:
+            return np.empty(0, dtype=np.int64)
+
+        departures, ids = item
+        start, stop = 0, len(ids)
+        if departure_from is not None:
+            start = np.searchsorted(
+                departures, np.datetime64(departure_from, 'm'), side='left')
+        if departure_to is not None:
+            stop = np.searchsorted(
+                departures, np.datetime64(departure_to, 'm'), side='right')
+
+        return ids[start:stop]
+
+    def find(self, origin: str, destination: str, via: Sequence[str] = (),
+             max_legs: int = None, departure_from: datetime = None,
+             departure_to: datetime = None) -> np.ndarray:
+        """Возвращает позиции предложений по возрастанию, маршрут туда
+        которых начинается в origin, заканчивается в destination,
+        проходит через все пересадки via и состоит не более чем
+        из max_legs сегментов. Интервал вылета ограничивает время вылета
+        первого сегмента."""
+        ids = self.departures(origin, departure_from, departure_to)
+        entries = _ranges(self.offsets[ids], self.offsets[ids + 1])
+        candidates = self.positions[entries[self.legs[entries] == 0]]
+        codes = self.route_codes[candidates]
+
+        valid = []
+        for code in np.unique(codes).tolist():
+            route = self.routes[code]
+            if (route[-1] == destination and
+                    (max_legs is None or len(route) - 1 <= max_legs) and
+                    all(airport in route[1:-1] for airport in via)):
+                valid.append(code)
+
+        return np.sort(candidates[np.isin(codes, valid)])
+
+    def itineraries(self, proposals: 'Proposals', positions: np.ndarray
+                    ) -> Dict[Tuple[str, ...], 'GroupStats']:
+        """Группирует предложения с позициями positions по маршрутам
+        {маршрут: лучшие предложения}."""
+        table = proposals.table
+        items = proposals.proposals
+        codes = self.route_codes[positions]
+        cheapest = first_by_group(codes, table.adult_prize[positions])
+        fastest = first_by_group(codes, table.duration[positions])
+
+        return {
+            self.routes[code]: GroupStats(
+                count=count, cheapest=items[positions[cheapest_index]],
+                fastest=items[positions[fastest[code][1]]])
+            for code, (count, cheapest_index) in cheapest.items()}
+
+
+def _adjacency(segments: Sequence['Flight']
+               ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Список смежности сегментов по аэропортам вылета."""
+    grouped = {}
+    for segment_id, segment in enumerate(segments):
+        grouped.setdefault(segment.source.code, []).append(segment_id)
+
+    result = {}
+    for code, group in grouped.items():
+        group = np.array(group, dtype=np.int64)
+        departures = np.array(
+            [segments[i].departure_timestamp for i in group.tolist()],
+            dtype='datetime64[m]')
+        order = np.argsort(departures, kind='stable')
+        result[code] = (departures[order], group[order])
+
+    return result
+
+
+def _ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """Склеивает диапазоны range(starts[i], stops[i]) в один массив."""
+    counts = stops - starts
+    if not counts.sum():
+        return np.empty(0, dtype=np.int64)
+
+    shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+    return shifts + np.arange(counts.sum())
@@ -1,13 +1,28 @@
+from typing import TYPE_CHECKING
+
 from marshmallow import Schema, fields
 
-from utils import DateFormat
+from utils import DateFormat, jsonify, minor2decimal
+
+if TYPE_CHECKING:
+    from models import Proposal
+
+
+class MinorUnits(fields.Field):
+    """Сумма Pricing в минимальных единицах валюты,
+    выводится как число в основных единицах."""
+    def _serialize(self, value, attr, obj):
+        if value is None:
+            return None
+
+        return minor2decimal(value, obj.exponent)
 
 
 class PricingSchema(Schema):
     type = fields.Str(dump_only=True, attribute='type_name')
-    base_fare = fields.Decimal(dump_only=True)
-    taxes = fields.Decimal(dump_only=True)
-    total_amount = fields.Decimal(dump_only=True)
+    base_fare = MinorUnits(dump_only=True)
+    taxes = MinorUnits(dump_only=True)
+    total_amount = MinorUnits(dump_only=True)
 
 
 class FlightSchema(Schema):
@@ -36,3 +51,14 @@ class ProposalSchema(Schema):
     uuid = fields.Str(dump_only=True)
     flights = fields.Nested(FlightsSchema, dump_only=True)
     pricing = fields.Nested(PricingSchema, dump_only=True, many=True)
+
+
+# Экземпляр схемы для формирования JSON-фрагментов предложений.
+proposal_schema = ProposalSchema(strict=True)
+
+
+def dump_proposal_json(proposal: 'Proposal') -> bytes:
+    """Возвращает предложение в виде компактного JSON."""
+    result = proposal_schema.dump(proposal)
+
+    return jsonify(result.data, indent=None).encode()
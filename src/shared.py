@@ -0,0 +1,229 @@
+"""Разделяемая между процессами память только для чтения.
+
+Под gunicorn --preload воркеры форкаются от мастера и делят его страницы
+памяти, пока в них никто не пишет. Массивы numpy и байты, разложенные
+по объектам Python, со временем копируются в каждый воркер: запись
+счетчиков ссылок и проход сборщика мусора изменяют страницы. Поэтому
+колонки, индексы и JSON-фрагменты складываются в один регион mmap,
+открытый только на чтение, и дальше используются через представления
+(np.ndarray, memoryview), которые не пишут в сам регион.
+
+Регионы, созданные после старта, у каждого процесса свои. Чтобы воркеры,
+которые загружают состояние из снимка хранилища, не держали собственные
+копии, при сохранении снимка данные регионов записываются в файл региона
+рядом со снимком (RegionWriter), а при загрузке этот файл отображается
+в память (RegionReader), и все такие воркеры делят его страницы.
+"""
+import mmap
+import pickle
+import tempfile
+from typing import (
+    BinaryIO, Dict, Hashable, Iterable, Iterator, List, Tuple, Union)
+
+import numpy as np
+
+from config import SHARED_MEMORY_DIR
+
+# Выравнивание начала каждого массива в регионе.
+ALIGNMENT = 64
+
+
+def create_region(chunks: Iterable[bytes]) -> Tuple[mmap.mmap, List[int]]:
+    """Записывает куски в новый регион и возвращает его
+    вместе со смещениями кусков.
+
+    Регион - файл в SHARED_MEMORY_DIR без имени, отображенный в память
+    только на чтение. После форка процессы отображают одни и те же
+    физические страницы.
+    """
+    offsets = []
+    with tempfile.TemporaryFile(dir=SHARED_MEMORY_DIR) as f:
+        size = 0
+        for chunk in chunks:
+            padding = -size % ALIGNMENT
+            f.write(b'\0' * padding)
+            size += padding
+            offsets.append(size)
+            f.write(chunk)
+            size += len(chunk)
+        # Пустой файл нельзя отобразить в память.
+        if not size:
+            f.write(b'\0')
+        f.flush()
+        region = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return region, offsets
+
+
+def share_arrays(
+        arrays: Dict[Hashable, np.ndarray]) -> Dict[Hashable, np.ndarray]:
+    """Переносит массивы в один регион разделяемой памяти.
+
+    Возвращает массивы с теми же ключами, которые являются представлениями
+    региона и доступны только на чтение.
+    """
+    arrays = {key: np.ascontiguousarray(a) for key, a in arrays.items()}
+    region, offsets = create_region(a.tobytes() for a in arrays.values())
+    result = {}
+    for (key, array), offset in zip(arrays.items(), offsets):
+        result[key] = np.frombuffer(
+            region, dtype=array.dtype, count=array.size,
+            offset=offset).reshape(array.shape)
+
+    return result
+
+
+class SharedFragments:
+    """JSON-фрагменты предложений в одном регионе разделяемой памяти.
+
+    Фрагменты лежат в регионе подряд, i-й фрагмент занимает байты
+    [offsets[i], offsets[i + 1]). Элементы отдаются как memoryview,
+    поэтому их можно склеивать через bytes.join без копирования в объекты
+    bytes. При сериализации (снимок хранилища) превращается в список bytes.
+    """
+    def __init__(self, buffer: memoryview, offsets: np.ndarray) -> None:
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_fragments(cls, fragments: Iterable[bytes]) -> 'SharedFragments':
+        fragments = list(fragments)
+        lengths = np.fromiter(
+            (len(f) for f in fragments), dtype=np.int64, count=len(fragments))
+        offsets = np.zeros(len(fragments) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        region, (offsets_start, data_start) = create_region(
+            [offsets.tobytes(), b''.join(fragments)])
+        offsets = np.frombuffer(
+            region, dtype=offsets.dtype, count=len(offsets),
+            offset=offsets_start)
+
+        return cls(memoryview(region)[data_start:], offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """Размер фрагментов в байтах."""
+        return int(self.offsets[-1] - self.offsets[0])
+
+    def __getitem__(self, index: Union[int, slice]
+                    ) -> Union[memoryview, 'SharedFragments']:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Шаг среза не поддерживается.')
+            stop = max(start, stop)
+            return SharedFragments(self.buffer, self.offsets[start:stop + 1])
+        if index < 0:
+            index += len(self)
+
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reduce__(self):
+        return list, ([bytes(f) for f in self],)
+
+
+class RegionWriter:
+    """Записывает данные регионов разделяемой памяти в файл региона
+    при сохранении снимка (pickle.Pickler.persistent_id).
+
+    Вместо копий в снимок попадают ссылки на место данных в файле.
+    Так сохраняются массивы, доступные только на чтение (представления
+    регионов), и JSON-фрагменты SharedFragments. Общий буфер фрагментов
+    и его срезов записывается один раз.
+    """
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.size = 0
+        self._buffers = {}
+        # Ссылки на уже записанные объекты, которые встречаются
+        # в состоянии несколько раз.
+        self._ids = {}
+
+    def persistent_id(self, obj) -> Union[tuple, None]:
+        result = self._ids.get(id(obj))
+        if result is None:
+            result = self._persistent_id(obj)
+            if result is not None:
+                self._ids[id(obj)] = result
+
+        return result
+
+    def _persistent_id(self, obj) -> Union[tuple, None]:
+        if isinstance(obj, np.ndarray):
+            if (obj.flags.writeable or obj.dtype.hasobject or
+                    not obj.flags.c_contiguous):
+                return None
+            return ('array', self._write_array(obj), obj.dtype.str, obj.shape)
+        if isinstance(obj, SharedFragments):
+            # Срезы фрагментов ссылаются на один буфер.
+            buffer = self._buffers.get(id(obj.buffer))
+            if buffer is None:
+                buffer = self._buffers[id(obj.buffer)] = (
+                    self._write(obj.buffer), len(obj.buffer))
+            return ('fragments', *buffer, self._write_array(obj.offsets),
+                    len(obj.offsets))
+
+        return None
+
+    def close(self) -> None:
+        """Дописывает файл. Пустой файл нельзя отобразить в память."""
+        if not self.size:
+            self.file.write(b'\0')
+        self.file.flush()
+
+    def _write_array(self, array: np.ndarray) -> int:
+        return self._write(array.view(np.uint8).reshape(-1))
+
+    def _write(self, data) -> int:
+        padding = -self.size % ALIGNMENT
+        self.file.write(b'\0' * padding)
+        offset = self.size + padding
+        self.file.write(data)
+        self.size = offset + len(data)
+
+        return offset
+
+
+class RegionReader:
+    """Восстанавливает данные из файла региона при загрузке снимка
+    (pickle.Unpickler.persistent_load, см. RegionWriter).
+
+    Файл отображается в память только на чтение при первом обращении.
+    Массивы и фрагменты становятся его представлениями, поэтому процессы,
+    загрузившие один снимок, делят страницы файла.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._region = None
+
+    def persistent_load(self, pid: tuple):
+        region = self._map()
+        kind, *args = pid
+        if kind == 'array':
+            offset, dtype, shape = args
+            return np.frombuffer(
+                region, dtype=np.dtype(dtype), count=int(np.prod(shape)),
+                offset=offset).reshape(shape)
+        if kind == 'fragments':
+            start, size, offsets_start, count = args
+            offsets = np.frombuffer(
+                region, dtype=np.int64, count=count, offset=offsets_start)
+            return SharedFragments(
+                memoryview(region)[start:start + size], offsets)
+
+        raise pickle.UnpicklingError(f'Неизвестная ссылка {kind}.')
+
+    def _map(self) -> mmap.mmap:
+        if self._region is None:
+            with open(self.path, 'rb') as f:
+                self._region = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._region
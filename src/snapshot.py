@@ -0,0 +1,145 @@
+"""Бинарный снимок загруженного хранилища.
+
+Снимок - файл с двумя pickle-объектами подряд: заголовком и состоянием
+хранилища. Заголовок содержит версию формата, настройки, от которых
+зависит состав состояния (см. storage.snapshot_settings), и отпечаток
+исходных файлов, поэтому устаревший снимок отбрасывается без чтения
+состояния.
+Снимок создается самим приложением рядом с данными и считается доверенным.
+
+Данные разделяемой памяти (см. shared.py) записываются не в сам снимок,
+а в файл региона рядом с ним, имя которого хранится в заголовке. Каждый
+снимок пишет новый файл региона, старые удаляются после подмены снимка:
+процессы, которые уже отобразили старый файл, продолжают с ним работать.
+"""
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import uuid
+from typing import Dict, Tuple, Union
+
+from shared import RegionReader, RegionWriter
+
+# Версия формата снимка. Увеличивается при любых изменениях моделей,
+# индексов или состава состояния хранилища.
+SNAPSHOT_FORMAT_VERSION = 10
+
+logger = logging.getLogger()
+
+
+def file_digest(file_path: str, chunk_size: int = 2 ** 20) -> str:
+    """Хэш содержимого файла."""
+    digest = hashlib.blake2b()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fingerprint(sources: Dict[str, str],
+                known: Tuple[tuple, ...] = ()) -> Tuple[tuple, ...]:
+    """Отпечаток исходных файлов: ключ, размер, mtime и хэш содержимого.
+
+    known - известный отпечаток, например из заголовка снимка. Хэш
+    содержимого берется из него, если размер и mtime файла не изменились,
+    и считается заново только для измененных файлов.
+    """
+    digests = {
+        (key, size, mtime): digest for key, size, mtime, digest in known}
+    result = []
+    for key in sorted(sources):
+        path = sources[key]
+        stat = os.stat(path)
+        signature = (key, stat.st_size, stat.st_mtime_ns)
+        digest = digests.get(signature)
+        if digest is None:
+            digest = file_digest(path)
+        result.append((*signature, digest))
+
+    return tuple(result)
+
+
+def load_snapshot(path: str, sources: Dict[str, str], settings: dict
+                  ) -> Union[Tuple[tuple, dict], None]:
+    """Загружает состояние хранилища из снимка.
+
+    Возвращает отпечаток исходных файлов sources (см. fingerprint)
+    и состояние или None, если снимка нет, он другой версии формата,
+    сохранен с другими настройками settings или собран по другим
+    исходным файлам.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            region = header.pop('region', None)
+            sources_fingerprint = fingerprint(
+                sources, header.get('fingerprint', ()))
+            if header != _header(sources_fingerprint, settings) or not region:
+                logger.info(f'Снимок {path} устарел.')
+                return None
+            unpickler = pickle.Unpickler(f)
+            unpickler.persistent_load = RegionReader(
+                os.path.join(os.path.dirname(path), region)).persistent_load
+            return sources_fingerprint, unpickler.load()
+    except FileNotFoundError:
+        # В том числе файл региона, удаленный следующим снимком.
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+            ImportError) as e:
+        logger.warning(f'Не удалось прочитать снимок {path}: {e}')
+        return None
+
+
+def save_snapshot(path: str, sources_fingerprint: tuple, settings: dict,
+                  state: dict) -> None:
+    """Сохраняет состояние хранилища в снимок.
+
+    Файл пишется во временный и затем атомарно подменяется, чтобы
+    параллельно стартующие процессы не прочитали его наполовину.
+    Файл региона пишется под новым именем до подмены снимка. Снимки
+    сохраняются по одному под блокировкой файла, поэтому файл региона
+    текущего снимка не удалит другой процесс.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    region_path = f'{path}.{uuid.uuid4().hex}.region'
+    header = dict(
+        _header(sources_fingerprint, settings),
+        region=os.path.basename(region_path))
+    try:
+        lock = open(f'{path}.save.lock', 'a')
+    except OSError as e:
+        logger.warning(f'Не удалось сохранить снимок {path}: {e}')
+        return
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(tmp_path, 'wb') as f, open(region_path, 'wb') as r:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                writer = RegionWriter(r)
+                pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = writer.persistent_id
+                pickler.dump(state)
+                writer.close()
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Не удалось сохранить снимок {path}: {e}')
+            for file_path in (tmp_path, region_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            return
+
+        for file_path in glob.glob(f'{glob.escape(path)}.*.region'):
+            if file_path != region_path:
+                os.remove(file_path)
+
+
+def _header(sources_fingerprint: tuple, settings: dict) -> dict:
+    return {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'settings': settings,
+        'fingerprint': sources_fingerprint,
+    }
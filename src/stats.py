@@ -0,0 +1,240 @@
+"""Аналитика по предложениям для эндпоинта /stats.
+
+Для каждого набора предложений при загрузке считаются лучшие предложения
+(самое дешевое и самое быстрое) по перевозчикам, маршрутам и количеству
+сегментов, а также распределения цен и длительностей. Статистика общего
+набора собирается из статистики источников без повторного прохода
+по предложениям, поэтому при перезагрузке пересчитываются только
+изменившиеся источники.
+"""
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING, Dict, Hashable, Iterable, List, Sequence, Tuple, Union)
+from uuid import UUID
+
+import numpy as np
+from numpy.lib import NumpyVersion
+
+from config import (
+    STATS_DURATION_EDGES, STATS_PERCENTILES, STATS_PRICE_EDGES)
+from utils import PRICE_EXPONENT, jsonify, minor2decimal
+
+if TYPE_CHECKING:
+    from columns import ProposalsTable
+    from models import Proposal, Proposals
+
+# Группировки лучших предложений.
+STATS_GROUPS = ('carriers', 'routes', 'segments')
+# Перцентили без интерполяции: в numpy 1.22 параметр interpolation
+# переименован в method, а в numpy 2 удален.
+PERCENTILE_LOWER = (
+    {'method': 'lower'} if NumpyVersion(np.__version__) >= '1.22.0'
+    else {'interpolation': 'lower'})
+
+
+@dataclass(frozen=True)
+class Offer:
+    """Краткие данные предложения, которые нужны статистике.
+
+    Статистика не держит сами предложения, поэтому ленивые наборы
+    (см. lazy.py) не хранят разобранные объекты ради нее.
+    """
+    uuid: UUID
+    adult_prize: int
+    duration: int
+    segments_airports: Tuple[str, ...]
+
+    @classmethod
+    def from_proposal(cls, proposal: 'Proposal') -> 'Offer':
+        return cls(
+            uuid=proposal.uuid, adult_prize=proposal.adult_prize,
+            duration=proposal.duration,
+            segments_airports=tuple(proposal.segments_airports))
+
+
+@dataclass(frozen=True)
+class GroupStats:
+    """Лучшие предложения группы."""
+    # Количество предложений в группе.
+    count: int
+    # Самое дешевое (по цене для взрослого) и самое быстрое предложения.
+    # При равенстве берется первое по порядку предложений.
+    cheapest: Union['Offer', 'Proposal']
+    fastest: Union['Offer', 'Proposal']
+
+    @classmethod
+    def merge(cls, items: Sequence['GroupStats']) -> 'GroupStats':
+        """Объединяет статистику одной группы из нескольких наборов,
+        перечисленных в порядке предложений."""
+        return cls(
+            count=sum(item.count for item in items),
+            cheapest=min(
+                (item.cheapest for item in items),
+                key=lambda p: p.adult_prize),
+            fastest=min(
+                (item.fastest for item in items),
+                key=lambda p: p.duration),
+        )
+
+    def dump(self) -> dict:
+        return {
+            'count': self.count,
+            'cheapest': dump_offer(self.cheapest),
+            'fastest': dump_offer(self.fastest),
+        }
+
+
+class ProposalsStats:
+    """Статистика набора предложений.
+
+    groups - {группировка: {значение: GroupStats}},
+    distributions - распределения цен и длительностей,
+    body - готовый JSON, который отдается без сериализации на запросах.
+    """
+    def __init__(self, count: int,
+                 groups: Dict[str, Dict[Hashable, 'GroupStats']],
+                 distributions: Dict[str, dict]) -> None:
+        self.count = count
+        self.groups = groups
+        self.distributions = distributions
+        self.body = jsonify(self.dump(), indent=None).encode()
+
+    @classmethod
+    def build(cls, proposals: 'Proposals') -> 'ProposalsStats':
+        """Считает статистику по колонкам таблицы предложений."""
+        table = proposals.table
+        items = proposals.proposals
+        routes = {}
+        route_codes = np.fromiter(
+            (routes.setdefault('-'.join(p.segments_airports), len(routes))
+             for p in items), dtype=np.int64, count=len(items))
+        codes = {
+            'carriers': (table.carrier, table.carriers),
+            'routes': (route_codes, tuple(routes)),
+            'segments': (table.segments, None),
+        }
+        groups = {}
+        for name, (group_codes, labels) in codes.items():
+            groups[name] = {}
+            cheapest = first_by_group(group_codes, table.adult_prize)
+            fastest = first_by_group(group_codes, table.duration)
+            for code, (count, cheapest_position) in cheapest.items():
+                label = int(code) if labels is None else labels[code]
+                groups[name][label] = GroupStats(
+                    count=count,
+                    cheapest=Offer.from_proposal(items[cheapest_position]),
+                    fastest=Offer.from_proposal(items[fastest[code][1]]))
+
+        return cls(
+            count=len(items), groups=groups,
+            distributions=_distributions(table))
+
+    @classmethod
+    def merge(cls, parts: Iterable['ProposalsStats'],
+              proposals: 'Proposals') -> 'ProposalsStats':
+        """Статистика объединения наборов предложений (Proposals.concat).
+
+        Лучшие предложения групп берутся из статистики частей.
+        Перцентили не складываются, поэтому распределения считаются
+        по колонкам общей таблицы.
+        """
+        parts = list(parts)
+        groups = {}
+        for name in STATS_GROUPS:
+            collected = {}
+            for part in parts:
+                for label, item in part.groups[name].items():
+                    collected.setdefault(label, []).append(item)
+            groups[name] = {
+                label: GroupStats.merge(items)
+                for label, items in collected.items()}
+
+        return cls(
+            count=sum(part.count for part in parts), groups=groups,
+            distributions=_distributions(proposals.table))
+
+    def dump(self) -> dict:
+        result = {
+            name: {
+                str(label): item.dump() for label, item in items.items()}
+            for name, items in self.groups.items()}
+        result.update(self.distributions)
+        result['count'] = self.count
+
+        return result
+
+
+def dump_offer(proposal: Union['Offer', 'Proposal']) -> dict:
+    """Краткое описание предложения в статистике."""
+    return {
+        'uuid': str(proposal.uuid),
+        'adult_prize': minor2decimal(proposal.adult_prize, PRICE_EXPONENT),
+        'duration': proposal.duration,
+        'segments_airports': list(proposal.segments_airports),
+    }
+
+
+def first_by_group(codes: np.ndarray,
+                   values: np.ndarray) -> Dict[int, tuple]:
+    """Возвращает {код группы: (размер группы, позиция предложения
+    с минимальным значением)}. При равенстве берется меньшая позиция."""
+    if not len(codes):
+        return {}
+
+    # lexsort стабилен: внутри группы по значению, затем по позиции.
+    order = np.lexsort((values, codes))
+    group_codes, starts, counts = np.unique(
+        codes[order], return_index=True, return_counts=True)
+
+    return {
+        code: (int(count), int(position))
+        for code, count, position in zip(
+            group_codes.tolist(), counts, order[starts])}
+
+
+def _distributions(table: 'ProposalsTable') -> Dict[str, dict]:
+    """Распределения цен для взрослого и длительностей перелета."""
+    scale = 10 ** PRICE_EXPONENT
+    return {
+        'adult_prize': _distribution(
+            table.adult_prize, [edge * scale for edge in STATS_PRICE_EDGES],
+            scale),
+        'duration': _distribution(table.duration, STATS_DURATION_EDGES),
+    }
+
+
+def _distribution(values: np.ndarray, edges: List[int],
+                  scale: int = 1) -> dict:
+    """Минимум, максимум, перцентили и гистограмма значений.
+
+    Гистограмма - количества значений в интервалах [edges[i], edges[i + 1]),
+    последний интервал не ограничен сверху. Перцентили берутся
+    из самих значений без интерполяции.
+    """
+    def convert(value):
+        value = int(value)
+        return value if scale == 1 else minor2decimal(value, PRICE_EXPONENT)
+
+    counts = np.bincount(
+        np.searchsorted(edges, values, side='right'),
+        minlength=len(edges) + 1)
+    result = {
+        'histogram': {
+            'edges': [convert(edge) for edge in edges],
+            # Значения меньше первой границы попадают в первый интервал.
+            'counts': [int(counts[0] + counts[1])] + counts[2:].tolist(),
+        },
+    }
+    if not len(values):
+        return result
+
+    percentiles = np.percentile(values, STATS_PERCENTILES, **PERCENTILE_LOWER)
+    result.update(
+        min=convert(values.min()),
+        max=convert(values.max()),
+        percentiles={
+            f'p{q:02d}': convert(value)
+            for q, value in zip(STATS_PERCENTILES, percentiles)},
+    )
+
+    return result
@@ -1,77 +1,227 @@
+import fcntl
+import glob
 import logging
+import multiprocessing
+import os
 import sys
+import threading
+import time
 import uuid
-from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import groupby, islice
 from operator import itemgetter
-from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List, Tuple, Union
 
-from config import RS_VIA_3_XML, RS_VIA_OW_XML, VIA_3_KEY, VIA_OW_KEY
+import numpy as np
+
+from config import (
+    ALL_KEY, LAZY_BUILD_CHUNK, LAZY_PROPOSALS, LOAD_CHUNK, LOAD_QUEUE_CHUNKS,
+    LOAD_WORKERS, PRERENDER_JSON, RETENTION_MAX_AGE, RETENTION_MAX_BYTES,
+    RETENTION_MAX_SOURCES, SHARED_MEMORY, SNAPSHOT_PATH, SOURCES_GLOB)
+from cursors import query_digest
+from lazy import LazyProposals, SourceFile
+from metrics import (
+    STORAGE_EVICTIONS, STORAGE_LOAD_SECONDS, STORAGE_MEMORY_BYTES)
 from models import (
     Pricing, Proposal, Proposals, Carrier, Airport, Flight, Flights,
     PricingTypeEnum)
 from parser import Parser
+from shared import SharedFragments
+from snapshot import fingerprint, load_snapshot, save_snapshot
+from utils import source_file_name, source_key
 
 
-class Storage:
-    """Хранилище."""
-    def __init__(self):
-        self.logger = logging.getLogger()
-        self._proposals = {}
-        self._airports = {}
-        self._carriers = {}
+def discover_sources(pattern: str = SOURCES_GLOB) -> Dict[str, str]:
+    """Возвращает словарь {ключ источника: путь к файлу} по шаблону."""
+    return {source_key(path): path for path in glob.glob(pattern)}
 
-    def load(self) -> None:
-        """Загружает данные из xml файлов в хранилище."""
-        # Парсим файл RS_Via-3.xml
-        data = self._parse_xml_file(RS_VIA_3_XML)
-        self._proposals[VIA_3_KEY] = self._create_proposals(data)
-        # Парсим файл RS_ViaOW.xml
-        data = self._parse_xml_file(RS_VIA_OW_XML)
-        self._proposals[VIA_OW_KEY] = self._create_proposals(data)
-        # Объединяем результаты парсинга.
-        proposals = (self._proposals[VIA_3_KEY].proposals +
-                     self._proposals[VIA_OW_KEY].proposals)
-        self._proposals['all'] = Proposals(proposals=proposals)
+
+def send_xml_file(file_path: str, queue: 'multiprocessing.Queue') -> None:
+    """Парсит xml файл в дочернем процессе и передает данные в очередь.
+
+    Сначала передается заголовок ответа, затем предложения порциями по
+    LOAD_CHUNK штук. Очередь ограничена, поэтому парсинг приостанавливается,
+    пока основной процесс не разберет уже переданные порции.
+    """
+    try:
+        data = Parser.parse_stream(file_path)
+        proposals = data.pop('proposals')
+        queue.put(('header', data))
+        while True:
+            chunk = list(islice(proposals, LOAD_CHUNK))
+            if not chunk:
+                break
+            queue.put(('chunk', chunk))
+    except Exception as e:
+        queue.put(('error', e))
+    else:
+        queue.put(('end', None))
+
+
+def receive_xml_file(queue: 'multiprocessing.Queue') -> dict:
+    """Принимает из очереди данные, переданные send_xml_file.
+
+    Возвращает словарь того же вида, что и Parser.parse_stream: предложения
+    в ключе 'proposals' генерируются по мере получения порций.
+    """
+    kind, data = queue.get()
+    if kind == 'error':
+        raise data
+
+    def proposals():
+        while True:
+            kind, chunk = queue.get()
+            if kind == 'error':
+                raise chunk
+            if kind == 'end':
+                return
+            yield from chunk
+
+    data['proposals'] = proposals()
+
+    return data
+
+
+@dataclass(frozen=True)
+class StorageState:
+    """Неизменяемое состояние хранилища.
+
+    Содержит все предложения с индексами и агрегатами. При перезагрузке
+    данных строится новое состояние и подменяется одной операцией
+    присваивания, поэтому запрос, взявший состояние в начале обработки,
+    до конца работает с согласованными данными без блокировок.
+    """
+    # Версия данных, увеличивается при каждой загрузке.
+    version: int
+    # Предложения по ключам источников и общий набор под ключом ALL_KEY.
+    proposals: Dict[str, 'Proposals']
+    # Подписи исходных файлов {ключ источника: (путь, размер, mtime)}.
+    files: Dict[str, tuple]
+
+    @property
+    def generation(self) -> str:
+        """Идентификатор данных.
+
+        В отличие от version, одинаков во всех процессах, загрузивших
+        одни и те же файлы, поэтому подходит для курсоров, которые
+        клиент может прислать в другой воркер.
+        """
+        return query_digest(sorted(self.files.items()))
 
     def get_all_proposals(self) -> 'Proposals':
         """Возвращает все предложения о перелетах."""
-        return self._proposals['all']
+        return self.proposals[ALL_KEY]
 
-    def get_proposals(self) -> 'Proposals':
-        """Возвращает все предложения о перелетах."""
-        return self._proposals
+    def get_proposals(self) -> Dict[str, 'Proposals']:
+        """Возвращает предложения о перелетах по источникам."""
+        return self.proposals
+
+    @property
+    def memory_bytes(self) -> int:
+        """Оценка памяти предложений и индексов в байтах.
+
+        Предложения и фрагменты общего набора - те же, что у источников,
+        поэтому у него учитываются только таблица и индексы.
+        """
+        result = 0
+        for key, item in self.proposals.items():
+            result += item.index_bytes
+            if key != ALL_KEY:
+                result += item.data_bytes
+
+        return result
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """Ограничения хранилища, None - без ограничения.
+
+    Сверх ограничений вытесняются самые старые источники по времени
+    ответа поставщика (источники без него считаются самыми старыми).
+    """
+    # Максимальный возраст данных в секундах.
+    max_age: float = RETENTION_MAX_AGE
+    # Максимальное количество источников.
+    max_sources: int = RETENTION_MAX_SOURCES
+    # Бюджет памяти предложений и индексов в байтах
+    # (см. StorageState.memory_bytes).
+    max_bytes: int = RETENTION_MAX_BYTES
+
+
+def file_signatures(sources: Dict[str, str]) -> Dict[str, tuple]:
+    """Возвращает подписи файлов для быстрой проверки изменений."""
+    result = {}
+    for key, path in sources.items():
+        stat = os.stat(path)
+        result[key] = (path, stat.st_size, stat.st_mtime_ns)
+
+    return result
+
+
+def snapshot_settings() -> dict:
+    """Настройки, от которых зависит состав состояния в снимке.
+
+    Снимок, сохраненный с другими значениями, считается устаревшим.
+    """
+    return {
+        'lazy_proposals': LAZY_PROPOSALS,
+        'prerender_json': PRERENDER_JSON,
+        'shared_memory': SHARED_MEMORY,
+    }
+
+
+# Таблицы интернирования объектов предложений (см. ProposalsBuilder).
+INTERN_TABLES = ('_airports', '_carriers', '_flights', '_pricing', '_strings')
 
-    def _parse_xml_file(self, file_path: str) -> dict:
-        """Парсит xml и возвращает словарь с данными."""
-        try:
-            content = Path(file_path).read_text()
-        except FileNotFoundError:
-            self.logger.error(f'Файл {file_path} не найден.')
-            sys.exit()
 
-        return Parser.parse(content)
+class ProposalsBuilder:
+    """Создание объектов предложений из результатов парсинга."""
+    def __init__(self) -> None:
+        # Таблицы интернирования: одинаковые объекты разных предложений
+        # хранятся в одном экземпляре.
+        self._airports = {}
+        self._carriers = {}
+        self._flights = {}
+        self._pricing = {}
+        self._strings = {}
+        # Счетчики ссылок на объекты таблиц интернирования
+        # {имя таблицы: {ключ: количество наборов источников}}
+        # и наборы, которые их держат (см. _acquire_interned).
+        self._interned_refs = {name: {} for name in INTERN_TABLES}
+        self._interned_sources = []
+
+    def _create_proposals(self, data: dict,
+                          source: str = '') -> 'Proposals':
+        """Создает экземпляр Proposals на основе данных из словаря.
 
-    def _create_proposals(self, data: dict) -> 'Proposals':
-        """Создает экземпляр Proposals на основе данных из словаря."""
-        proposals = []
-        for p_dct in data['proposals']:
-            onward_flights = self._create_flights(p_dct['onward'])
-            returned_flights = self._create_flights(p_dct['returned'])
-            pricing = self._create_pricing(p_dct['pricing'])
+        Предложения берутся из data['proposals'], который может быть
+        генератором, так что промежуточный список словарей не создается.
+        """
+        proposals = [
+            self._create_proposal(p_dct, source, uuid.uuid4())
+            for p_dct in data['proposals']]
 
-            flights = Flights(
-                onward=onward_flights,
-                returned=returned_flights)
+        return Proposals(
+            proposals=proposals, response_time=data.get('response_time'))
 
-            proposal = Proposal(
-                uuid=uuid.uuid4(),
-                flights=flights,
-                pricing=pricing)
+    def _create_proposal(self, data: dict, source: str,
+                         proposal_uuid: uuid.UUID) -> 'Proposal':
+        """Создает экземпляр Proposal на основе данных из словаря."""
+        onward_flights = self._create_flights(data['onward'])
+        returned_flights = self._create_flights(data['returned'])
+        pricing = self._create_pricing(data['pricing'])
 
-            proposals.append(proposal)
+        flights = Flights(
+            onward=onward_flights,
+            returned=returned_flights)
 
-        return Proposals(proposals=proposals)
+        return Proposal(
+            uuid=proposal_uuid,
+            flights=flights,
+            pricing=pricing,
+            source=source)
 
     def _create_carrier(self, carrier_id: str, name: str) -> 'Carrier':
         """Создает экземпляр Carrier."""
@@ -87,8 +237,15 @@ class Storage:
 
         return airport
 
-    def _create_flights(self, data: List[dict]) -> List['Flight']:
-        """Создает список экземпляров Flight на основе данных из словаря."""
+    def _intern_string(self, value: str) -> str:
+        """Возвращает общий экземпляр строки."""
+        return self._strings.setdefault(value, value)
+
+    def _create_flights(self, data: List[dict]) -> Tuple['Flight', ...]:
+        """Создает кортеж экземпляров Flight на основе данных из словаря.
+
+        Одинаковые сегменты интернируются в self._flights.
+        """
         flights = []
         for f_dct in data:
             # Перевозчик.
@@ -98,8 +255,8 @@ class Storage:
                     carrier_id=f_dct['carrier_id'],
                     name=f_dct['carrier'])
             # Аэропорты.
-            source = self._carriers.get(f_dct['source'])
-            destination = self._carriers.get(f_dct['destination'])
+            source = self._airports.get(f_dct['source'])
+            destination = self._airports.get(f_dct['destination'])
             if source is None:
                 source = self._create_airport(code=f_dct['source'])
             if destination is None:
@@ -115,16 +272,19 @@ class Storage:
                 arrival_timestamp=f_dct['arrival_timestamp'],
                 trip_class=f_dct['trip_class'],
                 number_of_stops=f_dct['number_of_stops'],
-                fare_basis=f_dct['fare_basis'],
-                warning_text=f_dct['warning_text'] or '',
+                fare_basis=self._intern_string(f_dct['fare_basis']),
+                warning_text=self._intern_string(f_dct['warning_text'] or ''),
                 ticket_type=f_dct['ticket_type'])
 
-            flights.append(flight)
+            flights.append(self._flights.setdefault(flight, flight))
 
-        return flights
+        return tuple(flights)
 
-    def _create_pricing(self, data: dict) -> List['Pricing']:
-        """Создает список экземпляров Pricing на основе данных из словаря."""
+    def _create_pricing(self, data: dict) -> Tuple['Pricing', ...]:
+        """Создает кортеж экземпляров Pricing на основе данных из словаря.
+
+        Одинаковые ценообразования интернируются в self._pricing.
+        """
         type_mapper = {
             'SingleAdult': PricingTypeEnum.SINGLE_ADULT,
             'SingleInfant': PricingTypeEnum.SINGLE_CHILD,
@@ -143,11 +303,734 @@ class Storage:
         for type_, group in groupby(charges, key=key):
             params = {
                 'type': type_mapper.get(type_),
+                'currency': data['currency'],
+                'base_fare': 0,
+                'taxes': 0,
+                'total_amount': 0,
             }
             for charge in group:
                 charge_type_key = charge_type_mapper.get(charge['charge_type'])
                 params[charge_type_key] = charge['sum']
-            result.append(Pricing(**params))
+            pricing = Pricing(**params)
+            result.append(self._pricing.setdefault(pricing, pricing))
+
+        return tuple(result)
+
+    @staticmethod
+    def _interned_keys(proposals: List['Proposal']) -> Dict[str, set]:
+        """Возвращает ключи таблиц интернирования, используемые
+        предложениями, {имя таблицы: ключи}."""
+        flights = set()
+        pricing = set()
+        for proposal in proposals:
+            flights.update(proposal.flights.onward)
+            flights.update(proposal.flights.returned)
+            pricing.update(proposal.pricing)
+
+        return {
+            '_airports': {
+                airport.code for flight in flights
+                for airport in (flight.source, flight.destination)},
+            '_carriers': {flight.carrier.carrier_id for flight in flights},
+            '_flights': flights,
+            '_pricing': pricing,
+            '_strings': {
+                value for flight in flights
+                for value in (flight.fare_basis, flight.warning_text)},
+        }
+
+    def _acquire_interned(self, item: 'Proposals') -> None:
+        """Учитывает ссылки набора источника на объекты таблиц
+        интернирования.
+
+        Каждый набор учитывается один раз, сколько бы его предложений
+        ни ссылались на объект. Ленивые наборы таблицы не заполняют.
+        """
+        if isinstance(item.proposals, LazyProposals):
+            return
+
+        for name, keys in self._interned_keys(item.proposals).items():
+            refs = self._interned_refs[name]
+            for key in keys:
+                refs[key] = refs.get(key, 0) + 1
+        self._interned_sources.append(item)
+
+    def _release_interned(self, item: 'Proposals') -> None:
+        """Снимает ссылки набора источника и убирает из таблиц
+        интернирования объекты, на которые больше никто не ссылается."""
+        for name, keys in self._interned_keys(item.proposals).items():
+            refs = self._interned_refs[name]
+            table = getattr(self, name)
+            for key in keys:
+                count = refs[key] - 1
+                if count:
+                    refs[key] = count
+                else:
+                    del refs[key]
+                    table.pop(key, None)
+
+    def _drop_unreferenced(self) -> None:
+        """Убирает из таблиц интернирования объекты без ссылок,
+        которые остались от недостроенного набора."""
+        for name in INTERN_TABLES:
+            refs = self._interned_refs[name]
+            setattr(self, name, {
+                key: value for key, value in getattr(self, name).items()
+                if key in refs})
+
+
+def decode_proposal(element: bytes, source: str,
+                    proposal_uuid: uuid.UUID) -> 'Proposal':
+    """Создает предложение из байтов тэга Flights (см. lazy.py).
+
+    Объекты предложения не интернируются в таблицы хранилища: они живут,
+    пока предложение лежит в кэше ленивого набора.
+    """
+    return ProposalsBuilder()._create_proposal(
+        Parser.parse_proposal(element), source, proposal_uuid)
+
+
+def build_lazy_proposals(source: str, path: str,
+                         response_time: datetime = None) -> 'Proposals':
+    """Строит ленивый набор предложений (LAZY_PROPOSALS) по xml файлу path.
+
+    Файл отображается в память, и предложения разбираются прямо из тэгов
+    Flights по их границам (см. SourceFile.spans) порциями
+    по LAZY_BUILD_CHUNK: по объектам порции строятся таблица, индексы
+    фильтрации и маршрутов и статистика, после чего объекты отпускаются,
+    а от порции остаются ссылки на тэги. Порции склеиваются так же, как
+    наборы источников в общий набор (см. Proposals.concat), поэтому
+    в памяти одновременно находятся объекты только одной порции.
+    """
+    file = SourceFile(path, source)
+    spans = file.spans()
+    parts = []
+    # Пустой файл дает одну пустую порцию, и набор остается ленивым.
+    for start in range(0, len(spans) or 1, LAZY_BUILD_CHUNK):
+        chunk_spans = spans[start:start + LAZY_BUILD_CHUNK]
+        # Таблицы интернирования и мемоизации общие только внутри порции.
+        builder = ProposalsBuilder()
+        memo = Parser.new_memo()
+        chunk = [
+            builder._create_proposal(
+                Parser.parse_proposal(file.element(begin, end), memo),
+                source, uuid.uuid4())
+            for begin, end in chunk_spans.tolist()]
+        eager = Proposals(proposals=chunk)
+        part = Proposals(proposals=LazyProposals.from_file(
+            file, [p.uuid for p in chunk], decode_proposal,
+            spans=chunk_spans))
+        for name in ('table', 'filter_index', 'route_index', 'stats'):
+            part.__dict__[name] = getattr(eager, name)
+        parts.append(part)
+
+    result = Proposals.concat(parts, response_time=response_time)
+    result.build_indexes()
+
+    return result
+
+
+def build_lazy_file(file_path: str, source: str) -> 'Proposals':
+    """Строит ленивый набор предложений по xml файлу.
+
+    Используется в дочерних процессах: в основной процесс передаются
+    только таблица, индексы и границы тэгов, а файл отображается в память
+    заново при распаковке (см. SourceFile). Из заголовка файла читается
+    только время ответа, предложения разбираются по границам тэгов.
+    """
+    response_time = Parser.parse_stream(file_path)['response_time']
+
+    return build_lazy_proposals(source, file_path, response_time)
+
+
+class Storage(ProposalsBuilder):
+    """Хранилище."""
+    # Атрибуты, которые сохраняются в снимок хранилища.
+    snapshot_attrs = (
+        '_state', '_airports', '_carriers', '_flights', '_pricing',
+        '_strings', '_interned_refs', '_interned_sources', '_evicted',
+    )
+
+    def __init__(self, sources: Dict[str, str] = None,
+                 workers: int = LOAD_WORKERS,
+                 snapshot_path: Union[str, None] = SNAPSHOT_PATH,
+                 pattern: str = SOURCES_GLOB,
+                 retention: 'RetentionPolicy' = None):
+        """
+        sources - словарь {ключ источника: путь к xml файлу},
+            по умолчанию файлы ищутся по шаблону pattern.
+        workers - количество процессов для парсинга файлов.
+        snapshot_path - путь к бинарному снимку хранилища,
+            None - не использовать снимок.
+        retention - политика хранения, по умолчанию из настроек.
+        """
+        self.logger = logging.getLogger()
+        self._sources = sources
+        self._pattern = pattern
+        self._workers = workers
+        self._snapshot_path = snapshot_path
+        self._retention = retention or RetentionPolicy()
+        self._state = StorageState(version=0, proposals={}, files={})
+        super().__init__()
+        # Подписи файлов вытесненных источников {ключ: подпись}.
+        # Пока файл не изменился, источник повторно не загружается.
+        self._evicted = {}
+        # Перезагрузки выполняются по одной.
+        self._reload_lock = threading.Lock()
+        # Фоновая проверка изменений файлов.
+        self._watch_interval = None
+        self._watcher_pid = None
+        self._watcher_lock = threading.Lock()
+        # Файл с блокировкой ведущего процесса (см. _is_leader)
+        # и подпись последнего снимка, который проверил ведомый.
+        self._leader_file = None
+        self._leader_pid = None
+        self._followed_snapshot = None
+        # Отпечаток исходных файлов последнего загруженного
+        # или сохраненного снимка (см. snapshot.fingerprint).
+        self._fingerprint = ()
+
+    @property
+    def state(self) -> 'StorageState':
+        """Текущее состояние хранилища.
+
+        Запрос должен взять состояние один раз и дальше работать с ним.
+        """
+        if self._watch_interval and self._watcher_pid != os.getpid():
+            self._start_watcher()
+
+        return self._state
+
+    @property
+    def version(self) -> int:
+        """Версия данных текущего состояния."""
+        return self._state.version
+
+    def get_all_proposals(self) -> 'Proposals':
+        """Возвращает все предложения о перелетах."""
+        return self.state.get_all_proposals()
+
+    def get_proposals(self) -> Dict[str, 'Proposals']:
+        """Возвращает предложения о перелетах по источникам."""
+        return self.state.get_proposals()
+
+    def load(self) -> None:
+        """Загружает данные из xml файлов в хранилище.
+
+        Если есть актуальный снимок хранилища, данные берутся из него.
+        Иначе файлы парсятся параллельно, а результаты объединяются
+        в порядке ключей источников, поэтому порядок предложений не зависит
+        от того, какой процесс закончил работу первым. После парсинга
+        снимок пересохраняется.
+        """
+        with self._reload_lock:
+            sources = self._discover_sources()
+            start = time.perf_counter()
+            try:
+                if self._load_snapshot(sources):
+                    STORAGE_LOAD_SECONDS.observe(
+                        time.perf_counter() - start, source='snapshot')
+                    return
+                self._update(
+                    sources, self._retained_files(file_signatures(sources)))
+                STORAGE_LOAD_SECONDS.observe(
+                    time.perf_counter() - start, source='xml')
+            except FileNotFoundError as e:
+                self.logger.error(f'Файл {e.filename} не найден.')
+                sys.exit()
+
+    def reload(self) -> bool:
+        """Перезагружает данные, если исходные файлы изменились.
+
+        Парсятся только новые и измененные файлы, остальные источники
+        берутся из текущего состояния. Новое состояние публикуется
+        подменой ссылки, текущие запросы дорабатывают со старым.
+        При ошибке остается прежнее состояние.
+
+        Возвращает True, если состояние обновилось.
+        """
+        with self._reload_lock:
+            try:
+                sources = self._discover_sources()
+                files = self._retained_files(file_signatures(sources))
+                if files == self._state.files:
+                    return False
+                start = time.perf_counter()
+                self._update(sources, files)
+                STORAGE_LOAD_SECONDS.observe(
+                    time.perf_counter() - start, source='reload')
+            except Exception:
+                self.logger.exception('Не удалось перезагрузить данные.')
+                return False
+
+        return True
+
+    def follow(self) -> bool:
+        """Подхватывает состояние из снимка, который сохранил ведущий
+        процесс (см. _is_leader), если исходные файлы изменились.
+
+        Файлы не парсятся: состояние берется из снимка, только если
+        он собран по текущим файлам, а уже загруженный снимок повторно
+        не читается. Массивы и JSON-фрагменты отображаются из файла региона
+        снимка, и ведомые процессы делят его страницы (см. shared.py).
+        Пока ведущий процесс не сохранил новый снимок, остается прежнее
+        состояние.
+
+        Возвращает True, если состояние обновилось.
+        """
+        with self._reload_lock:
+            try:
+                sources = self._discover_sources()
+                files = self._retained_files(file_signatures(sources))
+                if files == self._state.files:
+                    return False
+                stat = os.stat(self._snapshot_path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if signature == self._followed_snapshot:
+                    return False
+                start = time.perf_counter()
+                # Снимок может быть еще не собран по текущим файлам или уже
+                # заменен вместе с файлом региона, тогда он читается снова
+                # при следующей проверке.
+                if not self._load_snapshot(sources):
+                    return False
+                self._followed_snapshot = signature
+                STORAGE_LOAD_SECONDS.observe(
+                    time.perf_counter() - start, source='snapshot')
+            except FileNotFoundError:
+                return False
+            except Exception:
+                self.logger.exception('Не удалось загрузить снимок.')
+                return False
+
+        return True
+
+    def enforce_retention(self, save: bool = True) -> bool:
+        """Вытесняет источники, вышедшие за ограничения политики
+        хранения без изменения файлов, например по возрасту.
+
+        save - пересохранить снимок, ведомые процессы его не пишут.
+        Возвращает True, если состояние обновилось.
+        """
+        with self._reload_lock:
+            try:
+                state = self._state
+                if not self._select_evictions(state.proposals):
+                    return False
+                self._publish(dict(state.proposals), dict(state.files))
+                if save:
+                    self._save_snapshot(self._discover_sources())
+            except Exception:
+                self.logger.exception('Не удалось вытеснить данные.')
+                return False
+
+        return True
+
+    def watch(self, interval: float) -> None:
+        """Включает проверку изменений файлов раз в interval секунд.
+
+        Фоновый поток запускается при первом обращении к состоянию
+        в текущем процессе, поэтому под gunicorn --preload он работает
+        в каждом воркере, а не в мастере. Файлы парсит и снимок пишет
+        только один из них - ведущий (см. _is_leader), остальные
+        загружают новое состояние из снимка (см. follow).
+        """
+        self._watch_interval = interval
+
+    def _start_watcher(self) -> None:
+        """Запускает фоновый поток проверки изменений в текущем процессе."""
+        with self._watcher_lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+            thread = threading.Thread(
+                target=self._watch_loop, name='storage-watcher', daemon=True)
+            thread.start()
+
+    def _watch_loop(self) -> None:
+        while True:
+            time.sleep(self._watch_interval)
+            leader = self._is_leader()
+            if leader:
+                self.reload()
+            else:
+                self.follow()
+            self.enforce_retention(save=leader)
+
+    def _is_leader(self) -> bool:
+        """Является ли текущий процесс ведущим.
+
+        Ведущий - процесс, который держит блокировку файла рядом
+        со снимком. Если ведущий воркер завершился, блокировка
+        освобождается, и ее забирает следующий проверяющий процесс.
+        Без снимка процессы не могут обмениваться состоянием, и каждый
+        перезагружает данные сам.
+        """
+        if not self._snapshot_path:
+            return True
+        # Файл, открытый до форка, принадлежит родителю.
+        if self._leader_pid == os.getpid():
+            return True
+
+        file = open(f'{self._snapshot_path}.lock', 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self._leader_file = file
+        self._leader_pid = os.getpid()
+
+        return True
+
+    def _discover_sources(self) -> Dict[str, str]:
+        if self._sources is None:
+            return discover_sources(self._pattern)
+
+        return self._sources
+
+    def _publish(self, proposals: Dict[str, 'Proposals'],
+                 files: Dict[str, tuple]) -> None:
+        """Публикует новое состояние хранилища с учетом политики
+        хранения.
+
+        Ссылки на таблицы интернирования снимаются только с наборов,
+        которые не попали в новое состояние: замененных при перезагрузке
+        и вытесненных источников. Объекты, на которые больше никто
+        не ссылается, убираются из таблиц (см. _release_interned).
+        """
+        proposals, files = self._retain(proposals, files)
+        published = {
+            id(item) for key, item in proposals.items() if key != ALL_KEY}
+        for item in self._interned_sources:
+            if id(item) not in published:
+                self._release_interned(item)
+        self._interned_sources = [
+            item for item in self._interned_sources
+            if id(item) in published]
+        if SHARED_MEMORY:
+            self._share(proposals)
+        self._state = StorageState(
+            version=self._state.version + 1,
+            proposals=proposals,
+            files=files)
+        STORAGE_MEMORY_BYTES.set(self._state.memory_bytes)
+
+    def _retained_files(self, files: Dict[str, tuple]) -> Dict[str, tuple]:
+        """Убирает из подписей файлов вытесненные источники.
+
+        Источник, файл которого изменился или удален, забывается
+        и при следующей загрузке снова попадает в хранилище.
+        """
+        for key, signature in list(self._evicted.items()):
+            if files.get(key) != signature:
+                del self._evicted[key]
+
+        return {
+            key: signature for key, signature in files.items()
+            if key not in self._evicted}
+
+    def _select_evictions(self, proposals: Dict[str, 'Proposals']
+                          ) -> Dict[str, str]:
+        """Возвращает источники, которые нужно вытеснить,
+        {ключ источника: причина}."""
+        policy = self._retention
+        # От самых старых к самым новым.
+        keys = sorted(
+            (key for key in proposals if key != ALL_KEY),
+            key=lambda k: (proposals[k].response_time or datetime.min, k))
+
+        result = {}
+        if policy.max_age is not None:
+            deadline = datetime.now() - timedelta(seconds=policy.max_age)
+            for key in keys:
+                if (proposals[key].response_time or datetime.min) < deadline:
+                    result[key] = 'age'
+        keys = [key for key in keys if key not in result]
+        if policy.max_sources is not None:
+            while len(keys) > policy.max_sources:
+                result[keys.pop(0)] = 'count'
+        if policy.max_bytes is not None:
+            # Индексы источника повторяются в общем наборе.
+            sizes = {
+                key: proposals[key].data_bytes +
+                2 * proposals[key].index_bytes for key in keys}
+            total = sum(sizes.values())
+            # Самый новый источник остается, даже если не влезает в бюджет.
+            while total > policy.max_bytes and len(keys) > 1:
+                key = keys.pop(0)
+                total -= sizes[key]
+                result[key] = 'memory'
 
         return result
 
+    def _retain(self, proposals: Dict[str, 'Proposals'],
+                files: Dict[str, tuple]
+                ) -> Tuple[Dict[str, 'Proposals'], Dict[str, tuple]]:
+        """Применяет политику хранения к собранному состоянию.
+
+        Общий набор не собирается заново: из него убираются предложения
+        вытесненных источников вместе с позициями в индексах
+        (см. Proposals.subset).
+        """
+        evictions = self._select_evictions(proposals)
+        if not evictions:
+            return proposals, files
+
+        keys = sorted(key for key in proposals if key != ALL_KEY)
+        all_proposals = proposals[ALL_KEY]
+        keep = np.ones(len(all_proposals.proposals), dtype=np.bool_)
+        start = 0
+        for key in keys:
+            stop = start + len(proposals[key].proposals)
+            if key in evictions:
+                keep[start:stop] = False
+            start = stop
+
+        remaining = [key for key in keys if key not in evictions]
+        result = {key: proposals[key] for key in remaining}
+        result[ALL_KEY] = all_proposals.subset(
+            keep, parts=[proposals[key] for key in remaining])
+        result[ALL_KEY].build_indexes()
+        files = dict(files)
+        for key, reason in sorted(evictions.items()):
+            signature = files.pop(key, None)
+            if signature is not None:
+                self._evicted[key] = signature
+            STORAGE_EVICTIONS.inc(reason=reason)
+            self.logger.info(f'Источник {key} вытеснен: {reason}.')
+
+        return result, files
+
+    @staticmethod
+    def _share(proposals: Dict[str, 'Proposals']) -> None:
+        """Переносит данные предложений в разделяемую память.
+
+        JSON-фрагменты хранятся один раз в регионе общего набора,
+        наборы источников получают срезы этого региона.
+        """
+        all_proposals = proposals[ALL_KEY]
+        all_proposals.share()
+        fragments = all_proposals.__dict__.get('fragments')
+        if not isinstance(fragments, SharedFragments):
+            fragments = None
+
+        start = 0
+        for key in sorted(proposals):
+            if key == ALL_KEY:
+                continue
+            item = proposals[key]
+            stop = start + len(item.proposals)
+            item.share(
+                None if fragments is None else fragments[start:stop])
+            start = stop
+
+    def _load_snapshot(self, sources: Dict[str, str]) -> bool:
+        """Загружает состояние из бинарного снимка, если он актуален."""
+        if not self._snapshot_path:
+            return False
+
+        result = load_snapshot(
+            self._snapshot_path, sources, snapshot_settings())
+        if result is None:
+            return False
+
+        self._fingerprint, state = result
+        for name in self.snapshot_attrs:
+            if name != '_state':
+                setattr(self, name, state[name])
+        self._publish(state['_state'].proposals, state['_state'].files)
+
+        return True
+
+    def _save_snapshot(self, sources: Dict[str, str]) -> None:
+        if not self._snapshot_path:
+            return
+
+        # Хэши не изменившихся файлов берутся из прошлого отпечатка.
+        self._fingerprint = fingerprint(sources, self._fingerprint)
+        state = {name: getattr(self, name) for name in self.snapshot_attrs}
+        save_snapshot(
+            self._snapshot_path, self._fingerprint, snapshot_settings(),
+            state)
+
+    def _update(self, sources: Dict[str, str],
+                files: Dict[str, tuple]) -> None:
+        """Строит и публикует новое состояние.
+
+        Парсятся только файлы, подписи которых отличаются от текущего
+        состояния, остальные источники переиспользуются.
+        """
+        current = self._state
+        keys = sorted(files)
+        changed = [key for key in keys if current.files.get(key) != files[key]]
+
+        proposals = {}
+        paths = [sources[key] for key in changed]
+        if LAZY_PROPOSALS:
+            proposals.update(zip(changed, self._build_lazy_files(
+                paths, changed)))
+        else:
+            parsed = self._parse_xml_files(paths)
+            for key, path, data in zip(changed, paths, parsed):
+                proposals[key] = self._build_proposals(
+                    data, source=key, path=path)
+        for key in keys:
+            if key not in proposals:
+                proposals[key] = current.proposals[key]
+
+        self._publish_sources(proposals, files)
+        self._save_snapshot(sources)
+
+    def ingest(self, source: str, file_path: str) -> None:
+        """Публикует предложения источника, полученные не из файла
+        хранилища, а через POST /searches/{source}.
+
+        file_path - временный файл с исходным xml, проверенным при приеме
+        запроса. Предложения строятся до того, как файл переносится
+        на место файла источника (см. source_path), поэтому данные,
+        которые не удалось опубликовать, не остаются в каталоге
+        источников. При ошибке файл удаляется. Данные переживают
+        перезапуск, а другие процессы подхватывают их при проверке
+        изменений файлов. Подпись файла попадает в состояние, и этот
+        процесс повторно его не парсит.
+        """
+        with self._reload_lock:
+            start = time.perf_counter()
+            path = self.source_path(source)
+            try:
+                item = self._build_proposals(
+                    Parser.parse_stream(file_path), source=source,
+                    path=file_path)
+                if not len(item.proposals):
+                    raise ValueError(f'Источник {source}: нет предложений.')
+            except Exception:
+                os.remove(file_path)
+                raise
+
+            os.replace(file_path, path)
+            previous_sources = self._sources
+            try:
+                if isinstance(item.proposals, LazyProposals):
+                    item.proposals.files[0].move(path)
+                if self._sources is not None:
+                    self._sources = dict(self._sources, **{source: path})
+
+                proposals = {
+                    key: value for key, value in self._state.proposals.items()
+                    if key != ALL_KEY}
+                proposals[source] = item
+                files = dict(self._state.files)
+                files.update(file_signatures({source: path}))
+                self._evicted.pop(source, None)
+                self._publish_sources(proposals, files)
+            except Exception:
+                self._sources = previous_sources
+                os.remove(path)
+                raise
+            self._save_snapshot(self._discover_sources())
+            STORAGE_LOAD_SECONDS.observe(
+                time.perf_counter() - start, source='ingest')
+
+    def source_path(self, source: str) -> str:
+        """Путь к xml файлу источника: текущий, если источник загружен
+        из файла, иначе новый файл рядом с файлами источников."""
+        path = self._discover_sources().get(source)
+        if path is None:
+            path = os.path.join(
+                os.path.dirname(self._pattern), source_file_name(source))
+
+        return path
+
+    def _build_proposals(self, data: dict, source: str,
+                         path: str) -> 'Proposals':
+        """Создает предложения источника с индексами.
+
+        path - xml файл, из которого разобраны данные. В ленивом режиме
+        (LAZY_PROPOSALS) объекты всех предложений сразу не создаются,
+        а предложения разбираются из файла при обращении
+        (см. build_lazy_proposals).
+        """
+        if LAZY_PROPOSALS:
+            return build_lazy_proposals(
+                source, path, data.get('response_time'))
+
+        try:
+            item = self._create_proposals(data, source=source)
+        except Exception:
+            self._drop_unreferenced()
+            raise
+        # Ссылки снимаются при публикации, если набор в нее не попал.
+        self._acquire_interned(item)
+        # Индексы сортировки строим при загрузке, а не на запросах.
+        item.build_indexes()
+        if PRERENDER_JSON:
+            item.render_fragments()
+
+        return item
+
+    def _publish_sources(self, proposals: Dict[str, 'Proposals'],
+                         files: Dict[str, tuple]) -> None:
+        """Собирает общий набор из наборов источников и публикует
+        новое состояние."""
+        keys = sorted(proposals)
+        # Объединяем результаты парсинга.
+        proposals[ALL_KEY] = Proposals.concat(
+            proposals[key] for key in keys)
+        proposals[ALL_KEY].build_indexes()
+
+        self._publish(proposals, files)
+
+    def _parse_xml_files(self, file_paths: List[str]) -> Iterator[dict]:
+        """Парсит xml файлы и генерирует словари с данными в том же порядке.
+
+        Если файлов несколько, они парсятся в дочерних процессах, не более
+        workers одновременно. Предложения передаются в основной процесс
+        порциями через ограниченные очереди (см. send_xml_file), поэтому
+        ни дочерний, ни основной процесс не держат файл целиком. Процессы
+        завершаются до окончания загрузки, так что под gunicorn --preload
+        воркеры форкаются уже без них.
+        """
+        workers = min(self._workers, len(file_paths))
+        if workers <= 1:
+            for file_path in file_paths:
+                yield Parser.parse_stream(file_path)
+            return
+
+        context = multiprocessing.get_context()
+        started = []
+        try:
+            for index in range(len(file_paths)):
+                # Предыдущий файл уже разобран, его процесс завершается.
+                if index:
+                    started[index - 1][0].join()
+                while len(started) < min(index + workers, len(file_paths)):
+                    queue = context.Queue(maxsize=LOAD_QUEUE_CHUNKS)
+                    process = context.Process(
+                        target=send_xml_file,
+                        args=(file_paths[len(started)], queue), daemon=True)
+                    process.start()
+                    started.append((process, queue))
+                yield receive_xml_file(started[index][1])
+        finally:
+            for process, queue in started:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                queue.close()
+
+    def _build_lazy_files(self, file_paths: List[str],
+                          keys: List[str]) -> Iterator['Proposals']:
+        """Строит ленивые наборы предложений файлов в том же порядке.
+
+        Как и при обычной загрузке, несколько файлов обрабатываются в пуле
+        процессов, но из дочерних процессов возвращаются уже построенные
+        наборы без объектов предложений (см. build_lazy_file).
+        """
+        workers = min(self._workers, len(file_paths))
+        if workers <= 1:
+            yield from map(build_lazy_file, file_paths, keys)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(build_lazy_file, file_paths, keys)
@@ -1,14 +1,76 @@
+import gzip
+import json
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import types
 import unittest
+import unittest.mock
+import xml.etree.ElementTree as ET
+from dataclasses import replace
+from datetime import datetime
+from decimal import Decimal
+from operator import attrgetter, methodcaller
+from pathlib import Path
 
+import falcon
+import numpy as np
 from falcon import testing
 
 import app
+import bench
+import datagen
+import metrics
+from cache import ResponseCache
+from columns import top_k
+from config import RS_VIA_3_XML, RS_VIA_OW_XML, VIA_3_KEY, VIA_OW_KEY
+from filters import ProposalsFilter
+from ingest import IngestQueue
+from lazy import LazyProposals
+from models import OptimalityWeights, Proposals, compare_proposals
+from parser import Parser
+from resources import SearchesResource
+from shared import SharedFragments
+from stats import ProposalsStats
+from storage import RetentionPolicy, Storage, discover_sources
+from schemas import ProposalSchema, dump_proposal_json
+from utils import (
+    PRICE_EXPONENT, DateFormat, jsonify, str2date, str2minor, str2timestamp)
 
 
 class BaseTestCase(testing.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Снимок хранилища и файлы метрик пишутся во временный каталог,
+        # а не в каталог данных и общий каталог метрик. Фоновый сброс
+        # метрик не запускается, чтобы он не писал в каталог после тестов.
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.patches = [
+            unittest.mock.patch.object(
+                metrics.REGISTRY, 'directory', cls.tmp_dir),
+            unittest.mock.patch.object(
+                metrics.REGISTRY, 'flush_interval', 0),
+        ]
+        for patch in cls.patches:
+            patch.start()
+        # Хранилище загружается один раз на все тесты.
+        cls.storage = Storage(
+            snapshot_path=os.path.join(cls.tmp_dir, 'storage.snapshot'))
+        cls.storage.load()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in reversed(cls.patches):
+            patch.stop()
+        shutil.rmtree(cls.tmp_dir)
+        super().tearDownClass()
+
     def setUp(self):
         super().setUp()
-        self.app = app.get_app()
+        self.app = app.create_app(self.storage)
 
 
 class TestApp(BaseTestCase):
@@ -28,6 +90,105 @@ class TestApp(BaseTestCase):
 
         self.assertEqual(result.json, expected)
 
+        # Из равных цен выбирается первое предложение, как у sorted.
+        params['reverse'] = 'true'
+        result = self.simulate_get('/difference', params=params).json
+        self.assertEqual(result['duration_diff'], 280)
+        params['order_by'] = 'child_prize'
+        result = self.simulate_get('/difference', params=params).json
+        self.assertEqual(
+            result['second_segments_airports'], ['DXB', 'KMG', 'BKK'])
+
+    def test_difference_sources(self):
+        params = {'order_by': 'duration', 'reverse': 'true'}
+        default = self.simulate_get('/difference', params=params).json
+        params.update(sources=f'{VIA_OW_KEY},{VIA_3_KEY}')
+        swapped = self.simulate_get('/difference', params=params).json
+
+        self.assertEqual(swapped['duration_diff'], -default['duration_diff'])
+        self.assertEqual(
+            swapped['first_segments_airports'],
+            default['second_segments_airports'])
+
+        params.update(pairwise='true')
+        result = self.simulate_get('/difference', params=params).json
+        self.assertEqual(result[VIA_3_KEY][VIA_OW_KEY], default)
+        self.assertEqual(result[VIA_OW_KEY][VIA_3_KEY], swapped)
+
+        for sources in (VIA_3_KEY, f'{VIA_3_KEY},unknown'):
+            params.update(sources=sources)
+            result = self.simulate_get('/difference', params=params)
+            self.assertEqual(result.status_code, 400)
+
+    def test_difference_many_sources(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sources = {VIA_3_KEY: RS_VIA_3_XML, VIA_OW_KEY: RS_VIA_OW_XML}
+        for seed in (1, 2):
+            sources[f'synthetic_{seed}'] = os.path.join(
+                tmp_dir, f'RS_Synthetic_{seed}.xml')
+            with open(sources[f'synthetic_{seed}'], 'w') as f:
+                datagen.write(f, proposals=50, seed=seed)
+        storage = Storage(sources, workers=1, snapshot_path=None)
+        storage.load()
+        self.app = app.create_app(storage)
+        keys = ','.join(sources)
+        params = {'order_by': 'adult_prize', 'sources': keys}
+        result = self.simulate_get('/difference', params=params).json
+
+        self.assertEqual(set(result), set(sources) - {VIA_3_KEY})
+        data = storage.get_proposals()
+        for key, difference in result.items():
+            expected = compare_proposals(
+                data[VIA_3_KEY].best('adult_prize'),
+                data[key].best('adult_prize'))
+            self.assertEqual(difference, json.loads(jsonify(expected)))
+
+        params.update(pairwise='true')
+        result = self.simulate_get('/difference', params=params).json
+        self.assertEqual(
+            sum(len(row) for row in result.values()), 4 * 3)
+
+    def test_difference_join(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        # Второй ответ: без первых 10 предложений и дороже на 10.
+        tree = ET.parse(RS_VIA_3_XML)
+        itineraries = tree.getroot().find('PricedItineraries')
+        for proposal in list(itineraries)[:10]:
+            itineraries.remove(proposal)
+        for charge in itineraries.iter('ServiceCharges'):
+            if charge.get('ChargeType') == 'TotalAmount':
+                charge.text = f'{float(charge.text) + 10:.2f}'
+        sources = {
+            'before': RS_VIA_3_XML,
+            'after': os.path.join(tmp_dir, 'RS_After.xml'),
+        }
+        tree.write(sources['after'])
+        storage = Storage(sources, workers=1, snapshot_path=None)
+        storage.load()
+        self.app = app.create_app(storage)
+        params = {'mode': 'join', 'sources': 'before,after'}
+        result = self.simulate_get('/difference', params=params)
+        rows = [json.loads(line) for line in result.text.splitlines()]
+        statuses = [row['status'] for row in rows]
+
+        self.assertEqual(
+            result.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual(statuses.count('matched'), 190)
+        self.assertEqual(statuses.count('removed'), 10)
+        self.assertEqual(statuses.count('added'), 0)
+        for row in rows:
+            if row['status'] == 'matched':
+                self.assertAlmostEqual(row['adult_prize_diff'], 10)
+                self.assertEqual(row['duration_diff'], 0)
+            else:
+                self.assertIn('flights', row['proposal'])
+
+        params.update(sources='before,after,before_missing')
+        result = self.simulate_get('/difference', params=params)
+        self.assertEqual(result.status_code, 400)
+
     def test_proposals(self):
         expected_flights = {
             'onward': [
@@ -90,6 +251,1046 @@ class TestApp(BaseTestCase):
         self.assertEqual(result['flights'], expected_flights)
         self.assertEqual(result['pricing'], expected_pricing)
 
+    def test_proposals_fragments(self):
+        data = self.storage.get_all_proposals()
+        positions = data.order_positions('duration', limit=20)
+        proposals = [data.proposals[i] for i in positions]
+        expected = jsonify(
+            {'proposals': ProposalSchema(many=True).dump(proposals).data},
+            indent=None)
+
+        self.assertEqual(data.to_json(positions), expected.encode())
+
+    def test_proposals_stream(self):
+        params = {'order_by': 'adult_prize', 'source': 'DXB'}
+        expected = self.simulate_get('/proposals', params=params)
+        result = self.simulate_get(
+            '/proposals', params=dict(params, stream='true'))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.headers['x-accel-buffering'], 'no')
+        self.assertNotIn('etag', result.headers)
+        self.assertEqual(result.content, expected.content)
+
+        # Большие ответы отдаются потоком без параметра stream.
+        params['reverse'] = 'true'
+        expected = self.simulate_get(
+            '/proposals', params=dict(params, stream='false'))
+        with unittest.mock.patch('resources.STREAM_MIN_PROPOSALS', 1):
+            result = self.simulate_get('/proposals', params=params)
+        self.assertNotIn('x-accel-buffering', expected.headers)
+        self.assertIn('x-accel-buffering', result.headers)
+        self.assertEqual(result.content, expected.content)
+
+        data = self.storage.get_all_proposals()
+        positions = data.order_positions('duration')
+        for chunk_bytes in (1, 1000, 10 ** 9):
+            chunks = list(data.iter_json(
+                positions, next_link='/proposals?cursor=x',
+                chunk_bytes=chunk_bytes))
+            self.assertEqual(
+                b''.join(chunks),
+                data.to_json(positions, next_link='/proposals?cursor=x'))
+        self.assertEqual(
+            b''.join(data.iter_json([])), data.to_json([]))
+
+    def test_proposals_etag(self):
+        params = {'order_by': 'duration', 'limit': 3}
+        result = self.simulate_get('/proposals', params=params)
+        etag = result.headers['etag']
+        headers = {'If-None-Match': etag}
+        cached = self.simulate_get(
+            '/proposals', params=params, headers=headers)
+
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+
+    def test_proposals_optimality_weights(self):
+        params = {'order_by': 'optimality', 'limit': 5}
+        default = self.simulate_get('/proposals', params=params)
+        params.update(w_price='0.75', w_duration='0.25', adults='1')
+        result = self.simulate_get('/proposals', params=params)
+
+        self.assertEqual(
+            result.json['proposals'], default.json['proposals'])
+
+        params.update(adults='0')
+        result = self.simulate_get('/proposals', params=params)
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_proposals_cursor(self):
+        params = {'order_by': 'duration', 'reverse': 'true'}
+        expected = self.simulate_get('/proposals', params=params).json
+        expected = [p['uuid'] for p in expected['proposals']]
+        # Фильтр пропускает все предложения, но страницы берутся
+        # из отдельно построенного порядка.
+        params.update(limit=50, max_segments=10)
+        result = self.simulate_get('/proposals', params=params).json
+        pages = [result]
+        while 'next' in result:
+            path, query = result['next'].split('?')
+            result = self.simulate_get(path, query_string=query).json
+            pages.append(result)
+        uuids = [p['uuid'] for page in pages for p in page['proposals']]
+
+        self.assertEqual(len(pages), math.ceil(len(expected) / 50))
+        self.assertEqual(uuids, expected)
+
+        # Курсор привязан к параметрам запроса.
+        cursor = pages[0]['next'].split('cursor=')[1]
+        params = {'order_by': 'adult_prize', 'cursor': cursor}
+        result = self.simulate_get('/proposals', params=params)
+        self.assertEqual(result.status_code, 400)
+        params = {'cursor': 'garbage'}
+        result = self.simulate_get('/proposals', params=params)
+        self.assertEqual(result.status_code, 400)
+
+        # После перезагрузки данных курсор устаревает.
+        files = {
+            key: (path, size + 1, mtime)
+            for key, (path, size, mtime) in self.storage.state.files.items()}
+        stale = replace(self.storage.state, files=files)
+        path, query = pages[0]['next'].split('?')
+        with unittest.mock.patch.object(Storage, 'state', stale):
+            result = self.simulate_get(path, query_string=query)
+        self.assertEqual(result.status_code, 410)
+
+    def test_proposals_first_page(self):
+        # Первая страница выбирается как top-k без полного порядка.
+        params = {'order_by': 'optimality', 'w_stops': 1}
+        expected = self.simulate_get('/proposals', params=params).json
+        params['limit'] = 3
+        expected = [p['uuid'] for p in expected['proposals']]
+        with unittest.mock.patch.object(
+                Proposals, 'ordering', side_effect=AssertionError), \
+                unittest.mock.patch(
+                    'models.top_k', wraps=top_k) as spy:
+            result = self.simulate_get('/proposals', params=params).json
+        spy.assert_called_once()
+        self.assertEqual(spy.call_args[0][1], 4)
+        self.assertEqual(
+            [p['uuid'] for p in result['proposals']], expected[:3])
+
+        # Курсор первой страницы продолжается по полному порядку.
+        path, query = result['next'].split('?')
+        result = self.simulate_get(path, query_string=query).json
+        self.assertEqual(
+            [p['uuid'] for p in result['proposals']], expected[3:6])
+
+    def test_proposals_filter(self):
+        params = {
+            'order_by': 'adult_prize',
+            'max_stops': 1,
+            'departure_from': '2018-10-22T0000',
+            'has_return': 'true',
+        }
+        result = self.simulate_get('/proposals', params=params)
+        proposals = result.json['proposals']
+
+        self.assertTrue(proposals)
+        for proposal in proposals:
+            onward = proposal['flights']['onward']
+            self.assertLessEqual(len(onward), 2)
+            self.assertGreaterEqual(
+                onward[0]['departure_timestamp'], '2018-10-22T0000')
+            self.assertTrue(proposal['flights']['returned'])
+        prizes = [
+            float(price['total_amount'])
+            for p in proposals for price in p['pricing']
+            if price['type'] == 'single_adult']
+        self.assertEqual(len(prizes), len(proposals))
+        self.assertEqual(prizes, sorted(prizes))
+
+        params.update(departure_from='2018-10-22')
+        result = self.simulate_get('/proposals', params=params)
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_routes(self):
+        data = self.storage.get_all_proposals()
+
+        def expected(predicate):
+            routes = {}
+            for p in data.proposals:
+                if (p.segments_airports[0] == 'DXB' and
+                        p.segments_airports[-1] == 'BKK' and predicate(p)):
+                    routes.setdefault(tuple(p.segments_airports), []).append(p)
+            scale = 10 ** PRICE_EXPONENT
+            return {
+                route: (len(items),
+                        min(p.adult_prize for p in items) / scale,
+                        min(p.duration for p in items))
+                for route, items in routes.items()}
+
+        def actual(**params):
+            result = self.simulate_get(
+                '/routes', params=dict(params, **{'from': 'DXB', 'to': 'bkk'}))
+            self.assertEqual(result.status_code, 200)
+            return {
+                tuple(item['route']): (
+                    item['count'], item['cheapest']['adult_prize'],
+                    item['fastest']['duration'])
+                for item in result.json['itineraries']}
+
+        self.assertEqual(actual(), expected(lambda p: True))
+        self.assertEqual(
+            actual(via='DOH'),
+            expected(lambda p: 'DOH' in p.segments_airports))
+        self.assertEqual(
+            actual(max_legs='1'),
+            expected(lambda p: len(p.flights.onward) == 1))
+        self.assertEqual(
+            actual(departure_to='2018-10-22T1200'),
+            expected(lambda p: p.flights.onward[0].departure_timestamp <=
+                     datetime(2018, 10, 22, 12)))
+        result = self.simulate_get(
+            '/routes', params={'from': 'DXB', 'to': 'BKK', 'limit': '2'})
+        prizes = [
+            item['cheapest']['adult_prize']
+            for item in result.json['itineraries']]
+        self.assertEqual(len(prizes), 2)
+        self.assertEqual(prizes, sorted(prizes))
+        self.assertEqual(
+            self.simulate_get('/routes', params={'from': 'DXB'}).status_code,
+            400)
+
+        # sources - ключи источников, как у /stats.
+        self.assertEqual(
+            actual(sources=VIA_OW_KEY),
+            expected(lambda p: p.source == VIA_OW_KEY))
+        self.assertEqual(
+            actual(sources=f'{VIA_OW_KEY},{VIA_3_KEY}'),
+            expected(lambda p: True))
+        result = self.simulate_get(
+            '/routes', params={'from': 'DXB', 'to': 'BKK', 'sources': 'DXB'})
+        self.assertEqual(result.status_code, 400)
+
+    def test_stats(self):
+        result = self.simulate_get('/stats')
+        data = self.storage.get_proposals()
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(set(result.json), set(data))
+        stats = result.json['all']
+        self.assertEqual(stats['count'], len(data['all'].proposals))
+        self.assertEqual(
+            sum(item['count'] for item in stats['carriers'].values()),
+            stats['count'])
+        self.assertEqual(
+            sum(stats['adult_prize']['histogram']['counts']), stats['count'])
+
+        # Лучшие предложения совпадают с перебором.
+        for proposal in data['all'].proposals:
+            carrier_id = proposal.flights.onward[0].carrier_id
+            route = '-'.join(proposal.segments_airports)
+            for item in (stats['carriers'][carrier_id],
+                         stats['routes'][route]):
+                self.assertLessEqual(
+                    item['cheapest']['adult_prize'],
+                    proposal.adult_prize / 10 ** PRICE_EXPONENT)
+                self.assertLessEqual(
+                    item['fastest']['duration'], proposal.duration)
+
+        # Статистика общего набора, собранная из источников, совпадает
+        # с посчитанной по всем предложениям.
+        self.assertEqual(
+            data['all'].stats.body,
+            ProposalsStats.build(data['all']).body)
+
+        result = self.simulate_get(
+            '/stats', params={'sources': VIA_OW_KEY})
+        self.assertEqual(list(result.json), [VIA_OW_KEY])
+        result = self.simulate_get('/stats', params={'sources': 'unknown'})
+        self.assertEqual(result.status_code, 400)
+
+    def test_metrics(self):
+        self.simulate_get('/proposals', params={'limit': 1})
+        self.simulate_get('/missing/a1')
+        self.simulate_get('/missing/b2')
+        result = self.simulate_get('/metrics')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(
+            'avia_request_duration_seconds_count{route="/proposals",'
+            'method="GET",status="200"}', result.text)
+        self.assertIn(
+            'avia_stage_duration_seconds_bucket{route="/proposals",'
+            'stage="order",le="+Inf"}', result.text)
+        self.assertIn(
+            'avia_storage_load_duration_seconds_count{source=', result.text)
+        # Пути без ресурса не добавляют новых рядов.
+        self.assertNotIn('/missing', result.text)
+        self.assertIn(
+            'avia_request_duration_seconds_count{route="unmatched",'
+            'method="GET",status="404"}', result.text)
+
+
+class TestSearches(testing.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        shutil.copy(RS_VIA_3_XML, self.tmp_dir)
+        self.storage = Storage(
+            workers=1, snapshot_path=None,
+            pattern=os.path.join(self.tmp_dir, 'RS_*.xml'))
+        self.storage.load()
+        self.ingest = IngestQueue(self.storage, max_size=1)
+        self.app = falcon.API()
+        self.app.add_route(
+            '/searches/{source}',
+            SearchesResource(self.storage, self.ingest))
+
+    def test_post(self):
+        with open(RS_VIA_OW_XML, 'rb') as f:
+            body = f.read()
+        result = self.simulate_post(
+            '/searches/via_ow', body=gzip.compress(body),
+            headers={'Content-Encoding': 'gzip'})
+
+        self.assertEqual(result.status_code, 202)
+        self.assertEqual(
+            result.json, {'source': VIA_OW_KEY, 'proposals': 172})
+
+        self.ingest.join()
+        state = self.storage.state
+        self.assertEqual(len(state.proposals[VIA_OW_KEY].proposals), 172)
+        self.assertEqual(len(state.get_all_proposals().proposals), 372)
+        # Тело сохраняется файлом источника и повторно не парсится.
+        path = os.path.join(self.tmp_dir, 'RS_via_ow.xml')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertFalse(self.storage.reload())
+
+    def test_invalid(self):
+        result = self.simulate_post('/searches/via_ow', body='<Air')
+        self.assertEqual(result.status_code, 400)
+        result = self.simulate_post('/searches/all', body='<a/>')
+        self.assertEqual(result.status_code, 400)
+        result = self.simulate_post('/searches/Via-OW', body='<a/>')
+        self.assertEqual(result.status_code, 400)
+        # Ответ без предложений не публикуется.
+        result = self.simulate_post(
+            '/searches/via_ow', body='<AirFareSearchResponse/>')
+        self.assertEqual(result.status_code, 400)
+        # Предложение без обязательного тэга.
+        result = self.simulate_post(
+            '/searches/via_ow',
+            body='<AirFareSearchResponse><PricedItineraries><Flights>'
+                 '<OnwardPricedItinerary/></Flights></PricedItineraries>'
+                 '</AirFareSearchResponse>')
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(os.listdir(self.tmp_dir), ['RS_Via-3.xml'])
+
+    def test_ingest_failure(self):
+        # Файл, который не удалось опубликовать, удаляется.
+        file_path = os.path.join(self.tmp_dir, '.ingest-test.tmp')
+        Path(file_path).write_text('<AirFareSearchResponse/>')
+        with self.assertRaises(ValueError):
+            self.storage.ingest(VIA_OW_KEY, file_path)
+
+        self.assertEqual(os.listdir(self.tmp_dir), ['RS_Via-3.xml'])
+        self.assertFalse(self.storage.reload())
+
+    def test_queue_full(self):
+        with open(RS_VIA_OW_XML, 'rb') as f:
+            body = f.read()
+        self.assertTrue(self.ingest.reserve())
+        result = self.simulate_post('/searches/via_ow', body=body)
+
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(result.headers['retry-after'], '5')
+
+        self.ingest.release()
+        result = self.simulate_post('/searches/via_ow', body=body)
+        self.assertEqual(result.status_code, 202)
+        self.ingest.join()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.registry = metrics.Registry(tmp_dir, flush_interval=0)
+        self.counter = metrics.Counter(
+            self.registry, 'test_requests', 'Запросы.', ('route',))
+        self.histogram = metrics.Histogram(
+            self.registry, 'test_seconds', 'Время.', buckets=(0.1, 1))
+
+    def test_expose(self):
+        self.counter.inc(route='/a')
+        self.counter.inc(2, route='/a')
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+        lines = self.registry.expose().splitlines()
+
+        self.assertIn('# TYPE test_requests counter', lines)
+        self.assertIn('test_requests_total{route="/a"} 3.0', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', lines)
+        self.assertIn('test_seconds_sum 5.55', lines)
+        self.assertIn('test_seconds_count 3.0', lines)
+
+    def test_processes(self):
+        # Значения другого воркера из его файла суммируются с текущими.
+        self.counter.inc(route='/a')
+        self.registry.flush()
+        os.rename(
+            os.path.join(self.registry.directory, f'{os.getpid()}.json'),
+            os.path.join(self.registry.directory, '1.json'))
+        # После форка унаследованные значения сбрасываются.
+        self.registry._pid = -1
+        self.counter.inc(5, route='/a')
+        self.counter.inc(route='/b')
+        lines = self.registry.expose().splitlines()
+
+        self.assertIn('test_requests_total{route="/a"} 6.0', lines)
+        self.assertIn('test_requests_total{route="/b"} 1.0', lines)
+
+    def test_gauge(self):
+        gauge = metrics.Gauge(self.registry, 'test_bytes', 'Память.')
+        gauge.set(10)
+        self.registry.flush()
+        os.rename(
+            os.path.join(self.registry.directory, f'{os.getpid()}.json'),
+            os.path.join(self.registry.directory, '1.json'))
+        self.registry._pid = -1
+        gauge.set(3)
+        lines = self.registry.expose().splitlines()
+
+        # Значения процессов не складываются.
+        self.assertIn('# TYPE test_bytes gauge', lines)
+        self.assertIn('test_bytes{pid="1"} 10.0', lines)
+        self.assertIn(f'test_bytes{{pid="{os.getpid()}"}} 3.0', lines)
+
+    def test_dead_processes(self):
+        directory = self.registry.directory
+        gauge = metrics.Gauge(self.registry, 'test_bytes', 'Память.')
+        dead = {'test_requests': [[['/a'], [2.0]]], 'test_bytes': [[[], [7]]]}
+        for name in ('999999999.json', f'{os.getpid()}.json'):
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump(dead, f)
+        # Файл со своим pid до первого сброса остался от другого процесса.
+        self.counter.inc(route='/a')
+        gauge.set(3)
+        lines = self.registry.expose().splitlines()
+
+        self.assertIn('test_requests_total{route="/a"} 5.0', lines)
+        self.assertEqual(
+            [line for line in lines if line.startswith('test_bytes{')],
+            [f'test_bytes{{pid="{os.getpid()}"}} 3.0'])
+        self.assertEqual(
+            sorted(name for name in os.listdir(directory)
+                   if name.endswith('.json')),
+            sorted([metrics.AGGREGATE_FILE, f'{os.getpid()}.json']))
+        # Повторный сбор не учитывает перенесенные значения дважды.
+        self.assertEqual(self.registry.expose().splitlines(), lines)
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_stream(self):
+        data = Parser.parse_stream(RS_VIA_3_XML)
+        expected = Parser.parse(Path(RS_VIA_3_XML).read_text())
+
+        self.assertIsInstance(data['proposals'], types.GeneratorType)
+        self.assertEqual(data['request_id'], '123ABCD')
+        self.assertEqual(data['response_time'], expected['response_time'])
+        self.assertEqual(list(data['proposals']), expected['proposals'])
+        self.assertEqual(len(expected['proposals']), 200)
+
+    def test_parse_pricing(self):
+        element = (
+            '<Pricing currency="SGD">'
+            '<ServiceCharges type="SingleAdult" ChargeType="BaseFare">'
+            '{}</ServiceCharges></Pricing>')
+        data = Parser._parse_pricing(ET.fromstring(element.format('546.80')))
+        self.assertEqual(data['service_charges'][0]['sum'], 54680)
+
+        # Некорректная сумма - ошибка, а не нулевая цена.
+        with self.assertRaises(ValueError):
+            Parser._parse_pricing(ET.fromstring(element.format('n/a')))
+
+
+class TestDatagen(unittest.TestCase):
+    def test_generate(self):
+        content = ''.join(datagen.generate(
+            proposals=300, segments=(2, 3), return_ratio=0.5, seed=1))
+        data = Parser.parse(content)
+        proposals = data['proposals']
+        returned = [p for p in proposals if p['returned']]
+
+        self.assertEqual(content, ''.join(datagen.generate(
+            proposals=300, segments=(2, 3), return_ratio=0.5, seed=1)))
+        self.assertEqual(data['request_id'], '123ABCD')
+        self.assertEqual(len(proposals), 300)
+        self.assertTrue(all(2 <= len(p['onward']) <= 3 for p in proposals))
+        self.assertTrue(100 < len(returned) < 200)
+        for proposal in returned:
+            self.assertEqual(
+                proposal['onward'][0]['source'],
+                proposal['returned'][-1]['destination'])
+            self.assertLess(
+                proposal['onward'][-1]['arrival_timestamp'],
+                proposal['returned'][0]['departure_timestamp'])
+
+    def test_compare(self):
+        baseline = {'parse/1000': {'seconds': 1.0, 'peak_bytes': 100}}
+        results = {
+            'parse/1000': {'seconds': 1.1, 'peak_bytes': 200},
+            'parse/10000': {'seconds': 10.0, 'peak_bytes': 1000},
+        }
+        regressions = bench.compare(results, baseline, threshold=0.25)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('peak_bytes', regressions[0])
+
+
+class TestStorage(unittest.TestCase):
+    def test_discover_sources(self):
+        expected = {VIA_3_KEY: RS_VIA_3_XML, VIA_OW_KEY: RS_VIA_OW_XML}
+
+        self.assertEqual(discover_sources(), expected)
+
+    def test_interning(self):
+        storage = Storage(workers=1, snapshot_path=None)
+        storage.load()
+        flights = [
+            flight
+            for p in storage.get_all_proposals().proposals
+            for flight in p.flights.onward + p.flights.returned]
+        airports = {id(f.source) for f in flights}
+        airports |= {id(f.destination) for f in flights}
+
+        self.assertEqual(len({id(f) for f in flights}), len(set(flights)))
+        self.assertEqual(len(airports), len(storage._airports))
+        self.assertFalse(hasattr(flights[0], '__dict__'))
+
+    def test_shared_memory(self):
+        storage = Storage(workers=1, snapshot_path=None)
+        storage.load()
+        data = storage.get_all_proposals()
+        via3 = storage.get_proposals()[VIA_3_KEY]
+        arrays = [
+            data.table.adult_prize, data.indexes['duration'],
+            data.ranks['optimality'], via3.table.departure,
+            data.filter_index.ranges['stops'][1],
+        ]
+
+        for array in arrays:
+            self.assertFalse(array.flags.writeable)
+        self.assertIsInstance(data.fragments, SharedFragments)
+        self.assertEqual(
+            [bytes(f) for f in via3.fragments],
+            [bytes(f) for f in data.fragments[:len(via3.proposals)]])
+        self.assertEqual(
+            bytes(via3.fragment(3)), dump_proposal_json(via3.proposals[3]))
+
+        # В снимок попадают обычные копии данных.
+        copy = pickle.loads(pickle.dumps(data))
+        self.assertEqual(copy.fragments, [bytes(f) for f in data.fragments])
+        self.assertTrue(copy.table.adult_prize.flags.writeable)
+        copy.share()
+        self.assertIsInstance(copy.fragments, SharedFragments)
+
+    def test_snapshot(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        sources = {VIA_3_KEY: os.path.join(tmp_dir, 'RS_Via-3.xml')}
+        shutil.copy(RS_VIA_3_XML, sources[VIA_3_KEY])
+        snapshot_path = os.path.join(tmp_dir, 'storage.snapshot')
+
+        parsed = Storage(sources, workers=1, snapshot_path=snapshot_path)
+        parsed.load()
+        loaded = Storage(sources, workers=1, snapshot_path=snapshot_path)
+        # Хэш не изменившегося файла берется из заголовка снимка.
+        with unittest.mock.patch.object(
+                Storage, '_parse_xml_files') as parse, \
+                unittest.mock.patch('snapshot.file_digest') as digest:
+            loaded.load()
+
+        parse.assert_not_called()
+        digest.assert_not_called()
+        self.assertEqual(
+            loaded.get_all_proposals().proposals,
+            parsed.get_all_proposals().proposals)
+        self.assertEqual(
+            list(loaded.get_all_proposals().indexes['optimality']),
+            list(parsed.get_all_proposals().indexes['optimality']))
+
+        # Изменение исходного файла делает снимок устаревшим.
+        with open(sources[VIA_3_KEY], 'a') as f:
+            f.write('\n')
+        stale = Storage(sources, workers=1, snapshot_path=snapshot_path)
+        with unittest.mock.patch.object(
+                Storage, '_parse_xml_files',
+                wraps=stale._parse_xml_files) as parse:
+            stale.load()
+
+        parse.assert_called_once()
+
+        # Снимок с другими настройками тоже устаревший.
+        with unittest.mock.patch('storage.LAZY_PROPOSALS', True):
+            lazy = Storage(sources, workers=1, snapshot_path=snapshot_path)
+            with unittest.mock.patch.object(
+                    Storage, '_build_lazy_files',
+                    wraps=lazy._build_lazy_files) as build:
+                lazy.load()
+
+        build.assert_called_once()
+        self.assertIsInstance(
+            lazy.get_all_proposals().proposals, LazyProposals)
+
+    def test_reload(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        shutil.copy(RS_VIA_3_XML, tmp_dir)
+        storage = Storage(
+            workers=1, snapshot_path=None,
+            pattern=os.path.join(tmp_dir, 'RS_*.xml'))
+        storage.load()
+        before = storage.state
+        sizes = (len(storage._flights), len(storage._strings))
+
+        self.assertFalse(storage.reload())
+
+        shutil.copy(RS_VIA_OW_XML, tmp_dir)
+
+        self.assertTrue(storage.reload())
+        after = storage.state
+        self.assertEqual(after.version, before.version + 1)
+        self.assertEqual(set(before.proposals), {VIA_3_KEY, 'all'})
+        self.assertEqual(
+            set(after.proposals), {VIA_3_KEY, VIA_OW_KEY, 'all'})
+        # Неизмененный источник не парсится заново.
+        self.assertIs(
+            after.proposals[VIA_3_KEY], before.proposals[VIA_3_KEY])
+        self.assertEqual(len(after.get_all_proposals().proposals), 372)
+
+        # Объекты замененных данных убираются из таблиц интернирования.
+        os.remove(os.path.join(tmp_dir, os.path.basename(RS_VIA_OW_XML)))
+        path = os.path.join(tmp_dir, os.path.basename(RS_VIA_3_XML))
+        for i, source_path in enumerate([RS_VIA_OW_XML, RS_VIA_3_XML] * 2):
+            shutil.copy(source_path, path)
+            os.utime(path, ns=(0, i))
+            self.assertTrue(storage.reload())
+        self.assertEqual(
+            (len(storage._flights), len(storage._strings)), sizes)
+
+        def tables():
+            return {
+                name: set(getattr(storage, name))
+                for name in storage._interned_refs}
+
+        expected = Storage._interned_keys(
+            storage.get_all_proposals().proposals)
+        self.assertEqual(tables(), expected)
+        self.assertEqual(
+            {name: set(refs) for name, refs in storage._interned_refs.items()},
+            expected)
+
+        # Объекты недочитанного файла тоже не остаются в таблицах.
+        with open(RS_VIA_OW_XML, 'rb') as f:
+            content = f.read()
+        with open(os.path.join(tmp_dir, 'RS_Broken.xml'), 'wb') as f:
+            f.write(content[:len(content) // 2])
+        self.assertFalse(storage.reload())
+        self.assertEqual(tables(), expected)
+
+    def test_follow(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        shutil.copy(RS_VIA_3_XML, tmp_dir)
+        params = {
+            'workers': 1,
+            'snapshot_path': os.path.join(tmp_dir, 'storage.snapshot'),
+            'pattern': os.path.join(tmp_dir, 'RS_*.xml')}
+        leader = Storage(**params)
+        leader.load()
+        follower = Storage(**params)
+        follower.load()
+
+        # Блокировку держит только один процесс.
+        self.assertTrue(leader._is_leader())
+        self.addCleanup(leader._leader_file.close)
+        self.assertFalse(follower._is_leader())
+
+        shutil.copy(RS_VIA_OW_XML, tmp_dir)
+        # Пока ведущий не сохранил снимок, состояние прежнее.
+        self.assertFalse(follower.follow())
+        self.assertTrue(leader.reload())
+        with unittest.mock.patch.object(
+                Storage, '_parse_xml_files') as parse:
+            self.assertTrue(follower.follow())
+            self.assertFalse(follower.follow())
+
+        parse.assert_not_called()
+        self.assertEqual(follower.state.files, leader.state.files)
+        self.assertEqual(
+            follower.get_all_proposals().proposals,
+            leader.get_all_proposals().proposals)
+
+        # Ведомый не копирует данные, а отображает файл региона снимка,
+        # файлы регионов прежних снимков удалены.
+        regions = [
+            name for name in os.listdir(tmp_dir) if name.endswith('.region')]
+        self.assertEqual(len(regions), 1)
+        region_size = os.path.getsize(os.path.join(tmp_dir, regions[0]))
+        data = follower.get_all_proposals()
+        via_ow = follower.get_proposals()[VIA_OW_KEY]
+        for array in (data.table.adult_prize, data.reverse_indexes['duration'],
+                      via_ow.table.departure, data.fragments.offsets):
+            base = array
+            while isinstance(base, np.ndarray):
+                base = base.base
+            self.assertEqual(len(base), region_size)
+        self.assertEqual(
+            [bytes(f) for f in via_ow.fragments],
+            [bytes(f) for f in leader.get_proposals()[VIA_OW_KEY].fragments])
+
+    def test_retention(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        shutil.copy(RS_VIA_3_XML, tmp_dir)
+        shutil.copy(RS_VIA_OW_XML, tmp_dir)
+        storage = Storage(
+            workers=1, snapshot_path=None,
+            pattern=os.path.join(tmp_dir, 'RS_*.xml'),
+            retention=RetentionPolicy(max_sources=1))
+        evictions = metrics.STORAGE_EVICTIONS
+        with unittest.mock.patch.object(evictions, 'inc') as inc:
+            storage.load()
+
+        # Ответ via_3 старше, он и вытесняется.
+        inc.assert_called_once_with(reason='count')
+        state = storage.state
+        self.assertEqual(set(state.proposals), {VIA_OW_KEY, 'all'})
+        self.assertEqual(set(state.files), {VIA_OW_KEY})
+        self.assertEqual(
+            state.get_all_proposals().proposals,
+            state.proposals[VIA_OW_KEY].proposals)
+        self.assertEqual(
+            set(storage._airports),
+            {code for p in state.get_all_proposals().proposals
+             for code in p.segments_airports})
+        self.assertGreater(state.memory_bytes, 0)
+        # Файл вытесненного источника не загружается повторно,
+        # пока не изменится.
+        self.assertFalse(storage.reload())
+        self.assertFalse(storage.enforce_retention())
+
+        storage._retention = RetentionPolicy(max_age=0)
+        self.assertTrue(storage.enforce_retention())
+        self.assertEqual(set(storage.state.proposals), {'all'})
+        self.assertEqual(storage.get_all_proposals().proposals, [])
+        self.assertEqual(storage._flights, {})
+        self.assertEqual(storage._interned_sources, [])
+
+    def test_lazy(self):
+        eager = Storage(workers=1, snapshot_path=None)
+        eager.load()
+        # Объекты предложений создаются порциями, а не для всего файла.
+        with unittest.mock.patch('storage.LAZY_PROPOSALS', True), \
+                unittest.mock.patch('storage.LAZY_BUILD_CHUNK', 64), \
+                unittest.mock.patch.object(
+                    Storage, '_create_proposals') as create:
+            lazy = Storage(workers=1, snapshot_path=None)
+            lazy.load()
+            parallel = Storage(workers=2, snapshot_path=None)
+            parallel.load()
+
+        create.assert_not_called()
+        flt = ProposalsFilter(via='DEL')
+        for key, data in lazy.get_proposals().items():
+            expected = eager.get_proposals()[key]
+            self.assertIsInstance(data.proposals, LazyProposals)
+            self.assertEqual(
+                data.stats.distributions, expected.stats.distributions)
+            for name, groups in expected.stats.groups.items():
+                self.assertEqual(
+                    {label: (item.count, item.cheapest.adult_prize,
+                             item.fastest.duration)
+                     for label, item in data.stats.groups[name].items()},
+                    {label: (item.count, item.cheapest.adult_prize,
+                             item.fastest.duration)
+                     for label, item in groups.items()})
+            self.assertEqual(
+                list(data.filter_index.positions(flt)),
+                list(expected.filter_index.positions(flt)))
+            self.assertEqual(
+                list(data.route_index.find('DXB', 'BKK')),
+                list(expected.route_index.find('DXB', 'BKK')))
+            self.assertEqual(
+                list(parallel.get_proposals()[key].indexes['adult_prize']),
+                list(expected.indexes['adult_prize']))
+            self.assertEqual(len(data.proposals), len(expected.proposals))
+            for lazy_p, eager_p in zip(data.proposals, expected.proposals):
+                self.assertEqual(lazy_p.flights, eager_p.flights)
+                self.assertEqual(lazy_p.pricing, eager_p.pricing)
+                self.assertEqual(lazy_p.source, eager_p.source)
+            self.assertEqual(
+                list(data.indexes['optimality']),
+                list(expected.indexes['optimality']))
+            # От предложения остаются только ссылки на тэг в файле.
+            self.assertLess(data.data_bytes * 10, expected.data_bytes)
+
+        data = lazy.get_all_proposals()
+        self.assertEqual(
+            data.fragment(3), dump_proposal_json(data.proposals[3]))
+        # Вытесненное из кэша предложение разбирается с тем же uuid.
+        uuid = data.proposals[3].uuid
+        data.proposals.cache_size = 1
+        data.proposals[4]
+        self.assertEqual(data.proposals[3].uuid, uuid)
+        # В снимок попадают пути к файлам, а не отображения.
+        copy = pickle.loads(pickle.dumps(data))
+        self.assertEqual(copy.proposals[3].flights, data.proposals[3].flights)
+        self.assertEqual(copy.proposals[3].uuid, uuid)
+
+    def test_parallel_load(self):
+        def flights(storage, key):
+            return [p.flights for p in storage.get_proposals()[key].proposals]
+
+        sequential = Storage(workers=1, snapshot_path=None)
+        sequential.load()
+        # Мелкие порции и короткая очередь, чтобы дочерние процессы
+        # ждали, пока основной разберет переданные предложения.
+        with unittest.mock.patch('storage.LOAD_CHUNK', 7), \
+                unittest.mock.patch('storage.LOAD_QUEUE_CHUNKS', 1):
+            parallel = Storage(workers=2, snapshot_path=None)
+            parallel.load()
+
+        for key in (VIA_3_KEY, VIA_OW_KEY, 'all'):
+            self.assertEqual(
+                flights(parallel, key), flights(sequential, key))
+
+        # Ошибка парсинга в дочернем процессе доходит до основного.
+        with tempfile.TemporaryDirectory() as path:
+            shutil.copy(RS_VIA_3_XML, path)
+            with open(os.path.join(path, 'RS_Broken.xml'), 'w') as f:
+                f.write('<AirFareSearchResponse><PricedItineraries>')
+            broken = Storage(
+                pattern=os.path.join(path, 'RS_*.xml'), workers=2,
+                snapshot_path=None)
+            with self.assertRaises(ET.ParseError):
+                broken.load()
+
+
+class TestProposals(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        storage = Storage(workers=1, snapshot_path=None)
+        storage.load()
+        cls.data = storage.get_all_proposals()
+        cls.parts = storage.get_proposals()
+
+    def test_subset(self):
+        # Без предложений via_3 получается то же, что при сборке заново.
+        parts = self.parts
+        keep = np.arange(len(self.data.proposals)) >= len(
+            parts[VIA_3_KEY].proposals)
+        subset = self.data.subset(keep, parts=[parts[VIA_OW_KEY]])
+        expected = Proposals.concat([parts[VIA_OW_KEY]])
+        expected.build_indexes()
+
+        self.assertEqual(subset.proposals, expected.proposals)
+        self.assertEqual(subset.fragments, expected.fragments)
+        for key, index in expected.indexes.items():
+            self.assertEqual(list(subset.indexes[key]), list(index), key)
+        for name, index in expected.filter_index.inverted.items():
+            self.assertEqual(
+                {k: list(v) for k, v in
+                 subset.filter_index.inverted[name].items()},
+                {k: list(v) for k, v in index.items()}, name)
+        for name, (values, order) in expected.filter_index.ranges.items():
+            self.assertEqual(
+                list(subset.filter_index.ranges[name][1]), list(order))
+        self.assertEqual(subset.stats.body, expected.stats.body)
+        routes, expected_routes = subset.route_index, expected.route_index
+        self.assertEqual(list(routes.offsets), list(expected_routes.offsets))
+        self.assertEqual(
+            sorted(routes.adjacency), sorted(expected_routes.adjacency))
+        self.assertEqual(
+            list(routes.find('DXB', 'BKK')),
+            list(expected_routes.find('DXB', 'BKK')))
+
+    def test_order_by_index(self):
+        data = self.data
+        for key in ('adult_prize', 'child_prize', 'duration'):
+            expected = sorted(data.proposals, key=attrgetter(key))
+            self.assertEqual(data.order_by(key), expected)
+            self.assertEqual(data.order_by(key, limit=5), expected[:5])
+            # Равные значения и при reverse идут в порядке загрузки.
+            expected = sorted(
+                data.proposals, key=attrgetter(key), reverse=True)
+            self.assertEqual(data.order_by(key, reverse=True), expected)
+            flt = ProposalsFilter(max_segments=2)
+            self.assertEqual(
+                data.order_by(key, reverse=True, flt=flt),
+                [p for p in expected if len(p.flights.onward) <= 2])
+        key = methodcaller(
+            'calc_optimality',
+            min_prize=data.min_prize,
+            min_duration=data.min_duration)
+        expected = sorted(data.proposals, key=key, reverse=True)
+
+        self.assertEqual(data.order_by('optimality', limit=10), expected[:10])
+        self.assertEqual(
+            data.order_by('optimality', reverse=True),
+            sorted(data.proposals, key=key))
+
+    def test_table(self):
+        data = self.data
+        table = data.table
+        prizes = [p.adult_prize for p in data.proposals]
+
+        self.assertEqual(len(table), len(data.proposals))
+        self.assertEqual(data.min_prize, min(prizes))
+        self.assertEqual(
+            data.min_duration, min(p.duration for p in data.proposals))
+        self.assertEqual(table.max('adult_prize'), float(max(prizes)))
+        self.assertEqual(set(table.sources), {VIA_3_KEY, VIA_OW_KEY})
+
+    def test_empty(self):
+        # Пустой каталог данных или вытеснение всех источников.
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        storage = Storage(
+            workers=1, snapshot_path=None,
+            pattern=os.path.join(tmp_dir, 'RS_*.xml'))
+        storage.load()
+        data = storage.get_all_proposals()
+
+        self.assertEqual(len(data.table.optimality()), 0)
+        self.assertEqual(
+            len(data.table.optimality(OptimalityWeights(stops=1))), 0)
+        self.assertEqual(
+            list(data.order_positions('optimality', limit=3)), [])
+
+    def test_pricing(self):
+        proposal = self.data.proposals[0]
+        pricing = proposal.pricing[0]
+
+        self.assertEqual(pricing.currency, 'SGD')
+        self.assertIsInstance(pricing.total_amount, int)
+        self.assertIsInstance(proposal.adult_prize, int)
+        self.assertEqual(
+            proposal.adult_prize,
+            pricing.total_amount * 10 ** (PRICE_EXPONENT - 2))
+        self.assertEqual(
+            ProposalSchema().dump(proposal).data['pricing'][0]['total_amount'],
+            Decimal(pricing.total_amount).scaleb(-2))
+
+    def test_rank(self):
+        weights = OptimalityWeights(
+            price=0.5, duration=0.2, stops=0.3, adults=2, children=1)
+        prizes = [
+            2 * float(p.adult_prize) + float(p.child_prize)
+            for p in self.data.proposals]
+        durations = [p.duration for p in self.data.proposals]
+        segments = [len(p.flights.onward) for p in self.data.proposals]
+
+        def key(i):
+            return -(
+                0.5 * min(prizes) / prizes[i] +
+                0.2 * min(durations) / durations[i] +
+                0.3 * min(segments) / segments[i])
+
+        expected = sorted(range(len(prizes)), key=key)[:7]
+        expected = [self.data.proposals[i] for i in expected]
+
+        self.assertEqual(self.data.rank(weights, limit=7), expected)
+
+    def test_order_by_top_k(self):
+        key = attrgetter('child_prize')
+        for reverse in (False, True):
+            expected = sorted(self.data.proposals, key=key, reverse=reverse)
+            result = self.data.order_by(key, reverse=reverse, limit=3)
+            self.assertEqual(result, expected[:3])
+
+    def test_best(self):
+        for key in ('adult_prize', 'child_prize', 'infant_prize', 'duration'):
+            for reverse in (False, True):
+                expected = sorted(
+                    self.data.proposals, key=attrgetter(key),
+                    reverse=reverse)
+                self.assertIs(
+                    self.data.best(key, reverse=reverse), expected[0])
+
+    def test_filter(self):
+        data = self.data
+        carrier_id = data.proposals[0].flights.onward[0].carrier_id
+        flt = ProposalsFilter(
+            carrier_id=carrier_id, max_segments=2, max_adult_prize=1000)
+
+        def match(proposal):
+            flights = proposal.flights.onward + proposal.flights.returned
+            return (
+                any(f.carrier_id == carrier_id for f in flights) and
+                len(proposal.flights.onward) <= 2 and
+                proposal.adult_prize <= 1000 * 10 ** PRICE_EXPONENT)
+
+        expected = [p for p in data.proposals if match(p)]
+        positions = data.order_positions(flt=flt)
+
+        self.assertTrue(expected)
+        self.assertEqual([data.proposals[i] for i in positions], expected)
+
+        for key in ('duration', 'optimality'):
+            for reverse in (False, True):
+                result = data.order_by(
+                    key, reverse=reverse, limit=5, flt=flt)
+                ordered = [
+                    p for p in data.order_by(key, reverse=reverse)
+                    if match(p)]
+                self.assertEqual(result, ordered[:5])
+
+        flt = ProposalsFilter(source='NOPE')
+        self.assertEqual(len(data.order_positions(flt=flt)), 0)
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.set('a', 1, b'12345')
+        cache.set('b', 1, b'12345')
+        cache.get('a', 1)
+        cache.set('c', 1, b'123')
+
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1).body, b'12345')
+        self.assertEqual(cache.size, 8)
+
+    def test_version(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.set('a', 1, b'12345')
+
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(len(cache), 0)
+
+
+class TestUtils(unittest.TestCase):
+    def test_str2minor(self):
+        self.assertEqual(str2minor('546.80', 2), 54680)
+        self.assertEqual(str2minor('20', 2), 2000)
+        self.assertEqual(str2minor('.5', 3), 500)
+        self.assertEqual(str2minor('-3.2', 2), -320)
+        self.assertEqual(str2minor('117.005', 2), 11701)
+        self.assertEqual(str2minor('1500', 0), 1500)
+        self.assertIsNone(str2minor('1.2.3', 2))
+        self.assertIsNone(str2minor('', 2))
+
+    def test_str2timestamp(self):
+        values = (
+            '2018-10-22T0005', '2018-1-5T0005', '2018-02-30T0005',
+            '2018-10-22 0005', '', None,
+        )
+        for value in values:
+            expected = str2date(value, DateFormat.TIMESTAMP.value)
+            self.assertEqual(str2timestamp(value), expected)
+
 
 if __name__ == '__main__':
         unittest.main()
@@ -1,9 +1,28 @@
 import json
+import re
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum
+from pathlib import Path
 from typing import Union
 
+from config import JSON_INDENT
+
+
+# Количество знаков после запятой в минимальных единицах валют,
+# у которых оно отличается от DEFAULT_CURRENCY_EXPONENT (ISO 4217).
+CURRENCY_EXPONENTS = {
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0,
+    'KRW': 0, 'PYG': 0, 'RWF': 0, 'UGX': 0, 'VND': 0, 'VUV': 0, 'XAF': 0,
+    'XOF': 0, 'XPF': 0,
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+}
+DEFAULT_CURRENCY_EXPONENT = 2
+# Количество знаков после запятой в ценах, по которым предложения
+# сортируются и сравниваются. Не меньше, чем у любой валюты,
+# поэтому цены в разных валютах переводятся в него без потерь.
+PRICE_EXPONENT = 3
+
 
 class DateFormat(Enum):
     DEFAULT = '%d-%m-%Y %H:%M:%S'
@@ -22,6 +41,28 @@ def str2date(date_string: str, date_format: str) -> Union[datetime, None]:
     return result
 
 
+def str2timestamp(date_string: str) -> Union[datetime, None]:
+    """Преобразует строку формата DateFormat.TIMESTAMP в дату.
+
+    Строки фиксированной длины (Пр.: "2018-10-22T0005") разбираются срезами
+    без strptime, остальные передаются в str2date.
+    В случае неудачного преобразования возвращает None.
+    """
+    if (date_string and len(date_string) == 15 and
+            date_string[4] == '-' and date_string[7] == '-' and
+            date_string[10] == 'T' and
+            date_string.replace('-', '').replace('T', '').isdigit()):
+        try:
+            return datetime(
+                int(date_string[:4]), int(date_string[5:7]),
+                int(date_string[8:10]), int(date_string[11:13]),
+                int(date_string[13:15]))
+        except ValueError:
+            pass
+
+    return str2date(date_string, date_format=DateFormat.TIMESTAMP.value)
+
+
 def str2int(int_string: str) -> Union[int, None]:
     """Преобразует строку в целое число.
     В случае неудачного преобразования возвращает None.
@@ -34,6 +75,69 @@ def str2int(int_string: str) -> Union[int, None]:
     return result
 
 
+def currency_exponent(currency: Union[str, None]) -> int:
+    """Количество знаков после запятой в минимальной единице валюты
+    (ISO 4217). Для неизвестной валюты - DEFAULT_CURRENCY_EXPONENT."""
+    return CURRENCY_EXPONENTS.get(currency, DEFAULT_CURRENCY_EXPONENT)
+
+
+def str2minor(amount_string: str, exponent: int) -> Union[int, None]:
+    """Преобразует сумму в основных единицах валюты в целое количество
+    минимальных единиц с exponent знаками после запятой.
+
+    Пр.: str2minor('546.80', 2) -> 54680. Лишние знаки после запятой
+    округляются до ближайшего (половина - от нуля).
+    В случае неудачного преобразования возвращает None.
+    """
+    text = amount_string.strip()
+    sign = -1 if text.startswith('-') else 1
+    integer, _, fraction = text.lstrip('+-').partition('.')
+    if not (integer or fraction) or not (integer + fraction).isdigit():
+        return None
+
+    fraction = fraction.ljust(exponent, '0')
+    result = int(integer or '0') * 10 ** exponent + int(
+        fraction[:exponent] or '0')
+    if fraction[exponent:exponent + 1] >= '5':
+        result += 1
+
+    return sign * result
+
+
+def scale_minor(amount: int, exponent: int) -> int:
+    """Переводит сумму из минимальных единиц валюты с exponent знаками
+    в целое с PRICE_EXPONENT знаками после запятой."""
+    return amount * 10 ** (PRICE_EXPONENT - exponent)
+
+
+def minor2decimal(amount: int, exponent: int) -> Decimal:
+    """Переводит целую сумму с exponent знаками после запятой в Decimal.
+
+    Используется только при выводе: внутри суммы хранятся целыми.
+    """
+    return Decimal(amount).scaleb(-exponent)
+
+
+def source_key(file_path: str) -> str:
+    """Возвращает ключ источника по имени файла.
+
+    Пр.: "RS_Via-3.xml" -> "via_3", "RS_ViaOW.xml" -> "via_ow".
+    """
+    name = Path(file_path).stem
+    if name.startswith('RS_'):
+        name = name[3:]
+    name = re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name)
+    name = re.sub(r'[^0-9a-zA-Z]+', '_', name)
+
+    return name.strip('_').lower()
+
+
+def source_file_name(key: str) -> str:
+    """Возвращает имя файла для ключа источника,
+    обратное source_key: "via_3" -> "RS_via_3.xml"."""
+    return f'RS_{key}.xml'
+
+
 class ExtendedJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, Decimal):
@@ -44,5 +148,13 @@ class ExtendedJSONEncoder(json.JSONEncoder):
         return result
 
 
-def jsonify(data):
-    return json.dumps(data, cls=ExtendedJSONEncoder, indent=2, sort_keys=True)
+def jsonify(data, indent: Union[int, None] = JSON_INDENT) -> str:
+    """Сериализует данные в JSON.
+
+    При indent=None используется компактный вид без пробелов.
+    """
+    separators = (',', ':') if indent is None else None
+
+    return json.dumps(
+        data, cls=ExtendedJSONEncoder, indent=indent, sort_keys=True,
+        separators=separators)